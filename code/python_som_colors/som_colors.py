@@ -1,7 +1,6 @@
+import argparse
 import math
 import numpy as np
-import sys
-import random
 import svgwrite
 from PIL import Image
 
@@ -17,13 +16,20 @@ NEIGHBOURHOOD_SHRINK_FACTOR = 600.0
 LEARNING_RATE_SHRINK_FACTOR = 300.0
 EPOCH_SIZE = 1
 NUM_EPOCHS = 1000
+# Lattice coordinates of every neuron, for computing neighbourhoods all at once
+(LATTICE_Y, LATTICE_X) = np.mgrid[0:LATTICE_HEIGHT, 0:LATTICE_WIDTH]
+# Squared distances between the rows, and between the columns, of the lattice
+LATTICE_Y_DISTANCES = (np.arange(LATTICE_HEIGHT)[:, np.newaxis] - np.arange(LATTICE_HEIGHT)) ** 2
+LATTICE_X_DISTANCES = (np.arange(LATTICE_WIDTH)[:, np.newaxis] - np.arange(LATTICE_WIDTH)) ** 2
+# How many pixels are compared against the lattice at once
+BMU_CHUNK_SIZE = 4096
+# Bits kept from each colour channel when building the palette lookup table,
+# giving (2**LUT_BITS)**3 buckets
+LUT_BITS = 5
 
 def negexp(x):
     return math.exp(-x)
 
-def discriminant_function(w1, w2):
-    return np.linalg.norm(w2 - w1)
-
 def neighbourhood_size(time):
     #return DELTA0 * (1 - math.exp(-time / NEIGHBOURHOOD_SHRINK_FACTOR))
     return DELTA0 * negexp(time / NEIGHBOURHOOD_SHRINK_FACTOR)
@@ -31,42 +37,100 @@ def neighbourhood_size(time):
 def learning_rate(time):
     return INITIAL_LEARNING_RATE * math.exp(-time / LEARNING_RATE_SHRINK_FACTOR)
 
-def neighbourhood_function(neuron1, neuron2, time):
-    (x1, y1) = neuron1
-    (x2, y2) = neuron2
-    dist = ((x2 - x1)**2 + (y2 - y1) ** 2)
-    #T = negexp(dist / 2 * neighbourhood_size(time)**2)
-    T = negexp(dist / neighbourhood_size(time))
-    return T
+def find_winning_neurons(patterns):
+    """Finds the winning neuron of each pattern
+    Args:
+        patterns (np.ndarray): (n, INPUT_DIMENSIONS) array of patterns
+    Returns:
+        np.ndarray: (n,) array of neuron indices into the flattened lattice,
+            y * LATTICE_WIDTH + x. Ties go to the first neuron row by row.
+    """
+    weights = WEIGHTS.reshape(-1, INPUT_DIMENSIONS)
+    patterns = np.asarray(patterns, dtype=np.float64).reshape(-1, INPUT_DIMENSIONS)
+    winners = np.zeros(len(patterns), dtype=np.intp)
+    for start in range(0, len(patterns), BMU_CHUNK_SIZE):
+        chunk = patterns[start:start+BMU_CHUNK_SIZE]
+        diffs = chunk[:, np.newaxis, :] - weights[np.newaxis, :, :]
+        winners[start:start+len(chunk)] = np.argmin(np.einsum("ijk,ijk->ij", diffs, diffs), axis=1)
+    return winners
 
 def find_winning_neuron(pattern):
-    best_d = sys.float_info.max
-    best_neuron = (0, 0)
-    for y in range(LATTICE_HEIGHT):
-        for x in range(LATTICE_WIDTH):
-            neuron_weights = WEIGHTS[y][x]
-            d = discriminant_function(neuron_weights, pattern)
-            if d < best_d:
-                best_d = d
-                best_neuron = (x, y)
-    return best_neuron
+    winner = find_winning_neurons(pattern)[0]
+    return (int(winner % LATTICE_WIDTH), int(winner // LATTICE_WIDTH))
+
+def neighbourhood_grid(winning_neuron, time):
+    """The neighbourhood function between the winning neuron and every neuron"""
+    (x, y) = winning_neuron
+    dist = (LATTICE_X - x) ** 2 + (LATTICE_Y - y) ** 2
+    return np.exp(-dist / neighbourhood_size(time))
 
 def adapt_weights(winning_neuron, pattern, time):
+    T = neighbourhood_grid(winning_neuron, time)
+    WEIGHTS[...] += learning_rate(time) * T[:, :, np.newaxis] * (pattern - WEIGHTS)
+
+def adapt_weights_batch(winners, patterns, time):
+    """Adapts the weights to a batch of patterns at once. Each neuron moves
+    towards the neighbourhood-weighted mean of the patterns, by the fraction
+    1 - exp(-n * sum(T)) that as many single updates towards that mean would
+    move it.
+    """
     n = learning_rate(time)
-    count = 0
-    for y in range(LATTICE_HEIGHT):
-        for x in range(LATTICE_WIDTH):
-            T = neighbourhood_function(winning_neuron, (x,y), time)
-            delta = pattern - WEIGHTS[y][x]
-            update_delta = n * T * delta
-            #print("WEIGHTS[y][x]", WEIGHTS[y][x])
-            #print("n", n)
-            #print("T", T)
-            #print("delta", delta)
-            #print("update_delta", update_delta)
-            WEIGHTS[y][x] += update_delta
-            #print("WEIGHTS[y][x]", WEIGHTS[y][x])
-            #print()
+    # Patterns won by each neuron, and their sum
+    counts = np.bincount(winners, minlength=LATTICE_HEIGHT * LATTICE_WIDTH)
+    sums = np.zeros((LATTICE_HEIGHT * LATTICE_WIDTH, INPUT_DIMENSIONS))
+    np.add.at(sums, winners, patterns)
+
+    # The neighbourhood function is a product of one along each axis, so it is
+    # applied to the lattice one axis at a time
+    T_y = np.exp(-LATTICE_Y_DISTANCES / neighbourhood_size(time))
+    T_x = np.exp(-LATTICE_X_DISTANCES / neighbourhood_size(time))
+    total_T = T_y.dot(counts.reshape(LATTICE_HEIGHT, LATTICE_WIDTH)).dot(T_x)
+    weighted_sum = np.einsum("ab,bcd,ce->aed", T_y, sums.reshape(WEIGHTS.shape), T_x, optimize=True)
+
+    mean = weighted_sum / np.maximum(total_T, np.finfo(np.float64).tiny)[:, :, np.newaxis]
+    WEIGHTS[...] += -np.expm1(-n * total_T)[:, :, np.newaxis] * (mean - WEIGHTS)
+
+def train(pixels, num_epochs=NUM_EPOCHS, epoch_size=EPOCH_SIZE):
+    """Trains the map on batches of epoch_size pixels, one batch per epoch,
+    going round the pixels in order
+    Args:
+        pixels (np.ndarray): (n, INPUT_DIMENSIONS) array of pixel colours
+    """
+    pixels = np.asarray(pixels, dtype=np.float64)
+    for time in range(num_epochs):
+        indices = (time * epoch_size + np.arange(epoch_size)) % len(pixels)
+        batch = pixels[indices]
+        winners = find_winning_neurons(batch)
+        if epoch_size == 1:
+            adapt_weights((winners[0] % LATTICE_WIDTH, winners[0] // LATTICE_WIDTH), batch[0], time)
+        else:
+            adapt_weights_batch(winners, batch, time)
+
+def build_palette_lut(bits=LUT_BITS):
+    """Maps every colour, reduced to `bits` bits per channel, to the winning
+    neuron of the centre of its bucket
+    Returns:
+        np.ndarray: ((2**bits)**3,) array of neuron indices, indexed by
+            (r << 2*bits) | (g << bits) | b of the reduced colour
+    """
+    levels = 2 ** bits
+    centres = (np.arange(levels) + 0.5) * (256.0 / levels)
+    (r, g, b) = np.meshgrid(centres, centres, centres, indexing="ij")
+    buckets = np.column_stack((r.ravel(), g.ravel(), b.ravel()))
+    return find_winning_neurons(buckets).astype(np.uint16)
+
+def quantize_pixels(pixels, lut, bits=LUT_BITS):
+    """Replaces every pixel by the colour of its neuron, looked up in the lut
+    Args:
+        pixels (np.ndarray): (..., 3) uint8 array, e.g. a whole RGB image
+        lut (np.ndarray): from build_palette_lut
+    Returns:
+        np.ndarray: uint8 array of the same shape as pixels
+    """
+    reduced = (np.asarray(pixels, dtype=np.uint8) >> (8 - bits)).astype(np.intp)
+    index = (reduced[..., 0] << (2 * bits)) | (reduced[..., 1] << bits) | reduced[..., 2]
+    palette = np.clip(np.rint(WEIGHTS.reshape(-1, INPUT_DIMENSIONS)), 0, 255).astype(np.uint8)
+    return palette[lut[index]]
 
 def output_jpeg():
     pixel_list = []
@@ -96,40 +160,39 @@ def output_svg():
 
 if __name__ == "__main__":
 #if 0:
-    if len(sys.argv) < 2:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("image", nargs="?", help="Path to the image file to train on")
+    parser.add_argument("--epochs", type=int, default=NUM_EPOCHS)
+    parser.add_argument("--epoch-size", type=int, default=EPOCH_SIZE,
+                        help="How many pixels to train on at once in each epoch")
+    parser.add_argument("--quantize", help="Path to save the image quantized to the SOM palette to")
+    parser.add_argument("--lut-bits", type=int, default=LUT_BITS,
+                        help="Bits kept from each channel in the palette lookup table")
+    args = parser.parse_args()
+
+    if args.image is None:
         print("Please give path to image file as argument")
     else:
-        image_path = sys.argv[1]
-        im = Image.open(image_path)
+        image_path = args.image
+        im = Image.open(image_path).convert("RGB")
         print("Opening image: " + image_path)
         print(im.size)
 
-        # List of all the pixel colour values
-        im_data = list(im.getdata())
-        random.shuffle(im_data)
+        # All the pixel colour values
+        im_data = np.asarray(im, dtype=np.uint8).reshape(-1, 3)
+        shuffled = im_data[np.random.permutation(len(im_data))]
         print("Number of pixels: ", len(im_data))
 
         # TRAINING STAGE
-        # Iterate through all inputs in batches
         print("TRAINING")
-        for time in range(NUM_EPOCHS):
-            print("Epoch: " + str(time))
-            for j in range(EPOCH_SIZE):
-                pixel_index = (time * EPOCH_SIZE + j) % len(im_data)
-                pixel = np.array(im_data[pixel_index])
-                winning_neuron = find_winning_neuron(pixel)
-                adapt_weights(winning_neuron, pixel, time)
-
+        train(shuffled, args.epochs, args.epoch_size)
 
         # OUTPUT
-        """
-        print("OUTPUT")
-        pixel_grid = np.zeros((LATTICE_HEIGHT, LATTICE_WIDTH, 3))
-        # Check where every input is placed in the SOM
-        for i in range(len(im_data)):
-            pixel = np.array(im_data[i])
-            (x, y) = find_winning_neuron(pixel)
-            pixel_grid[y][x] = pixel
-            print(i, pixel, (x,y))
-        """
         output_svg()
+
+        if args.quantize:
+            print("QUANTIZING")
+            lut = build_palette_lut(args.lut_bits)
+            quantized = quantize_pixels(np.asarray(im, dtype=np.uint8), lut, args.lut_bits)
+            Image.fromarray(quantized, "RGB").save(args.quantize)
+            print("Saved quantized image to " + args.quantize)
@@ -0,0 +1,29 @@
+import unittest
+import numpy as np
+
+try:
+    import som_colors
+except ImportError: # svgwrite or PIL missing
+    som_colors = None
+
+@unittest.skipIf(som_colors is None, "som_colors needs svgwrite and PIL")
+class TestPaletteLUT(unittest.TestCase):
+
+    def test_lut_matches_bmu(self):
+        np.random.seed(1)
+        som_colors.WEIGHTS[:] = np.random.uniform(0, 255, som_colors.WEIGHTS.shape)
+        bits = 5
+        lut = som_colors.build_palette_lut(bits)
+
+        # Colours at the centres of their buckets, where the lut is exact
+        step = 256 // 2 ** bits
+        pixels = (np.random.randint(0, 2 ** bits, (4, 5, 3)) * step + step // 2).astype(np.uint8)
+        quantized = som_colors.quantize_pixels(pixels, lut, bits)
+        self.assertEqual(quantized.shape, pixels.shape)
+
+        palette = np.clip(np.rint(som_colors.WEIGHTS.reshape(-1, 3)), 0, 255).astype(np.uint8)
+        winners = som_colors.find_winning_neurons(pixels.reshape(-1, 3))
+        np.testing.assert_array_equal(quantized.reshape(-1, 3), palette[winners])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,328 @@
+"""Benchmarks of the CMM, the encoders and the SOM at several dataset sizes.
+
+    python benchmark.py --output results.json
+    python benchmark.py --baseline benchmark_baseline.json
+    python benchmark.py --save-baseline benchmark_baseline.json
+
+Every benchmark is run on each dataset: iris (150 patterns), the bundled
+MNIST 1000, and synthetic sets of uniformly random attributes with one-hot
+classes at each of the --scales sizes. Benchmarks of per-pattern calls
+(CMM.insert, CMM.recall, SOM.findBMU, ...) time at most --max-calls patterns;
+the others run on the whole dataset. Each timing is the best of at least
+--repeats runs, and of as many more as fit in --min-time seconds, so that
+short benchmarks are timed often enough to be stable.
+
+With --baseline, the results are compared against a previous results file.
+The exit status is 1 if any benchmark in the baseline is missing from the
+results, or if any benchmark is more than --tolerance slower. Only the
+datasets of this run count towards missing benchmarks: the iris and MNIST
+files, whose absence is a failure, and the synthetic datasets of --scales.
+So the comparison can be run on a quicker subset of the baseline's scales.
+Benchmarks which took less than --min-seconds in the baseline are too noisy
+to count as regressions.
+
+Timings depend on the machine, so slowdowns only fail the run when the
+baseline was recorded in the same environment (CPU, CPU count, python and
+numpy versions), or with --strict. Otherwise they are reported as advisory.
+benchmark_baseline.json is such a snapshot of one development machine, to be
+regenerated with --save-baseline on the machine that runs the comparison.
+"""
+import argparse
+import datetime
+import json
+import os
+import os.path
+import platform
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import som2cmm.cmm as cmm
+import som2cmm.encoding_schemes as enc
+import som2cmm.som as som
+import som2cmm.utils as utils
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data")
+IRIS_PATH = os.path.join(DATA_DIR, "iris", "iris.data.original")
+MNIST_PATH = os.path.join(DATA_DIR, "mnist", "mnist_som_test_1000.txt")
+FILE_DATASETS = [("iris", IRIS_PATH), ("mnist1000", MNIST_PATH)]
+
+DEFAULT_SCALES = [10000, 100000, 1000000]
+SYNTHETIC_DIMS = 8
+SYNTHETIC_CLASSES = 10
+BITS_PER_ATTR = 16
+SOM_SIZE = 10
+BAUM_SEGMENT_SIZES = [31, 37]
+THRESHOLD_FUNC = "lmax1"
+DEFAULT_MIN_TIME = 0.2
+MAX_RUNS = 1000
+DEFAULT_MIN_SECONDS = 0.005
+# Environment fields which must match for timings to be comparable
+ENVIRONMENT_KEYS = ["machine", "cpu", "cpu_count", "python", "numpy"]
+BASELINE_NOTE = ("Timings from a single machine, see \"environment\". They are only a "
+                 "regression gate on a matching environment, elsewhere they are advisory.")
+
+def load_datasets(scales, seed=0):
+    """Returns the (name, keys, values) of each dataset to benchmark on. The
+    keys are float attributes and the values one-hot classes."""
+    datasets = []
+    for (name, path) in FILE_DATASETS:
+        if os.path.isfile(path):
+            keys, values, _ = utils.load_patterns_csv(path)
+            datasets.append((name, keys, values))
+        else:
+            print("Skipping {}, {} is missing".format(name, path), file=sys.stderr)
+
+    rng = np.random.RandomState(seed)
+    for n in scales:
+        keys = rng.uniform(0, 1, (n, SYNTHETIC_DIMS))
+        values = np.eye(SYNTHETIC_CLASSES, dtype=np.int64)[rng.randint(SYNTHETIC_CLASSES, size=n)]
+        datasets.append(("synthetic{}".format(n), keys, values))
+    return datasets
+
+def dataset_names(scales):
+    """The names of the datasets load_datasets(scales) is asked for, including
+    any whose file is missing"""
+    return [name for (name, _) in FILE_DATASETS] + ["synthetic{}".format(n) for n in scales]
+
+def time_best(run, setup=None, repeats=3, min_time=0.0, max_runs=MAX_RUNS):
+    """Times calls to run, each given the result of a fresh call to setup if
+    there is one. It's called at least `repeats` times, and then again until
+    the calls add up to min_time seconds or it has been called max_runs times.
+    Returns:
+        tuple(float, int): the shortest time in seconds and the number of calls
+    """
+    best = None
+    total = 0.0
+    runs = 0
+    while runs < repeats or (total < min_time and runs < max_runs):
+        state = setup() if setup is not None else None
+        start = time.perf_counter()
+        run(state)
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+        total += seconds
+        runs += 1
+    return (best, runs)
+
+def column_vectors(rows):
+    """(n, size) array to a list of the (size, 1) vectors CMM.insert/recall take"""
+    return [row.reshape(-1, 1) for row in np.asarray(rows, dtype=np.float64)]
+
+def benchmark_dataset(keys, values, tmp_dir, max_calls=10000, repeats=3, seed=0,
+                      min_time=DEFAULT_MIN_TIME):
+    """Runs every benchmark on one dataset
+    Returns:
+        dict: maps each benchmark's name to its number of items and best time
+    """
+    results = {}
+    n = len(keys)
+    sample = np.random.RandomState(seed).choice(n, min(n, max_calls), replace=False)
+
+    def record(name, items, run, setup=None):
+        (seconds, runs) = time_best(run, setup, repeats, min_time)
+        results[name] = {
+            "items": int(items),
+            "runs": runs,
+            "seconds": seconds,
+            "items_per_second": items / seconds if seconds > 0 else None,
+        }
+
+    # Encoders
+    qe = enc.QuantizationEncoder(utils.get_min_max_values(keys),
+                                 [BITS_PER_ATTR] * keys.shape[1], [1] * keys.shape[1])
+    key_codes = qe.encodeAll(keys)
+    record("QuantizationEncoder.encodeAll", n, lambda _: qe.encodeAll(keys))
+    record("QuantizationEncoder.decodeAll", n, lambda _: qe.decodeAll(key_codes))
+
+    dne = enc.DoNothingEncoder(1)
+    value_codes = dne.encodeAll(values)
+    record("DoNothingEncoder.encodeAll", n, lambda _: dne.encodeAll(values))
+    record("DoNothingEncoder.decodeAll", n, lambda _: dne.decodeAll(value_codes))
+
+    new_baum = lambda: enc.BaumEncoder(BAUM_SEGMENT_SIZES)
+    record("BaumEncoder.encodeAll", n, lambda be: be.encodeAll(values), setup=new_baum)
+    be = new_baum()
+    baum_codes = be.encodeAll(values)
+    record("BaumEncoder.decodeAll", n, lambda _: be.decodeAll(baum_codes))
+
+    # A SOM whose neurons are some of the patterns, saved as a text .som file
+    rng = np.random.RandomState(seed)
+    som_map = som.SOM()
+    som_map.setWeights(keys[rng.choice(n, SOM_SIZE * SOM_SIZE, replace=n < SOM_SIZE * SOM_SIZE)]
+                       .reshape(SOM_SIZE, SOM_SIZE, -1))
+    som_path = os.path.join(tmp_dir, "benchmark.som")
+    som_map.saveToFile(som_path)
+    record("SOM.loadFromFile", 1, lambda _: som.SOM().loadFromFile(som_path, use_cache=False))
+    som.SOM().loadFromFile(som_path)
+    record("SOM.loadFromFile(cached)", 1, lambda _: som.SOM().loadFromFile(som_path))
+    record("SOM.findBMU", len(sample), lambda _: [som_map.findBMU(keys[i]) for i in sample])
+    record("SOM.findBMUs", n, lambda _: som_map.findBMUs(keys))
+
+    se = enc.SOMEncoder(som_path)
+    som_codes = se.encodeAll(keys)
+    record("SOMEncoder.encodeAll", n, lambda _: se.encodeAll(keys))
+    record("SOMEncoder.decodeAll", n, lambda _: se.decodeAll(som_codes))
+
+    # CMM, storing the quantized keys against the one-hot values
+    key_size = key_codes.shape[1]
+    data_size = value_codes.shape[1]
+    bits_in_key = qe.get_num_bits_in_encoding()
+    new_cmm = lambda: cmm.CMM(key_size, data_size, bits_in_key, THRESHOLD_FUNC)
+    key_vecs = column_vectors(key_codes[sample])
+    value_vecs = column_vectors(value_codes[sample])
+
+    def insert_each(mem):
+        for (key_vec, value_vec) in zip(key_vecs, value_vecs):
+            mem.insert(key_vec, value_vec)
+    record("CMM.insert", len(sample), insert_each, setup=new_cmm)
+    record("CMM.insert_many", n, lambda mem: mem.insert_many(key_codes, value_codes), setup=new_cmm)
+
+    mem = new_cmm()
+    mem.insert_many(key_codes, value_codes)
+    record("CMM.recall", len(sample), lambda _: [mem.recall(key_vec, smart=False) for key_vec in key_vecs])
+    record("CMM.recall_smart", len(sample), lambda _: [mem.recall_smart(key_vec) for key_vec in key_vecs])
+    record("CMM.recall_batch(smart)", n, lambda _: mem.recall_batch(key_codes, smart=True))
+    return results
+
+def cpu_model():
+    """The name of the CPU, which platform.processor() often leaves empty on Linux"""
+    try:
+        with open("/proc/cpuinfo", 'r') as f:
+            for line in f:
+                if line.startswith("model name"):
+                    return line.split(":", 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor()
+
+def run_benchmarks(datasets, max_calls=10000, repeats=3, verbose=False, min_time=DEFAULT_MIN_TIME):
+    """Benchmarks each of the (name, keys, values) datasets
+    Returns:
+        dict: the environment and, for each "benchmark[dataset]", its result
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for (dataset, keys, values) in datasets:
+            for (name, result) in benchmark_dataset(keys, values, tmp_dir, max_calls, repeats,
+                                                       min_time=min_time).items():
+                results["{}[{}]".format(name, dataset)] = result
+                if verbose:
+                    print("{:<50} {:>10.6f}s".format("{}[{}]".format(name, dataset), result["seconds"]))
+
+    return {
+        "environment": {
+            "date": datetime.datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "platform": platform.platform(),
+            "cpu": cpu_model(),
+            "cpu_count": os.cpu_count(),
+            "max_calls": max_calls,
+            "repeats": repeats,
+            "min_time": min_time,
+        },
+        "results": results,
+    }
+
+def compare_results(results, baseline, tolerance=0.25, min_seconds=DEFAULT_MIN_SECONDS):
+    """Compares benchmark results against a baseline
+    Args:
+        tolerance (float): how much slower than the baseline, as a fraction,
+            a benchmark may be before it counts as a regression
+        min_seconds (float): benchmarks that took less than this in the
+            baseline vary by more than the tolerance from run to run, so they
+            are compared but never count as regressions
+    Returns:
+        list(tuple(str, float, float, bool)): the name, baseline seconds, seconds
+            and whether it regressed, for each benchmark in both
+    """
+    comparison = []
+    for (name, result) in sorted(results["results"].items()):
+        if name not in baseline["results"]:
+            continue
+        base_seconds = baseline["results"][name]["seconds"]
+        seconds = result["seconds"]
+        regressed = base_seconds >= min_seconds and seconds > base_seconds * (1 + tolerance)
+        comparison.append((name, base_seconds, seconds, regressed))
+    return comparison
+
+def missing_results(results, baseline, datasets=None):
+    """Returns the names of the benchmarks in the baseline which are missing
+    from the results
+    Args:
+        datasets (list(str)): only count benchmarks on these datasets, see
+            `dataset_names`. All of them count if it's None.
+    """
+    missing = set(baseline["results"]) - set(results["results"])
+    if datasets is not None:
+        datasets = set(datasets)
+        missing = [name for name in missing if name.rsplit("[", 1)[-1].rstrip("]") in datasets]
+    return sorted(missing)
+
+def same_environment(results, baseline):
+    """Whether the results and baseline were timed in the same environment"""
+    return all(results["environment"].get(key) == baseline.get("environment", {}).get(key)
+               for key in ENVIRONMENT_KEYS)
+
+def print_comparison(comparison):
+    print("{:<50} {:>11} {:>11} {:>8}".format("benchmark", "baseline", "now", "change"))
+    for (name, base_seconds, seconds, regressed) in comparison:
+        change = (seconds / base_seconds - 1) * 100 if base_seconds > 0 else 0
+        print("{:<50} {:>10.6f}s {:>10.6f}s {:>+7.1f}%{}".format(
+            name, base_seconds, seconds, change, "  REGRESSION" if regressed else ""))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scales", type=int, nargs='*', default=DEFAULT_SCALES,
+                        help="Sizes of the synthetic datasets")
+    parser.add_argument("--max-calls", type=int, default=10000,
+                        help="Most patterns to time per-pattern calls on")
+    parser.add_argument("--repeats", type=int, default=3,
+                        help="Fewest runs of each benchmark to take the best of")
+    parser.add_argument("--min-time", type=float, default=DEFAULT_MIN_TIME,
+                        help="Seconds to keep re-running each benchmark for, up to {} runs".format(MAX_RUNS))
+    parser.add_argument("--output", help="Path to write the results JSON to")
+    parser.add_argument("--baseline", help="Results JSON to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="Fraction slower than the baseline which counts as a regression")
+    parser.add_argument("--min-seconds", type=float, default=DEFAULT_MIN_SECONDS,
+                        help="Baseline seconds below which a benchmark is too noisy to count as a regression")
+    parser.add_argument("--save-baseline", help="Path to write the results to as the new baseline")
+    parser.add_argument("--strict", action="store_true",
+                        help="Fail on slowdowns even if the baseline is from a different environment")
+    args = parser.parse_args()
+
+    results = run_benchmarks(load_datasets(args.scales), args.max_calls, args.repeats, verbose=True,
+                             min_time=args.min_time)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(json.dumps(results, indent=4, sort_keys=True))
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            f.write(json.dumps(dict(results, note=BASELINE_NOTE), indent=4, sort_keys=True))
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        comparison = compare_results(results, baseline, args.tolerance, args.min_seconds)
+        print_comparison(comparison)
+        failed = False
+
+        missing = missing_results(results, baseline, dataset_names(args.scales))
+        if missing:
+            print("{} benchmark(s) in the baseline are missing: {}".format(len(missing), ", ".join(missing)))
+            failed = True
+
+        regressions = [name for (name, _, _, regressed) in comparison if regressed]
+        if regressions:
+            print("{} regression(s): {}".format(len(regressions), ", ".join(regressions)))
+            if args.strict or same_environment(results, baseline):
+                failed = True
+            else:
+                print("The baseline is from a different environment, so these are advisory only")
+        if failed:
+            sys.exit(1)
@@ -0,0 +1,30 @@
+"""Converts a JSON patterns file, or a CSV file of attributes and class labels,
+to a binary patterns file which main.py can read directly:
+
+    python convert_patterns.py iris_patterns.json iris_patterns.bin
+    python convert_patterns.py mnist_som_test_1000.txt mnist_1000.bin --class-index -1
+"""
+import argparse
+import os.path
+
+import som2cmm.utils as utils
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input", help="Path to the .json patterns file or .csv/.txt data file")
+    parser.add_argument("output", help="Path to the binary patterns file to write")
+    parser.add_argument("--class-index", type=int, default=-1,
+                        help="Column of the class label in a CSV file")
+    parser.add_argument("--classes", nargs='+',
+                        help="Class labels in one-hot order (default: the labels found, sorted)")
+    args = parser.parse_args()
+
+    assert(os.path.isfile(args.input))
+    if args.input.endswith(".json"):
+        utils.convert_patterns_json(args.input, args.output)
+    else:
+        utils.convert_patterns_csv(args.input, args.output, args.class_index, args.classes)
+
+    header, keys, values = utils.load_patterns_binary_file(args.output)
+    print("Wrote {} patterns ({} key attrs, {} value attrs) to {}".format(
+        header["count"], header["key_size"], header["value_size"], args.output))
@@ -7,6 +7,7 @@ import os.path
 import shutil
 import toml
 
+import som2cmm.cache as cache
 import som2cmm.encoding as encoding
 import som2cmm.utils as utils
 import som2cmm.cmm as cmm
@@ -31,11 +32,34 @@ def setup_logging():
     log.addHandler(ch)
     return log
 
-def run_experiment(config):
-    patterns = utils.load_patterns_file(config["input_patterns_file"])
+log = logging.getLogger("som2cmm")
+
+def load_experiment_patterns(config):
+    """Loads the key and value patterns of an experiment, keeping only the first
+    num_patterns pairs if the config sets it. A binary patterns file (see
+    utils.save_patterns_binary_file) is memory mapped rather than parsed.
+    Returns:
+        tuple: the key patterns and the value patterns, as lists for a JSON
+            patterns file or arrays for a binary one
+    """
+    input_path = config["input_patterns_file"]
+    num_patterns = config.get("num_patterns", None)
+    if utils.is_binary_file(input_path, utils.PATTERNS_MAGIC):
+        return utils.load_pattern_arrays(input_path, stop=num_patterns)
+
+    patterns = utils.load_patterns_file(input_path)
+    if num_patterns is not None:
+        patterns = patterns[:num_patterns]
     key_patterns   = [pair[0] for pair in patterns]
     value_patterns = [pair[1] for pair in patterns] 
+    return (key_patterns, value_patterns)
 
+def encode_experiment_patterns(config, key_patterns, value_patterns):
+    """Creates the key and value encoders given by the config and encodes the patterns
+    Returns:
+        tuple: the key encoder, the value encoder, and the (n, key_size) and
+            (n, data_size) arrays of encoded keys and values
+    """
     key_encoder_cfg = config["encoding"]["keys"]
     value_encoder_cfg = config["encoding"]["values"]
 
@@ -46,23 +70,86 @@ def run_experiment(config):
     key_encoder   = encoding.get_scheme(key_patterns, key_encoder_cfg)
     value_encoder = encoding.get_scheme(value_patterns, value_encoder_cfg)
 
-    key_patterns_enc   = key_encoder.encodeAll(key_patterns)
-    value_patterns_enc = value_encoder.encodeAll(value_patterns)
-
-    utils.save_patterns_file(key_patterns_enc, value_patterns_enc, "encoded_patterns.json")
-    utils.create_cmm_input_file(key_patterns_enc, value_patterns_enc, "cmm_input.txt")
-
-    recalled_patterns = cmm.run_experiment("cmm_input.txt", os.getcwd(),
-            key_encoder.get_num_bits_in_encoding(), config["cmm"])
-    # Represented as (n, 1) np ndarrays so convert
-    recalled_patterns = [list(val[:, 0]) for val in recalled_patterns]
-
-    decoded_recalled_patterns = value_encoder.decodeAll(recalled_patterns)
+    key_patterns_enc   = key_encoder.encode_batch(np.asarray(key_patterns))
+    value_patterns_enc = value_encoder.encode_batch(np.asarray(value_patterns))
+    return (key_encoder, value_encoder, key_patterns_enc, value_patterns_enc)
 
-    results = list(zip(key_patterns, value_patterns, decoded_recalled_patterns))
+def load_encoded_patterns(config, patterns_cache=None):
+    """Loads and encodes the patterns of an experiment, going through the
+    encoding cache if the config has a [cache] table
+    Args:
+        config (dict): The experiment config
+        patterns_cache (dict): if given, parsed patterns are shared through it
+            between calls for the same input file, whatever their num_patterns
+    Returns:
+        tuple: the key patterns, value patterns, key encoder, value encoder,
+            and the arrays of encoded keys and values
+    """
+    encoding_cache = cache.EncodingCache.from_config(config)
+    if encoding_cache is not None:
+        cache_key = cache.cache_key(config)
+        encoded = encoding_cache.get(cache_key)
+        if encoded is not None:
+            log.info("Using cached encoding %s", cache_key)
+            return encoded
+
+    if patterns_cache is None:
+        (key_patterns, value_patterns) = load_experiment_patterns(config)
+    else:
+        # All the patterns are cached, so that configs which only differ in
+        # num_patterns load the file once
+        input_path = config["input_patterns_file"]
+        if input_path not in patterns_cache:
+            patterns_cache[input_path] = load_experiment_patterns(dict(config, num_patterns=None))
+        (key_patterns, value_patterns) = patterns_cache[input_path]
+        num_patterns = config.get("num_patterns", None)
+        if num_patterns is not None:
+            key_patterns = key_patterns[:num_patterns]
+            value_patterns = value_patterns[:num_patterns]
+
+    encoded = (key_patterns, value_patterns) + \
+        tuple(encode_experiment_patterns(config, key_patterns, value_patterns))
+    if encoding_cache is not None:
+        encoding_cache.put(cache_key, *encoded)
+    return encoded
 
+def run_experiment(config):
+    run_encoded_experiment(config, *load_encoded_patterns(config))
+
+def run_encoded_experiment(config, key_patterns, value_patterns,
+                           key_encoder, value_encoder, key_patterns_enc, value_patterns_enc):
+    """Runs the cmm on already encoded patterns and decodes its results, writing
+    the output files to the current directory"""
+    cmm_config = dict(config["cmm"])
+    in_memory = cmm_config.get("in_memory", False)
+    if in_memory:
+        # The intermediate files are only written when asked for
+        cmm_config.setdefault("save_results", False)
+        cmm_config.setdefault("save_stats", False)
+        cmm_config.setdefault("mem_format", "none")
+
+    if cmm_config.get("save_encoded_patterns", not in_memory):
+        utils.save_patterns_file(key_patterns_enc, value_patterns_enc, "encoded_patterns.json")
+    if not in_memory or cmm_config.get("save_input", False):
+        if cmm_config.get("input_format", "text") == "binary":
+            cmm_input_file = "cmm_input.bin"
+            utils.create_cmm_input_binary_file(key_patterns_enc, value_patterns_enc, cmm_input_file)
+        else:
+            cmm_input_file = "cmm_input.txt"
+            utils.create_cmm_input_file(key_patterns_enc, value_patterns_enc, cmm_input_file)
+
+    # (n, data_size) array of the recalled codes
+    bits_in_key = key_encoder.get_num_bits_in_encoding()
+    if in_memory:
+        recalled_patterns = cmm.run_experiment_arrays(key_patterns_enc, value_patterns_enc,
+                os.getcwd(), bits_in_key, cmm_config)
+    else:
+        recalled_patterns = cmm.run_experiment(cmm_input_file, os.getcwd(), bits_in_key, cmm_config)
+    decoded_recalled_patterns = value_encoder.decode_batch(recalled_patterns)
+
+    results = list(zip(key_patterns, value_patterns, decoded_recalled_patterns.tolist()))
     save_results_file("results.txt", results)
-    save_stats_file("stats.json", results)
+    save_stats_file("stats.json", np.asarray(value_patterns, dtype=np.float64), decoded_recalled_patterns)
 
     log.info("DONE")
 
@@ -74,6 +161,11 @@ def save_results_file(output_path, results):
     """
     with open(output_path, 'w') as f:
         for (i, (key_vec, data_vec, data_recalled)) in enumerate(results):
+            # Rows of a binary patterns file print the same as the JSON lists
+            if isinstance(key_vec, np.ndarray):
+                key_vec = key_vec.tolist()
+            if isinstance(data_vec, np.ndarray):
+                data_vec = data_vec.tolist()
             f.write("key {}".format(i).ljust(9))
             f.write(str(key_vec))
             f.write("\n")
@@ -84,33 +176,23 @@ def save_results_file(output_path, results):
             f.write(str(data_recalled))
             f.write("\n\n")
 
-def save_stats_file(output_path, results):
+def save_stats_file(output_path, value_patterns, decoded_patterns):
     """Saves statistics about the results to the given file
     Args:
         output_path (str): The path to the output file
-        results (tuple(list, list, list) of results
+        value_patterns (np.ndarray): (n, num_attrs) array of the original values
+        decoded_patterns (np.ndarray): (n, num_attrs) array of the decoded recalled values
     """
     stats = {}
-    distances = []
-    distance_pcts = []
-    exactly_right_count = 0
-
-    for (key_vec, data_vec, data_recalled) in results:
-        key_vec = np.array(key_vec)
-        data_vec = np.array(data_vec)
-        data_recalled = np.array(data_recalled)
-
-        dist = np.linalg.norm(data_vec - data_recalled)
-        distances.append(dist)
-        distance_pcts.append(dist / np.linalg.norm(data_vec))
-
-        if dist == 0:
-            exactly_right_count += 1
+    distances = np.linalg.norm(value_patterns - decoded_patterns, axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        distance_pcts = distances / np.linalg.norm(value_patterns, axis=1)
+    exactly_right_count = int(np.count_nonzero(distances == 0))
 
     stats["mean distance"] = np.mean(distances)
     stats["mean distance %"] = np.mean(distance_pcts)
     stats["exactly right"] = exactly_right_count
-    stats["not exactly right"] = len(results) - exactly_right_count
+    stats["not exactly right"] = len(value_patterns) - exactly_right_count
 
     with open(output_path, 'w') as f:
         f.write(json.dumps(stats, indent=4, sort_keys=True))
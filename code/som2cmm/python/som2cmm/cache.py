@@ -0,0 +1,156 @@
+"""An on-disk cache of encoded experiment patterns.
+
+Entries are keyed by a hash of the input patterns file, the settings which
+choose the patterns (num_patterns) and the [encoding] config, along with the
+hash of any SOM file that config uses. Each entry is a directory holding the
+encoded keys and values as .npy files, and a pickle of the parsed patterns and
+the fitted encoders. So a run that only changes the [cmm] config can go
+straight to the cmm.
+
+The cache is kept under a total size by evicting the least recently used
+entries. Using an entry updates its directory's mtime, which is what the
+eviction orders by.
+"""
+import hashlib
+import json
+import logging
+import numpy as np
+import os
+import os.path
+import pickle
+import shutil
+
+from . import som
+
+log = logging.getLogger("som2cmm")
+
+DEFAULT_MAX_SIZE_MB = 1024
+# Part of every cache key. Increase it whenever the encoder classes, or what
+# an entry holds, change, so that entries pickled by older code are not used.
+CACHE_FORMAT_VERSION = 2
+KEYS_FILE = "key_patterns_enc.npy"
+VALUES_FILE = "value_patterns_enc.npy"
+STATE_FILE = "state.pkl"
+
+def encoder_files(encoding_config):
+    """Returns the paths of the files the encoders given by the [encoding] config read"""
+    files = []
+    for part in ["keys", "values"]:
+        part_config = encoding_config.get(part, {})
+        if part_config.get("method", None) == "som":
+            files.append(part_config["som"]["som_file_path"])
+    return files
+
+def cache_key(config):
+    """Returns the key of the cache entry for an experiment config
+    Args:
+        config (dict): The experiment config
+    Returns:
+        str: hex digest that changes whenever the encoded patterns would
+    """
+    key = {
+        "version": CACHE_FORMAT_VERSION,
+        "input_patterns_file": som.file_sha1(config["input_patterns_file"]),
+        "num_patterns": config.get("num_patterns", None),
+        "encoding": config["encoding"],
+        "encoder_files": [som.file_sha1(path) for path in encoder_files(config["encoding"])],
+    }
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()
+
+class EncodingCache:
+    """A directory of cached encodings, holding at most max_size_mb of them"""
+
+    def __init__(self, directory, max_size_mb=DEFAULT_MAX_SIZE_MB):
+        self.directory = directory
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        os.makedirs(directory, exist_ok=True)
+
+    @classmethod
+    def from_config(cls, config):
+        """Returns the cache given by the experiment config's [cache] table, or
+        None if it doesn't have one"""
+        cache_config = config.get("cache", None)
+        if not cache_config or not cache_config.get("enabled", True):
+            return None
+        return cls(cache_config["directory"], cache_config.get("max_size_mb", DEFAULT_MAX_SIZE_MB))
+
+    def entry_path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        """Returns the cached encoding for the key, or None if there isn't one
+        Returns:
+            tuple: the key patterns, value patterns, key encoder, value encoder,
+                and the arrays of encoded keys and values
+        """
+        path = self.entry_path(key)
+        if not os.path.isdir(path):
+            return None
+        try:
+            with open(os.path.join(path, STATE_FILE), 'rb') as f:
+                state = pickle.load(f)
+            key_patterns_enc = np.load(os.path.join(path, KEYS_FILE))
+            value_patterns_enc = np.load(os.path.join(path, VALUES_FILE))
+        except (OSError, EOFError, ValueError, pickle.UnpicklingError,
+                AttributeError, ImportError, IndexError, KeyError, TypeError) as e:
+            # Also what unpickling objects whose classes have since changed raises
+            log.warning("Ignoring unreadable cache entry %s: %s", path, e)
+            return None
+
+        os.utime(path)
+        return (state["key_patterns"], state["value_patterns"],
+                state["key_encoder"], state["value_encoder"],
+                key_patterns_enc, value_patterns_enc)
+
+    def put(self, key, key_patterns, value_patterns, key_encoder, value_encoder,
+            key_patterns_enc, value_patterns_enc):
+        """Stores an encoding and then evicts entries until the cache fits"""
+        path = self.entry_path(key)
+        # Written under a temporary name and then moved into place, so that
+        # other processes never see a partial entry
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        try:
+            os.makedirs(tmp_path, exist_ok=True)
+            np.save(os.path.join(tmp_path, KEYS_FILE), key_patterns_enc)
+            np.save(os.path.join(tmp_path, VALUES_FILE), value_patterns_enc)
+            state = {
+                "key_patterns": key_patterns,
+                "value_patterns": value_patterns,
+                "key_encoder": key_encoder,
+                "value_encoder": value_encoder,
+            }
+            with open(os.path.join(tmp_path, STATE_FILE), 'wb') as f:
+                pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            log.warning("Couldn't cache the encoding at %s: %s", path, e)
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            return
+        self.evict(keep=key)
+
+    def entries(self):
+        """Returns the (last used time, size in bytes, key) of each entry"""
+        entries = []
+        for name in os.listdir(self.directory):
+            path = self.entry_path(name)
+            if name.endswith(".tmp") or not os.path.isdir(path):
+                continue
+            size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+            entries.append((os.path.getmtime(path), size, name))
+        return entries
+
+    def evict(self, keep=None):
+        """Removes the least recently used entries until the cache is no bigger
+        than max_size. The entry `keep` is never removed."""
+        entries = sorted(self.entries())
+        total = sum(size for (_, size, _) in entries)
+        for (_, size, name) in entries:
+            if total <= self.max_size:
+                break
+            if name == keep:
+                continue
+            log.info("Evicting cached encoding %s", name)
+            shutil.rmtree(self.entry_path(name), ignore_errors=True)
+            total -= size
@@ -1,16 +1,22 @@
 import argparse
+import itertools
 import json
 import logging
 import numpy as np
 import os
 import os.path
 import sys
-import re
 
+from . import storage
+from . import threshold
 from . import utils
 
 log = logging.getLogger("som2cmm")
 
+# Binary memory files start with this, see utils.write_binary_file. The header
+# is followed by the packed matrix and then the packed recorded items.
+MEM_FILE_MAGIC = b"SOM2CMM1"
+
 def create_matrix(rows, cols):
     return np.zeros(shape=(rows, cols))
 
@@ -50,13 +56,25 @@ def argmin(func, xs):
 def vector_distance(v1, v2):
     return np.linalg.norm(np.subtract(v1, v2))
 
+def keys_to_indices(keys):
+    """Converts binary keys which all have the same number of bits set into
+    the indices of those bits.
+    Args:
+        keys (np.ndarray): (n, key_size) array holding a key vector per row
+    Returns:
+        np.ndarray: (n, bits_in_key) array of the set bit indices of each key
+    """
+    rows, cols = np.nonzero(keys)
+    return cols.reshape(keys.shape[0], -1)
+
 def str2bool(v):
     return v.lower() in ("yes", "true", "t", "1")
 
 class CMM:
     """Represents a correlation matrix memory."""
 
-    def __init__(self, key_size, data_size, bits_in_key, threshold_func, record_data_items=True):
+    def __init__(self, key_size, data_size, bits_in_key, threshold_func, record_data_items=True,
+                 storage_kind="dense", data_segment_sizes=None):
         """Note that the matrix is shaped with `data_size` rows and `key_size` cols
         e.g.
               k k k k 
@@ -69,18 +87,27 @@ class CMM:
             record_data_items (bool):
                 If true, every input data vector will be kept so that when recalling
                 we can match to the closest input data vector.
+            storage_kind (str):
+                How the matrix is stored. "dense" keeps a float64 per cell,
+                "packed" packs each row into bits which uses 64x less memory.
+            data_segment_sizes (list(int)):
+                Segment sizes of the data vectors, used by the "lwtaN" threshold.
         """
-        self._mat = create_matrix(data_size, key_size)
-        # This saves having to allocate a new matrix on every insert
-        self._work_mat = create_matrix(data_size, key_size)
+        self._mem = self._create_storage(storage_kind, data_size, key_size)
+        self.storage_kind = storage_kind
         self.bits_in_key = bits_in_key
         self.threshold_func = threshold_func
+        self.data_segment_sizes = data_segment_sizes
+        self._threshold = threshold.create_threshold(threshold_func, bits_in_key, data_segment_sizes)
         self.should_record_data_items = record_data_items
-        self.recorded_data_items = []
+        self.recorded_data_items = storage.RecordedItems(data_size)
 
     def __str__(self):
         return self.print_mem()
 
+    def _create_storage(self, storage_kind, rows, cols):
+        return storage.create_storage(storage_kind, rows, cols)
+
     def key_size(self):
         return self.num_cols()
 
@@ -88,17 +115,71 @@ class CMM:
         return self.num_rows()
 
     def num_rows(self):
-        return self._mat.shape[0]
+        return self._mem.shape[0]
 
     def num_cols(self):
-        return self._mat.shape[1]
+        return self._mem.shape[1]
 
     def serialize_mem(self):
-        return binary_mat_to_str(self._mat)
+        return binary_mat_to_str(self._mem.to_dense())
 
     def print_mem(self):
         print(self.serialize_mem())
 
+    def save(self, file_path):
+        """Saves the memory to a compact binary file which `CMM.load` can map
+        straight back into memory.
+        Args:
+            file_path (str): path to the file to write
+        """
+        bits = self._mem.to_packed()
+        items = self.recorded_data_items.packed()
+        header = {
+            "key_size": self.key_size(),
+            "data_size": self.data_size(),
+            "bits_in_key": self.bits_in_key,
+            "threshold_func": self.threshold_func,
+            "data_segment_sizes": self.data_segment_sizes,
+            "record_data_items": self.should_record_data_items,
+            "recorded_data_items": len(self.recorded_data_items),
+        }
+        utils.write_binary_file(file_path, MEM_FILE_MAGIC, header, [bits, items])
+
+    @classmethod
+    def load(cls, file_path, mmap_mode="r", storage_kind="packed"):
+        """Loads a memory saved by `CMM.save`.
+        Args:
+            file_path (str): path to the file
+            mmap_mode (str): passed to np.memmap. "r" recalls straight from the
+                page cache, "c" also allows inserts without touching the file.
+                None reads the whole file into memory instead.
+            storage_kind (str): "packed" uses the file's bits as they are,
+                "dense" unpacks them into a float64 matrix
+        Returns:
+            CMM: the loaded memory
+        """
+        header, data_offset = utils.read_binary_file_header(file_path, MEM_FILE_MAGIC)
+
+        key_size = header["key_size"]
+        data_size = header["data_size"]
+        key_words = (key_size + 7) // 8
+        data_words = (data_size + 7) // 8
+        num_items = header["recorded_data_items"]
+
+        contents = utils.map_binary_file(file_path, data_offset,
+                                         data_size * key_words + num_items * data_words, mmap_mode)
+        bits = contents[:data_size * key_words].reshape(data_size, key_words)
+        items = contents[data_size * key_words:].reshape(num_items, data_words)
+
+        # Created empty, then given the loaded storage
+        result = cls(0, 0, header["bits_in_key"], header["threshold_func"],
+                     record_data_items=header["record_data_items"],
+                     storage_kind=storage_kind,
+                     data_segment_sizes=header["data_segment_sizes"])
+        result._mem = storage.STORAGE_BACKENDS[storage_kind].from_packed(bits, key_size)
+        result.recorded_data_items = storage.RecordedItems.from_packed(items, data_size)
+        return result
+
     def insert(self, key_vec, data_vec):
         """Insert a new item into the memory.
         Args:
@@ -114,14 +195,76 @@ class CMM:
 
         assert(np.count_nonzero(key_vec) == self.bits_in_key)
 
-        # Temporary matrix will be added to the main matrix
-        self._work_mat.fill(0)
-        np.dot(data_vec, np.transpose(key_vec), out=self._work_mat)
-        self._mat += self._work_mat
-        set_gt1_to_1(self._mat)
+        self._mem.insert(key_vec, data_vec)
+
+        if self.should_record_data_items:
+            self.recorded_data_items.add(data_vec)
+
+    def insert_many(self, keys, data):
+        """Insert many items into the memory at once. Equivalent to calling
+        `insert` for each pair but builds the memory in one pass.
+        Args:
+            keys (np.ndarray): (n, key_size) array holding a key vector per row
+            data (np.ndarray): (n, data_size) array holding a data vector per row
+        """
+        assert(keys.ndim == 2 and data.ndim == 2)
+        assert(keys.shape[0] == data.shape[0])
+        assert(keys.shape[1] == self.num_cols())
+        assert(data.shape[1] == self.num_rows())
+
+        assert((np.count_nonzero(keys, axis=1) == self.bits_in_key).all())
+
+        self._mem.insert_many(keys, data)
+
+        if self.should_record_data_items:
+            self.recorded_data_items.add_many(data)
+
+    def insert_indices(self, key_indices, data_vec):
+        """Insert a new item into the memory, where the key is given as the
+        indices of its set bits rather than as a vector.
+        Args:
+            key_indices (np.ndarray): the indices of the set bits in the key
+            data_vec (np.ndarray): the data vector
+        """
+        key_indices = np.asarray(key_indices, dtype=np.intp)
+
+        assert(data_vec.shape[0] == self.num_rows())
+        assert(data_vec.shape[1] == 1)
+
+        assert(len(np.unique(key_indices)) == self.bits_in_key)
+        assert(0 <= key_indices.min() and key_indices.max() < self.num_cols())
+
+        self._mem.insert_indices(key_indices, data_vec)
 
         if self.should_record_data_items:
-            self.recorded_data_items.append(data_vec)
+            self.recorded_data_items.add(data_vec)
+
+    def recall_indices(self, key_indices, smart=False):
+        """Recalls an item using a key given as the indices of its set bits.
+        Only the key's columns of the memory are read.
+        Args:
+            key_indices (np.ndarray): the indices of the set bits in the key
+        Returns:
+            np.ndarray: the recalled (data_size, 1) vector
+        """
+        key_indices = np.asarray(key_indices, dtype=np.intp).reshape(1, -1)
+        return self.recall_indices_batch(key_indices, smart=smart).T
+
+    def recall_indices_batch(self, key_indices, smart=False):
+        """Recalls many items at once using keys given as set bit indices.
+        See `keys_to_indices`.
+        Args:
+            key_indices (np.ndarray): (n, bits_in_key) set bit indices per key
+            smart (bool): match each result to the closest recorded data item
+        Returns:
+            np.ndarray: (n, data_size) array holding a recalled vector per row
+        """
+        key_indices = np.asarray(key_indices, dtype=np.intp)
+        assert(key_indices.ndim == 2)
+        results = self.threshold_batch(self._mem.sums_indices(key_indices))
+        if smart:
+            results = self.closest_recorded_items(results)
+        return results
 
     def recall_basic(self, key_vec):
         """Recalls an item from the memory.
@@ -130,31 +273,39 @@ class CMM:
         Returns:
             np.ndarray: the recalled data vector
         """
-        output_vec = create_vector(self.data_size())
-        output_vec.fill(0)
-        np.dot(self._mat, key_vec, out=output_vec)
+        output_vec = self._mem.sums(key_vec)
         return self.threshold(output_vec)
 
-    def threshold(self, vec):
-        if re.match("lmax\d", self.threshold_func):
-            L = int(re.match("lmax(\d)", self.threshold_func).group(1))
-
-            indices_w_values = []
-            for (i, row) in enumerate(vec):
-                indices_w_values.append((i, row[0]))
+    def recall_batch(self, keys, smart=False):
+        """Recalls many items from the memory at once.
+        Args:
+            keys (np.ndarray): (n, key_size) array holding a key vector per row
+            smart (bool): match each result to the closest recorded data item
+        Returns:
+            np.ndarray: (n, data_size) array holding a recalled vector per row
+        """
+        assert(keys.ndim == 2 and keys.shape[1] == self.num_cols())
+        results = self.threshold_batch(self._mem.sums_batch(keys))
+        if smart:
+            results = self.closest_recorded_items(results)
+        return results
 
-            # Sort by value
-            indices_w_values.sort(key=lambda x: -x[1])
-            top = indices_w_values[:L]
+    def threshold(self, vec):
+        """Thresholds a single (data_size, 1) output vector"""
+        return self.threshold_batch(vec.T).T
 
-            new_vec = create_vector(len(vec))
-            for (i, _) in top:
-                new_vec[i][0] = 1
+    def threshold_batch(self, sums):
+        """Thresholds a (n, data_size) array holding an output vector per row"""
+        return self._threshold(sums)
 
-            return new_vec
-        else:
-            raise Exception("Unknown thresholding function", self.threshold_func)
+    def closest_recorded_item(self, vec):
+        """Finds the recorded data item closest to the given (data_size, 1) vector"""
+        return self.closest_recorded_items(vec.T).T
 
+    def closest_recorded_items(self, results):
+        """Finds the recorded data item closest to each row of `results`"""
+        assert(self.should_record_data_items and len(self.recorded_data_items) > 0)
+        return self.recorded_data_items.nearest(results)
 
     def recall_smart(self, key_vec):
         """Peforms a basic recall and then attempts to match the result against
@@ -162,9 +313,7 @@ class CMM:
         """
         assert(self.should_record_data_items and len(self.recorded_data_items) > 0)
         basic_result = self.recall_basic(key_vec)
-        closest_match = argmin(lambda v: vector_distance(v, basic_result),
-                               self.recorded_data_items)
-        return closest_match
+        return self.closest_recorded_item(basic_result)
 
     def recall(self, key_vec, smart=True):
         if smart:
@@ -172,35 +321,125 @@ class CMM:
         else:
             return self.recall_basic(key_vec)
 
-def parse_input_file(filename):
-    log.debug("Parsing input file: " + filename)
-    key_size = 0
-    data_size = 0
-    pairs = []
+def parse_input_block(lines, key_size, data_size):
+    """Parses "k,k,k:d,d" lines into arrays, converting the whole block at once
+    Args:
+        lines (list(str)): the lines of the block
+        key_size (int): the size of the key vectors
+        data_size (int): the size of the data vectors
+    Returns:
+        tuple(np.ndarray, np.ndarray): (n, key_size) keys and (n, data_size) data
+    """
+    lines = [line.strip() for line in lines if not line.isspace() and len(line) > 0]
+    width = key_size + data_size
+
+    # Fast path for lines holding only single digits, as written for binary
+    # patterns, where every other character is a value
+    if len(lines) > 0 and all(len(line) == 2 * width - 1 for line in lines):
+        chars = np.frombuffer(",".join(lines).encode("ascii"), dtype=np.uint8)
+        chars = np.append(chars, np.uint8(ord(","))).reshape(len(lines), 2 * width)
+        digits = chars[:, 0::2] - np.uint8(ord("0"))
+        separators = chars[:, 1::2]
+        if (digits <= 9).all() and ((separators == ord(",")) | (separators == ord(":"))).all():
+            values = digits.astype(np.float64)
+            return values[:, :key_size], values[:, key_size:]
+
+    text = ",".join(lines).replace(":", ",")
+    if len(text) == 0:
+        values = np.zeros(shape=(0, key_size + data_size))
+    else:
+        values = np.fromstring(text, dtype=np.float64, sep=",")
+        assert(values.size == len(lines) * (key_size + data_size))
+        values = values.reshape(len(lines), key_size + data_size)
+    return values[:, :key_size], values[:, key_size:]
+
+def load_input_file(filename):
+    """Loads a whole cmm input file, in either the text or binary format
+    Returns:
+        tuple(int, int, np.ndarray, np.ndarray): the key size, the data size,
+            the (n, key_size) keys and the (n, data_size) data
+    """
+    log.debug("Loading input file: " + filename)
+    if utils.is_binary_file(filename, utils.CMM_INPUT_MAGIC):
+        key_size, data_size, keys, data = utils.load_cmm_input_binary_file(filename)
+        keys = np.unpackbits(keys, axis=1, count=key_size).astype(np.float64)
+        data = np.unpackbits(data, axis=1, count=data_size).astype(np.float64)
+        return key_size, data_size, keys, data
+
     with open(filename, 'r') as f:
-        for (n, line) in enumerate(f):
-            if n == 0:
-                # First line is key vector size
-                key_size = int(line.strip())
-            elif n == 1:
-                # Second line is data vector size
-                data_size = int(line.strip())
-
-            # Other lines hold key and data vector pairs
-            else:
-                key_vec = create_vector(key_size)
-                data_vec = create_vector(data_size)
-
-                key_vec_str, data_vec_str = line.strip().split(":")
-                for (i, x) in enumerate(key_vec_str.split(",")):
-                    key_vec[i, 0] = float(x)
-
-                for (i, x) in enumerate(data_vec_str.split(",")):
-                    data_vec[i, 0] = float(x)
-
-                pairs.append((key_vec, data_vec))
+        key_size, data_size = read_input_header(f)
+        keys, data = parse_input_block(f.readlines(), key_size, data_size)
+    return key_size, data_size, keys, data
+
+def parse_input_file(filename):
+    """Loads a cmm input file as a list of ((key_size, 1), (data_size, 1)) vector pairs"""
+    key_size, data_size, keys, data = load_input_file(filename)
+    pairs = [(key_vec.reshape(-1, 1), data_vec.reshape(-1, 1))
+             for (key_vec, data_vec) in zip(keys, data)]
     return key_size, data_size, pairs
 
+def read_input_header(f):
+    """Reads the key and data vector sizes from the first two lines of an open
+    text cmm input file, leaving the file positioned at the first pair.
+    """
+    key_size = int(f.readline().strip())
+    data_size = int(f.readline().strip())
+    return key_size, data_size
+
+def read_input_sizes(filename):
+    """Returns the key and data vector sizes of a text or binary cmm input file"""
+    if utils.is_binary_file(filename, utils.CMM_INPUT_MAGIC):
+        header, _ = utils.read_binary_file_header(filename, utils.CMM_INPUT_MAGIC)
+        return header["key_size"], header["data_size"]
+    with open(filename, 'r') as f:
+        return read_input_header(f)
+
+def iter_input_chunks(filename, chunk_size):
+    """Reads a cmm input file a chunk at a time, so that memory use is bounded
+    by the chunk size rather than by the size of the file.
+    Args:
+        filename (str): path to the text or binary cmm input file
+        chunk_size (int): the maximum number of pairs in each chunk
+    Yields:
+        tuple(np.ndarray, np.ndarray): (n, key_size) keys and (n, data_size) data
+    """
+    log.debug("Streaming input file: {} (chunk size {})".format(filename, chunk_size))
+    if utils.is_binary_file(filename, utils.CMM_INPUT_MAGIC):
+        key_size, data_size, keys, data = utils.load_cmm_input_binary_file(filename)
+        for start in range(0, keys.shape[0], chunk_size):
+            end = start + chunk_size
+            yield (np.unpackbits(keys[start:end], axis=1, count=key_size).astype(np.float64),
+                   np.unpackbits(data[start:end], axis=1, count=data_size).astype(np.float64))
+        return
+
+    with open(filename, 'r') as f:
+        key_size, data_size = read_input_header(f)
+        while True:
+            lines = list(itertools.islice(f, chunk_size))
+            if len(lines) == 0:
+                break
+            keys, data = parse_input_block(lines, key_size, data_size)
+            if keys.shape[0] > 0:
+                yield (keys, data)
+
+def write_results(f, results, start_index=0):
+    """Writes results to an open file in the format used by `save_output_file`
+    Args:
+        f (file): the file to write to
+        results (tuple(np.ndarray, np.ndarray, np.ndarray)): The list of results
+        start_index (int): the number of the first result
+    """
+    for (i, (key_vec, data_vec, data_recalled)) in enumerate(results, start_index):
+        f.write("key {}".format(i).ljust(9))
+        f.write(binary_vec_to_str(key_vec))
+        f.write("\n")
+        f.write("original ")
+        f.write(binary_vec_to_str(data_vec))
+        f.write("\n")
+        f.write("recalled ")
+        f.write(binary_vec_to_str(data_recalled))
+        f.write("\n\n")
+
 def save_output_file(output_path, results):
     """Saves the results to the given file.
     Args:
@@ -208,16 +447,7 @@ def save_output_file(output_path, results):
         results (tuple(np.ndarray, np.ndarray, np.ndarray)): The list of results
     """
     with open(output_path, 'w') as f:
-        for (i, (key_vec, data_vec, data_recalled)) in enumerate(results):
-            f.write("key {}".format(i).ljust(9))
-            f.write(binary_vec_to_str(key_vec))
-            f.write("\n")
-            f.write("original ")
-            f.write(binary_vec_to_str(data_vec))
-            f.write("\n")
-            f.write("recalled ")
-            f.write(binary_vec_to_str(data_recalled))
-            f.write("\n\n")
+        write_results(f, results)
 
 def save_stats_file(output_path, results):
     """Saves statistics about the results to the given file
@@ -236,8 +466,18 @@ def save_stats_file(output_path, results):
         else:
             stats["wrong"] += 1
         bits_wrong.append(vector_distance(data_vec, data_recalled))
-    stats["mean bits wrong"] = np.mean(bits_wrong)
-    stats["stdev bits wrong"] = np.std(bits_wrong)
+    write_stats_file(output_path, stats["correct"], stats["wrong"],
+                     np.mean(bits_wrong), np.std(bits_wrong))
+
+def write_stats_file(output_path, correct, wrong, mean_bits_wrong, stdev_bits_wrong):
+    """Writes the stats file given the counts of correct and wrong recalls and
+    the mean and standard deviation of the recalled vectors' distances from
+    the originals"""
+    stats = {}
+    stats["correct"] = correct
+    stats["wrong"] = wrong
+    stats["mean bits wrong"] = mean_bits_wrong
+    stats["stdev bits wrong"] = stdev_bits_wrong
 
     with open(output_path, 'w') as f:
         f.write(json.dumps(stats, indent=4, sort_keys=True))
@@ -248,48 +488,170 @@ def debug_result(result):
     log.debug("data:     {}".format(binary_vec_to_str(data_vec)))
     log.debug("recalled: {}".format(binary_vec_to_str(data_recalled)))
 
-def run_experiment(input_path, out_dir_path, bits_in_key, config):
-    key_size, data_size, pairs = parse_input_file(input_path)
-    use_smart_recall = config.get("smart_recall", False)
+def create_cmm_from_config(key_size, data_size, bits_in_key, config):
+    """Creates the CMM described by the [cmm] section of an experiment config"""
     threshold_func = config.get("threshold_func", "unknown")
+    storage_kind = config.get("storage", "dense")
+    data_segment_sizes = config.get("threshold_segment_sizes", None)
+    num_shards = config.get("shards", None)
+    log.debug("Storage: {}".format(storage_kind))
+    log.debug("Threshold function: {}".format(threshold_func))
+
+    if num_shards:
+        # Imported here as sharded imports this module
+        from .sharded import ShardedCMM
+        log.debug("Shards: {}".format(num_shards))
+        return ShardedCMM(key_size, data_size, bits_in_key, threshold_func, storage_kind=storage_kind,
+                          data_segment_sizes=data_segment_sizes, num_shards=num_shards)
+    else:
+        return CMM(key_size, data_size, bits_in_key, threshold_func, storage_kind=storage_kind,
+                   data_segment_sizes=data_segment_sizes)
+
+def save_mem(cmm, out_dir_path, config):
+    """Saves the trained memory in the format(s) chosen by the config's mem_format"""
+    mem_format = config.get("mem_format", "text")
+    mem_file = os.path.join(out_dir_path, "cmm.txt")
+    mem_bin_file = os.path.join(out_dir_path, "cmm.bin")
+    log.debug("Memory format: {}".format(mem_format))
+
+    if mem_format in ("text", "both"):
+        log.debug("Memory file:  {}".format(mem_file))
+        with open(mem_file, 'w') as f:
+            f.write(cmm.serialize_mem())
+    if mem_format in ("binary", "both"):
+        log.debug("Memory file:  {}".format(mem_bin_file))
+        cmm.save(mem_bin_file)
+
+def run_experiment(input_path, out_dir_path, bits_in_key, config):
+    """Trains a CMM on the pairs in the input file and recalls every key
+    Returns:
+        np.ndarray: (n, data_size) array of the recalled data vectors
+    """
+    if config.get("chunk_size", None):
+        return run_experiment_chunked(input_path, out_dir_path, bits_in_key, config)
+
+    key_size, data_size, keys, data = load_input_file(input_path)
     log.info("*** Running cmm: {}".format(input_path))
+    return run_experiment_arrays(keys, data, out_dir_path, bits_in_key, config)
+
+def run_experiment_arrays(keys, data, out_dir_path, bits_in_key, config):
+    """Trains a CMM on pairs already in memory and recalls every key. The
+    results and stats files are written unless the config's save_results or
+    save_stats are false, and the memory as chosen by its mem_format.
+    Args:
+        keys (np.ndarray): (n, key_size) binary array of the keys
+        data (np.ndarray): (n, data_size) binary array of the data
+    Returns:
+        np.ndarray: (n, data_size) array of the recalled data vectors
+    """
+    keys = np.asarray(keys, dtype=np.float64)
+    data = np.asarray(data, dtype=np.float64)
+    key_size = keys.shape[1]
+    data_size = data.shape[1]
+    use_smart_recall = config.get("smart_recall", False)
     log.debug("Output directory: {}".format(out_dir_path))
     log.debug("Key size: {}".format(key_size))
     log.debug("Data size: {}".format(data_size))
     log.debug("Using smart recall: {}".format(use_smart_recall))
 
-    cmm = CMM(key_size, data_size, bits_in_key, threshold_func)
+    cmm = create_cmm_from_config(key_size, data_size, bits_in_key, config)
 
     log.info("* Training...")
-    for key_vec, data_vec in pairs:
-        cmm.insert(key_vec, data_vec)
+    cmm.insert_many(keys, data)
     log.info("Training complete.")
 
     log.info("* Recalling...")
-    results = []
-    for key_vec, data_vec in pairs:
-        data_recalled = cmm.recall(key_vec, smart=use_smart_recall)
-        result = (key_vec, data_vec, data_recalled)
-        results.append(result)
-
+    # Every key has exactly bits_in_key bits set so recall can read just those columns
+    recalled_all = cmm.recall_indices_batch(keys_to_indices(keys), smart=use_smart_recall)
     log.info("Recall complete.")
 
-    mem_file = os.path.join(out_dir_path, "cmm.txt")
+    save_mem(cmm, out_dir_path, config)
+    if config.get("shards", None):
+        cmm.close()
+
+    save_results = config.get("save_results", True)
+    save_stats = config.get("save_stats", True)
+    if save_results or save_stats:
+        results = [(key_vec.reshape(-1, 1), data_vec.reshape(-1, 1), data_recalled.reshape(-1, 1))
+                   for (key_vec, data_vec, data_recalled) in zip(keys, data, recalled_all)]
+    if save_results:
+        results_file = os.path.join(out_dir_path, "cmm_results.txt")
+        log.debug("Results file: {}".format(results_file))
+        save_output_file(results_file, results)
+    if save_stats:
+        stats_file = os.path.join(out_dir_path, "cmm_stats.json")
+        log.debug("Stats file:   {}".format(stats_file))
+        save_stats_file(stats_file, results)
+
+    return recalled_all
+
+def run_experiment_chunked(input_path, out_dir_path, bits_in_key, config):
+    """Runs the experiment reading the input file `chunk_size` pairs at a time,
+    first to train and then again to recall, so that memory use is bounded by
+    the chunk size rather than the size of the input. The results and stats
+    are written as each chunk is recalled, and the recalled vectors go to
+    cmm_recalled.npy.
+    Returns:
+        np.ndarray: (n, data_size) uint8 array of the recalled data vectors,
+            memory mapped from cmm_recalled.npy
+    """
+    chunk_size = config["chunk_size"]
+    use_smart_recall = config.get("smart_recall", False)
+    key_size, data_size = read_input_sizes(input_path)
+    log.info("*** Running cmm: {} (chunks of {})".format(input_path, chunk_size))
+    log.debug("Output directory: {}".format(out_dir_path))
+    log.debug("Key size: {}".format(key_size))
+    log.debug("Data size: {}".format(data_size))
+    log.debug("Using smart recall: {}".format(use_smart_recall))
+
+    cmm = create_cmm_from_config(key_size, data_size, bits_in_key, config)
+
+    log.info("* Training...")
+    num_pairs = 0
+    for (keys, data) in iter_input_chunks(input_path, chunk_size):
+        cmm.insert_many(keys, data)
+        num_pairs += len(keys)
+    log.info("Training complete.")
+
     results_file = os.path.join(out_dir_path, "cmm_results.txt")
     stats_file = os.path.join(out_dir_path, "cmm_stats.json")
-
-    log.debug("Memory file:  {}".format(mem_file))
+    recalled_file = os.path.join(out_dir_path, "cmm_recalled.npy")
     log.debug("Results file: {}".format(results_file))
     log.debug("Stats file:   {}".format(stats_file))
+    log.debug("Recalled file: {}".format(recalled_file))
 
-    with open(mem_file, 'w') as f:
-        f.write(cmm.serialize_mem())
+    log.info("* Recalling...")
+    recalled = np.lib.format.open_memmap(recalled_file, mode="w+", dtype=np.uint8,
+                                         shape=(num_pairs, data_size))
+    num_recalled = 0
+    correct = 0
+    # Running stats of the distance of each recalled vector from the original
+    bits_wrong = utils.AttributeStats()
+    with open(results_file, 'w') as f:
+        for (keys, data) in iter_input_chunks(input_path, chunk_size):
+            recalled_chunk = cmm.recall_indices_batch(keys_to_indices(keys), smart=use_smart_recall)
+            results = [(key_vec.reshape(-1, 1), data_vec.reshape(-1, 1), rec.reshape(-1, 1))
+                       for (key_vec, data_vec, rec) in zip(keys, data, recalled_chunk)]
+            write_results(f, results, start_index=num_recalled)
+
+            correct += int(np.count_nonzero((data == recalled_chunk).all(axis=1)))
+            bits_wrong.update(np.linalg.norm(data - recalled_chunk, axis=1)[:, np.newaxis])
+            recalled[num_recalled:num_recalled + len(recalled_chunk)] = recalled_chunk
+            num_recalled += len(recalled_chunk)
+    recalled.flush()
+    del recalled
+    log.info("Recall complete.")
 
-    save_output_file(results_file, results)
-    save_stats_file(stats_file, results)
+    save_mem(cmm, out_dir_path, config)
+    if config.get("shards", None):
+        cmm.close()
 
-    recalled = [rec for (key, dat, rec) in results]
-    return recalled
+    if num_recalled > 0:
+        write_stats_file(stats_file, correct, num_recalled - correct,
+                         float(bits_wrong.mean[0]), float(bits_wrong.std[0]))
+    else:
+        write_stats_file(stats_file, 0, 0, np.nan, np.nan)
+    return np.load(recalled_file, mmap_mode="r")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -298,6 +660,14 @@ if __name__ == "__main__":
     parser.add_argument("--bits-in-key", required=True, type=int, help="How many bits are set in the key patterns")
     parser.add_argument("--out-dir", required=True, help="Path to the output directory (will be created if it doesn't exist)")
     parser.add_argument("--smart-recall", type="bool", default=True, help="Use smart recall?")
+    parser.add_argument("--threshold-func", default="lmax1", help="Thresholding function e.g. lmax1, willshaw, lwta1")
+    parser.add_argument("--threshold-segment-sizes", type=int, nargs='+', help="Data vector segment sizes for lwtaN thresholding")
+    parser.add_argument("--mem-format", default="text", choices=["text", "binary", "both", "none"],
+                        help="How to save the trained memory (cmm.txt and/or cmm.bin)")
+    parser.add_argument("--chunk-size", type=int, default=0, help="Stream the input file in chunks of this many pairs")
+    parser.add_argument("--shards", type=int, default=0, help="Split the memory's rows across this many worker processes")
+    parser.add_argument("--storage", default="dense", choices=sorted(storage.STORAGE_BACKENDS),
+                        help="How the CMM's matrix is stored in memory")
     args = parser.parse_args()
 
     assert(os.path.isfile(args.input))
@@ -305,5 +675,13 @@ if __name__ == "__main__":
         log.debug("Creating directory: " + args.out_dir)
         os.mkdir(args.out_dir)
 
-    config = {"smart_recall": args.smart_recall}
+    config = {
+        "smart_recall": args.smart_recall,
+        "storage": args.storage,
+        "shards": args.shards,
+        "chunk_size": args.chunk_size,
+        "mem_format": args.mem_format,
+        "threshold_func": args.threshold_func,
+        "threshold_segment_sizes": args.threshold_segment_sizes,
+    }
     run_experiment(args.input, args.out_dir, args.bits_in_key, config)
@@ -8,13 +8,12 @@ from . import utils
 def get_scheme(patterns, config):
     """Returns the encoding scheme specified by the given config object
     Args:
-        patterns (list(list)): List of input patterns
+        patterns (list(list) or np.ndarray): The input patterns
         config (dict): The config object
     """
-    assert(type(patterns) == list and len(patterns) > 0)
+    assert(len(patterns) > 0)
     assert(type(config) == dict)
 
-    min_max_values = utils.get_min_max_values(patterns)
     pattern_dims = len(patterns[0])
 
     scheme = None
@@ -25,13 +24,21 @@ def get_scheme(patterns, config):
         bits_set_per_attr = config["quantize"]["bits_set_per_attr"]
         assert(type(bits_per_attr) == list and len(bits_per_attr) == pattern_dims)
         assert(type(bits_set_per_attr) == list and len(bits_set_per_attr) == pattern_dims)
-        scheme = schemes.QuantizationEncoder(min_max_values, bits_per_attr, bits_set_per_attr)
+        stats = utils.AttributeStats.from_patterns(patterns)
+        scheme = schemes.QuantizationEncoder.from_stats(stats, bits_per_attr, bits_set_per_attr)
     elif method == "donothing":
         bits_set = config["donothing"]["bits_set"]
         scheme = schemes.DoNothingEncoder(bits_set)
     elif method == "som":
         som_path = config["som"]["som_file_path"]
-        scheme = schemes.SOMEncoder(som_path)
+        use_cache = config["som"].get("cache", True)
+        bmu_search = {key: config["som"][key]
+                      for key in ["coarse_factor", "coarse_candidates"]
+                      if key in config["som"]}
+        bmu_search["method"] = config["som"].get("bmu_search", "exact")
+        report_bmu_search = config["som"].get("report_bmu_search", False)
+        scheme = schemes.SOMEncoder(som_path, use_cache=use_cache, bmu_search=bmu_search,
+                                    report_bmu_search=report_bmu_search)
     elif method == "baum":
         segment_sizes = config["baum"]["segment_sizes"]
         scheme = schemes.BaumEncoder(segment_sizes)
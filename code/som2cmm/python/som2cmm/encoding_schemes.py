@@ -1,11 +1,14 @@
 from abc import ABC, abstractmethod
 import math
 import numpy as np
-import copy
+import itertools
+import logging
 
 from . import som
 from . import utils
 
+log = logging.getLogger("som2cmm")
+
 class EncodingScheme(ABC):
     """An abstract base class for encoders"""
 
@@ -19,8 +22,18 @@ class EncodingScheme(ABC):
         """
         pass
 
+    def encode_batch(self, patterns):
+        """Encode a batch of patterns. Schemes override this with a vectorized
+        version where they can.
+        Args:
+            patterns (np.ndarray): (n, num_attrs) float array, one pattern per row
+        Returns:
+            np.ndarray: (n, code_size) uint8 array, one code per row
+        """
+        return np.array([self.encode(pat) for pat in np.asarray(patterns).tolist()], dtype=np.uint8)
+
     def encodeAll(self, patterns):
-        return [self.encode(pat) for pat in patterns]
+        return self.encode_batch(patterns)
 
     @abstractmethod
     def decode(self, vec):
@@ -32,8 +45,18 @@ class EncodingScheme(ABC):
         """
         pass
 
+    def decode_batch(self, codes):
+        """Decode a batch of binary vectors. Schemes override this with a
+        vectorized version where they can.
+        Args:
+            codes (np.ndarray): (n, code_size) binary array, one code per row
+        Returns:
+            np.ndarray: (n, num_attrs) float array, one pattern per row
+        """
+        return np.array([self.decode(code) for code in np.asarray(codes).tolist()], dtype=np.float64)
+
     def decodeAll(self, patterns):
-        return [self.decode(pat) for pat in patterns]
+        return self.decode_batch(patterns)
 
     @abstractmethod
     def get_num_bits_in_encoding(self):
@@ -54,9 +77,16 @@ class DoNothingEncoder(EncodingScheme):
     def encode(self, attrs):
         return attrs
 
+    def encode_batch(self, patterns):
+        """Returns the patterns unchanged, as an array of their own dtype"""
+        return np.array(patterns)
+
     def decode(self, vec):
         return vec
 
+    def decode_batch(self, codes):
+        return np.asarray(codes, dtype=np.float64)
+
 class QuantizationEncoder(EncodingScheme):
     """Encoder which performs quantization on each attribute"""
 
@@ -71,6 +101,11 @@ class QuantizationEncoder(EncodingScheme):
         self.bits_per_attr = bits_per_attr
         self.bits_set_per_attr = bits_set_per_attr
 
+    @classmethod
+    def from_stats(cls, stats, bits_per_attr, bits_set_per_attr):
+        """Creates the encoder from the utils.AttributeStats of the patterns"""
+        return cls(stats.min_max(), bits_per_attr, bits_set_per_attr)
+
     def get_num_bits_in_encoding(self):
         return sum(self.bits_set_per_attr)
 
@@ -101,6 +136,43 @@ class QuantizationEncoder(EncodingScheme):
 
         return code
 
+    def encode_batch(self, patterns):
+        """Encodes every pattern at once. The bins of all the patterns are found
+        together for each attribute and their codes gathered from a table of
+        every code for that attribute's (bits_used, bits_set).
+        Args:
+            patterns (list(list(float)) or np.ndarray): the patterns, one per row
+        Returns:
+            np.ndarray: (n, sum(bits_per_attr)) uint8 array of the codes
+        """
+        patterns = np.asarray(patterns, dtype=np.float64)
+        assert(patterns.ndim == 2 and patterns.shape[1] == len(self.bits_per_attr))
+
+        codes = np.zeros(shape=(patterns.shape[0], sum(self.bits_per_attr)), dtype=np.uint8)
+        ptr = 0
+        for (i, (bits_used, bits_set)) in enumerate(zip(self.bits_per_attr, self.bits_set_per_attr)):
+            (min_val, max_val) = self.attr_min_max[i]
+            attrs = patterns[:, i]
+            assert(np.all((min_val <= attrs) & (attrs <= max_val)))
+
+            table = quantize_code_table(bits_used, bits_set)
+            bins = self.get_bins_to_use(attrs, min_val, max_val, table.shape[0])
+            codes[:, ptr:ptr+bits_used] = table[bins]
+            ptr += bits_used
+
+        return codes
+
+    def get_bins_to_use(self, attrs, min_val, max_val, num_bins):
+        """Vectorized `get_bin_to_use` over an array of values of one attribute"""
+        bin_size = self.get_bin_size(min_val, max_val, num_bins)
+        if bin_size == 0:
+            # Every value is the same so it all goes in the first bin
+            return np.zeros(shape=attrs.shape, dtype=np.intp)
+        bins = np.floor((attrs - min_val) / bin_size).astype(np.intp)
+        # Deals with max value
+        bins[bins == num_bins] -= 1
+        return bins
+
     def encode_attr(self, attr, min_val, max_val, bits_used, bits_set):
         """Quantize by initially having all the bits on the left and then shifting
         the rightmost one which is not at the end already
@@ -126,28 +198,36 @@ class QuantizationEncoder(EncodingScheme):
         return encoding
 
     def decode(self, code):
-        try:
-            assert(len(code) == sum(self.bits_per_attr))
-        except Exception as e:
-            print(code, self.bits_per_attr)
-            raise e
+        return self.decode_batch([code])[0].tolist()
+
+    def decode_batch(self, codes):
+        """Decodes every code at once. Each attribute's chunk of the codes is
+        looked up in a table of the valid codes to find its bin. Chunks which
+        aren't valid codes, e.g. with the wrong number of bits set after a
+        noisy recall, are decoded as the closest valid code by Hamming
+        distance, taking the lowest bin where several are equally close.
+        Args:
+            codes (list(list) or np.ndarray): the binary codes, one per row
+        Returns:
+            np.ndarray: (n, num_attrs) float64 array of the decoded patterns
+        """
+        codes = np.asarray(codes)
+        assert(codes.ndim == 2 and codes.shape[1] == sum(self.bits_per_attr))
+        codes = (codes != 0).astype(np.uint8)
 
-        chunks = []
+        patterns = np.zeros(shape=(codes.shape[0], len(self.bits_per_attr)))
         ptr = 0
-
-        for chunk_size in self.bits_per_attr: 
-            chunks.append(code[ptr:ptr+chunk_size])
-            ptr = ptr+chunk_size
-
-        pattern = []
-        for (i, chunk) in enumerate(chunks):
+        for (i, (bits_used, bits_set)) in enumerate(zip(self.bits_per_attr, self.bits_set_per_attr)):
             (min_val, max_val) = self.attr_min_max[i]
-            bits_used = self.bits_per_attr[i]
-            bits_set = self.bits_set_per_attr[i]
-            decoded_attr = self.decode_attr(chunk, min_val, max_val, bits_used, bits_set)
-            pattern.append(decoded_attr)
+            chunk = codes[:, ptr:ptr+bits_used]
+            ptr += bits_used
 
-        return pattern
+            bins = quantize_code_ranks(chunk, bits_used, bits_set)
+            num_bins = self.get_num_bins(bits_used, bits_set)
+            bin_size = self.get_bin_size(min_val, max_val, num_bins)
+            patterns[:, i] = min_val + bin_size * bins
+
+        return patterns
 
     def decode_attr(self, code, min_val, max_val, bits_used, bits_set):
         bin_used = new_quantize_decode(bits_used, bits_set, code)
@@ -157,38 +237,112 @@ class QuantizationEncoder(EncodingScheme):
         return min_val + bin_size * bin_used
 
 class BaumEncoder(EncodingScheme):
+    """Gives the pattern with rank i the i-th Baum code, which has one bit set
+    in each segment. The positions of the bits count up as a mixed-radix
+    number, with the last segment as the lowest digit. Decoding a code finds
+    its rank and returns the pattern stored with that rank.
+
+    A code depends only on its rank, so encoding can be split across workers
+    by giving each its own `start` rank. The patterns are then stored for
+    decoding with `add_patterns`.
+    """
+
     def __init__(self, segment_sizes):
-        self.segment_sizes = segment_sizes
-        self.last_baum_code_bits = None
-        self.mappings = {}
+        self.segment_sizes = list(segment_sizes)
+        self.num_codes = int(np.prod(self.segment_sizes))
+        # One past the highest rank stored
+        self.num_patterns = 0
+        self._pattern_blocks = [] # (start rank, patterns) in the order added
+        self._patterns = None # the blocks assembled by rank, rebuilt lazily
+        self._known = None
 
     def get_num_bits_in_encoding(self):
         return len(self.segment_sizes)
 
     def encode(self, attrs):
-        if len(self.mappings) == 0:
-            baum_code_bits = get_initial_baum_code(self.segment_sizes)
-        else:
-            baum_code_bits = get_next_baum_code(self.segment_sizes, self.last_baum_code_bits) 
+        return self.encode_batch([attrs])[0].tolist()
 
-        self.last_baum_code_bits = copy.deepcopy(baum_code_bits)
-        baum_code = concrete_baum_code(self.segment_sizes, baum_code_bits)
-        self.mappings[repr(baum_code)] = repr(attrs)
-        return baum_code
+    def encode_batch(self, patterns, start=None):
+        """Encodes the patterns with consecutive ranks
+        Args:
+            patterns (list(list(float)) or np.ndarray): the patterns, one per row
+            start (int): the rank of the first pattern. Only the codes are
+                computed, and the patterns must be stored with `add_patterns`
+                to be decoded. If None the patterns are given the ranks after
+                every pattern stored so far and are stored.
+        Returns:
+            np.ndarray: (n, sum(segment_sizes)) uint8 array of the codes
+        """
+        patterns = np.asarray(patterns, dtype=np.float64)
+        if start is None:
+            start = self.num_patterns
+            self.add_patterns(start, patterns)
+        return baum_codes(self.segment_sizes, np.arange(start, start + len(patterns)))
+
+    def add_patterns(self, start, patterns):
+        """Stores patterns for decoding, the first with rank `start`
+        Args:
+            start (int): the rank the patterns were encoded from
+            patterns (list(list(float)) or np.ndarray): the patterns, one per row
+        """
+        patterns = np.asarray(patterns, dtype=np.float64)
+        self._pattern_blocks.append((start, patterns))
+        self.num_patterns = max(self.num_patterns, start + len(patterns))
+        self._patterns = None
+
+    def get_patterns(self):
+        """Returns every pattern stored so far as one array, in rank order"""
+        if self._patterns is None:
+            dims = self._pattern_blocks[0][1].shape[1] if self._pattern_blocks else 0
+            self._patterns = np.zeros(shape=(self.num_patterns, dims))
+            self._known = np.zeros(self.num_patterns, dtype=bool)
+            for (start, patterns) in self._pattern_blocks:
+                self._patterns[start:start + len(patterns)] = patterns
+                self._known[start:start + len(patterns)] = True
+            self._pattern_blocks = [(0, self._patterns)] if self._known.all() else self._pattern_blocks
+        return self._patterns
 
     def decode(self, vec):
-        return self.mappings[repr(vec)]
+        return self.decode_batch([vec])[0].tolist()
+
+    def decode_batch(self, codes):
+        """Returns the pattern stored for each code. Once there have been more
+        patterns than codes the codes repeat, and the pattern with the highest
+        rank given the code is returned.
+        Args:
+            codes (list(list) or np.ndarray): the codes, one per row
+        Returns:
+            np.ndarray: (n, num_attrs) array of the patterns
+        """
+        ranks = baum_code_ranks(self.segment_sizes, codes)
+        patterns = self.get_patterns()
+        # The highest rank stored which is the same modulo the number of codes
+        indices = ranks + ((self.num_patterns - 1 - ranks) // self.num_codes) * self.num_codes
+        unknown = indices < 0
+        unknown[~unknown] = ~self._known[indices[~unknown]]
+        if unknown.any():
+            raise KeyError("No pattern was encoded as Baum code rank {}".format(ranks[unknown][0]))
+        return patterns[indices]
 
 class SOMEncoder(EncodingScheme):
     """Encoder which uses a Self-Organizing Map to perform the encoding"""
 
-    def __init__(self, som_file_path):
+    def __init__(self, som_file_path, use_cache=True, bmu_search=None, report_bmu_search=False):
         """
         Args:
-            som_file_path(string): path to the .som file containing the trained som
+            som_file_path(string): path to the .som file containing the trained
+                som, or to a binary .npy/.npz codebook
+            use_cache(bool): whether to keep a binary copy of a .som text file
+                next to it for faster loading
+            bmu_search(dict): arguments for SOM.findBMUs choosing how encodeAll
+                searches for BMUs, e.g. {"method": "coarse", "coarse_factor": 4}
+            report_bmu_search(bool): whether encodeAll logs how well the BMU
+                search agrees with the exact search
         """
         self.som = som.SOM()
-        self.som.loadFromFile(som_file_path)
+        self.som.loadFromFile(som_file_path, use_cache=use_cache)
+        self.bmu_search = dict(bmu_search or {})
+        self.report_bmu_search = report_bmu_search
 
     def get_num_bits_in_encoding(self):
         return 2
@@ -207,6 +361,26 @@ class SOMEncoder(EncodingScheme):
         group2[bmuCol] = 1
         return group1 + group2
 
+    def encode_batch(self, patterns):
+        """Encodes every pattern at once using a batched BMU search
+        Args:
+            patterns (list(list(float)) or np.ndarray): the patterns, one per row
+        Returns:
+            np.ndarray: (n, rows + cols) uint8 array of the codes
+        """
+        patterns = np.asarray(patterns, dtype=np.float64)
+        bmus = self.som.findBMUs(patterns, **self.bmu_search)
+        if self.report_bmu_search and self.bmu_search.get("method", "exact") != "exact":
+            report = self.som.compareBMUSearch(patterns, **self.bmu_search)
+            log.info("BMU search report: %s", report)
+        rows = self.som.numRows()
+
+        codes = np.zeros(shape=(len(patterns), rows + self.som.numCols()), dtype=np.uint8)
+        indices = np.arange(len(patterns))
+        codes[indices, bmus[:, 0]] = 1
+        codes[indices, rows + bmus[:, 1]] = 1
+        return codes
+
     def decode(self, vec):
         group1 = vec[:self.som.numRows()]
         group2 = vec[self.som.numRows():]
@@ -215,6 +389,60 @@ class SOMEncoder(EncodingScheme):
         bmuWeights = self.som.getNeuronWeights(row, col)
         return bmuWeights.tolist()
 
+    def decode_batch(self, codes):
+        """Decodes every code at once to the weights of the neuron it names,
+        reading each group from its first set bit
+        Args:
+            codes (np.ndarray): (n, rows + cols) binary array of the codes
+        Returns:
+            np.ndarray: (n, dims) array of neuron weights
+        """
+        codes = np.asarray(codes)
+        rows = self.som.numRows()
+        assert(codes.ndim == 2 and codes.shape[1] == rows + self.som.numCols())
+        bmu_rows = np.argmax(codes[:, :rows] != 0, axis=1)
+        bmu_cols = np.argmax(codes[:, rows:] != 0, axis=1)
+        return np.array(self.som.data[bmu_rows, bmu_cols], dtype=np.float64)
+
+def baum_codes(segment_sizes, ranks):
+    """Returns the Baum code of each rank, wrapping round after the last code
+    Args:
+        segment_sizes (list(int)): sizes of the segments of the code
+        ranks (np.ndarray): (n,) array of ranks
+    Returns:
+        np.ndarray: (n, sum(segment_sizes)) uint8 array of the codes
+    """
+    ranks = np.asarray(ranks, dtype=np.intp) % int(np.prod(segment_sizes))
+    # The digits of the rank in the mixed radix given by the segment sizes,
+    # which is the position of the set bit in each segment
+    positions = np.unravel_index(ranks, segment_sizes)
+    offsets = np.concatenate(([0], np.cumsum(segment_sizes)[:-1]))
+
+    codes = np.zeros(shape=(len(ranks), sum(segment_sizes)), dtype=np.uint8)
+    rows = np.arange(len(ranks))
+    for (offset, pos) in zip(offsets, positions):
+        codes[rows, offset + pos] = 1
+    return codes
+
+def baum_code_ranks(segment_sizes, codes):
+    """The inverse of `baum_codes`. Segments of recalled codes with several
+    bits set are read from their first set bit, and empty ones as the first
+    bit.
+    Args:
+        segment_sizes (list(int)): sizes of the segments of the code
+        codes (list(list) or np.ndarray): (n, sum(segment_sizes)) array of codes
+    Returns:
+        np.ndarray: (n,) array of ranks
+    """
+    codes = np.asarray(codes)
+    assert(codes.ndim == 2 and codes.shape[1] == sum(segment_sizes))
+    positions = []
+    offset = 0
+    for size in segment_sizes:
+        positions.append(np.argmax(codes[:, offset:offset+size] != 0, axis=1))
+        offset += size
+    return np.ravel_multi_index(positions, segment_sizes)
+
 def get_initial_baum_code(segment_sizes):
     # returns bit positions
     bit_positions = []
@@ -266,6 +494,86 @@ def new_quantize(bits_len, bits_set, bin_used):
         cursor += 1
     return pat
 
+# Tables of every fixed weight code, keyed by (bits_len, bits_set)
+_quantize_code_tables = {}
+
+def quantize_code_table(bits_len, bits_set):
+    """Returns every code `new_quantize` can produce for the given sizes.
+    The codes are in bin order, which is the lexicographic order of the
+    positions of their set bits, so the table is built from
+    itertools.combinations rather than by unranking each bin.
+    Args:
+        bits_len (int): length of the code
+        bits_set (int): number of bits set in the code
+    Returns:
+        np.ndarray: (num_bins, bits_len) uint8 array where row i is bin i's code
+    """
+    key = (bits_len, bits_set)
+    if key not in _quantize_code_tables:
+        num_bins = utils.binomial(bits_len, bits_set)
+        positions = np.fromiter(itertools.chain.from_iterable(itertools.combinations(range(bits_len), bits_set)),
+                                dtype=np.intp, count=num_bins * bits_set)
+        table = np.zeros(shape=(num_bins, bits_len), dtype=np.uint8)
+        np.put_along_axis(table, positions.reshape(num_bins, bits_set), 1, axis=1)
+        _quantize_code_tables[key] = table
+    return _quantize_code_tables[key]
+
+# Sorted packed keys of each code table and the bin of each key, keyed by
+# (bits_len, bits_set)
+_quantize_code_lookups = {}
+
+def pack_code_keys(codes):
+    """Packs each row of a binary array into a single comparable key
+    Args:
+        codes (np.ndarray): (n, bits_len) uint8 array of 0s and 1s
+    Returns:
+        np.ndarray: (n,) array of np.void keys
+    """
+    packed = np.ascontiguousarray(np.packbits(codes, axis=1))
+    return packed.view(np.dtype((np.void, packed.shape[1]))).ravel()
+
+def quantize_code_ranks(codes, bits_len, bits_set):
+    """Finds the bin of each code, the inverse of `quantize_code_table`. Codes
+    which aren't in the table get the bin of the closest code in the table.
+    Args:
+        codes (np.ndarray): (n, bits_len) uint8 array of 0s and 1s
+        bits_len (int): length of the codes
+        bits_set (int): number of bits set in a valid code
+    Returns:
+        np.ndarray: (n,) array of bins
+    """
+    key = (bits_len, bits_set)
+    table = quantize_code_table(bits_len, bits_set)
+    if key not in _quantize_code_lookups:
+        table_keys = pack_code_keys(table)
+        order = np.argsort(table_keys)
+        _quantize_code_lookups[key] = (table_keys[order], order)
+    (sorted_keys, order) = _quantize_code_lookups[key]
+
+    code_keys = pack_code_keys(codes)
+    positions = np.minimum(np.searchsorted(sorted_keys, code_keys), len(sorted_keys) - 1)
+    found = sorted_keys[positions] == code_keys
+    bins = order[positions]
+
+    invalid = np.flatnonzero(~found)
+    if len(invalid) > 0:
+        bins[invalid] = nearest_codes(codes[invalid], table)
+    return bins
+
+def nearest_codes(codes, table):
+    """Returns the index of the row of `table` closest to each code by Hamming
+    distance, the lowest index winning ties"""
+    table = table.astype(np.float32)
+    table_weights = table.sum(axis=1)
+    nearest = np.zeros(shape=codes.shape[0], dtype=np.intp)
+    for start in range(0, codes.shape[0], 1024):
+        chunk = codes[start:start+1024].astype(np.float32)
+        # |a - b| = |a| + |b| - 2 a.b for binary a and b
+        distances = (chunk.sum(axis=1)[:, np.newaxis] + table_weights[np.newaxis, :]
+                     - 2 * np.dot(chunk, table.T))
+        nearest[start:start+1024] = np.argmin(distances, axis=1)
+    return nearest
+
 def get_first_bit_pos(n, b, x):
     if b == 1:
         return x
@@ -0,0 +1,198 @@
+"""A CMM whose matrix is split by rows across worker processes.
+
+The rows of a CMM (one per data bit) are independent of each other during both
+insert and recall, so each worker process owns a contiguous block of rows in
+its own storage backend. Keys are sent to every worker, data vectors are split
+by block, and the per-block recall sums are gathered back together before the
+thresholding, which needs to see a whole output vector.
+"""
+import multiprocessing
+import os
+
+import numpy as np
+
+from . import storage
+from .cmm import CMM
+
+def _shard_worker(conn, storage_kind, rows, cols):
+    """Runs in a worker process, applying the storage methods it is sent to its
+    own block of rows until it is sent None.
+    """
+    mem = storage.create_storage(storage_kind, rows, cols)
+    while True:
+        message = conn.recv()
+        if message is None:
+            break
+        (method, args) = message
+        try:
+            if method == "load_packed":
+                # Replaces the block with the given (rows, words) packed bits
+                mem = storage.STORAGE_BACKENDS[storage_kind].from_packed(args[0], cols)
+                conn.send((True, None))
+                continue
+            conn.send((True, getattr(mem, method)(*args)))
+        except Exception as e:
+            conn.send((False, e))
+    conn.close()
+
+class ShardedStorage:
+    """Storage backend which forwards every operation to a set of worker
+    processes, each holding a block of the rows.
+    """
+
+    def __init__(self, storage_kind, rows, cols, num_shards):
+        assert(num_shards >= 1)
+        self._cols = cols
+        # Row boundaries of each shard
+        blocks = np.array_split(np.arange(rows), num_shards)
+        self._bounds = [(int(b[0]), int(b[-1]) + 1) if len(b) > 0 else (rows, rows) for b in blocks]
+
+        self._conns = []
+        self._procs = []
+        for (start, end) in self._bounds:
+            parent_conn, child_conn = multiprocessing.Pipe()
+            proc = multiprocessing.Process(target=_shard_worker,
+                                           args=(child_conn, storage_kind, end - start, cols),
+                                           daemon=True)
+            proc.start()
+            child_conn.close()
+            self._conns.append(parent_conn)
+            self._procs.append(proc)
+
+    @property
+    def shape(self):
+        return (self._bounds[-1][1], self._cols)
+
+    def num_shards(self):
+        return len(self._conns)
+
+    def _call(self, method, shard_args):
+        """Calls the method on every shard at once, then waits for them all.
+        Args:
+            method (str): name of the storage method
+            shard_args (list(tuple)): the arguments to send to each shard
+        Returns:
+            list: the result from each shard
+        """
+        for (conn, args) in zip(self._conns, shard_args):
+            conn.send((method, args))
+
+        results = []
+        error = None
+        for conn in self._conns:
+            (ok, result) = conn.recv()
+            if not ok and error is None:
+                error = result
+            results.append(result)
+        if error is not None:
+            raise error
+        return results
+
+    def _split_rows(self, arr, axis):
+        """Splits arr along the given axis into the blocks of rows belonging to each shard"""
+        if axis == 0:
+            return [arr[start:end] for (start, end) in self._bounds]
+        else:
+            return [arr[:, start:end] for (start, end) in self._bounds]
+
+    def nbytes(self):
+        return sum(self._call("nbytes", [()] * self.num_shards()))
+
+    def insert(self, key_vec, data_vec):
+        blocks = self._split_rows(data_vec, axis=0)
+        self._call("insert", [(key_vec, block) for block in blocks])
+
+    def insert_many(self, keys, data):
+        blocks = self._split_rows(data, axis=1)
+        self._call("insert_many", [(keys, block) for block in blocks])
+
+    def insert_indices(self, key_indices, data_vec):
+        blocks = self._split_rows(data_vec, axis=0)
+        self._call("insert_indices", [(key_indices, block) for block in blocks])
+
+    def sums(self, key_vec):
+        return np.vstack(self._call("sums", [(key_vec,)] * self.num_shards()))
+
+    def sums_batch(self, keys):
+        return np.hstack(self._call("sums_batch", [(keys,)] * self.num_shards()))
+
+    def sums_indices(self, key_indices):
+        return np.hstack(self._call("sums_indices", [(key_indices,)] * self.num_shards()))
+
+    def to_dense(self):
+        return np.vstack(self._call("to_dense", [()] * self.num_shards()))
+
+    def to_packed(self):
+        return np.vstack(self._call("to_packed", [()] * self.num_shards()))
+
+    def load_packed(self, bits):
+        """Replaces the matrix with a (rows, words) packed uint8 array, sending
+        each shard its block of rows"""
+        assert(bits.shape[0] == self.shape[0])
+        blocks = self._split_rows(bits, axis=0)
+        self._call("load_packed", [(np.array(block),) for block in blocks])
+
+    def close(self):
+        """Stops the worker processes"""
+        for conn in self._conns:
+            try:
+                conn.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+            conn.close()
+        for proc in self._procs:
+            proc.join()
+        self._conns = []
+        self._procs = []
+
+class ShardedCMM(CMM):
+    """A CMM with the same API as `CMM` whose rows are split across
+    `num_shards` worker processes. Call `close` (or use it as a context
+    manager) to stop the workers.
+    """
+
+    def __init__(self, key_size, data_size, bits_in_key, threshold_func, record_data_items=True,
+                 storage_kind="packed", data_segment_sizes=None, num_shards=None):
+        """
+        Args:
+            num_shards (int): how many worker processes to use, defaults to the
+                number of CPUs. Every other argument is as for `CMM`.
+        """
+        self.num_shards = num_shards or os.cpu_count() or 1
+        super().__init__(key_size, data_size, bits_in_key, threshold_func,
+                         record_data_items=record_data_items,
+                         storage_kind=storage_kind,
+                         data_segment_sizes=data_segment_sizes)
+
+    def _create_storage(self, storage_kind, rows, cols):
+        return ShardedStorage(storage_kind, rows, cols, self.num_shards)
+
+    @classmethod
+    def load(cls, file_path, mmap_mode="r", storage_kind="packed", num_shards=None):
+        """Loads a memory saved by `CMM.save`, sending each worker its block of
+        rows. Each worker keeps its own copy of its block, so unlike `CMM.load`
+        the matrix is not memory mapped.
+        Args:
+            num_shards (int): how many worker processes to use. Every other
+                argument is as for `CMM.load`.
+        Returns:
+            ShardedCMM: the loaded memory
+        """
+        loaded = CMM.load(file_path, mmap_mode=mmap_mode, storage_kind="packed")
+        result = cls(loaded.key_size(), loaded.data_size(), loaded.bits_in_key, loaded.threshold_func,
+                     record_data_items=loaded.should_record_data_items,
+                     storage_kind=storage_kind,
+                     data_segment_sizes=loaded.data_segment_sizes,
+                     num_shards=num_shards)
+        result._mem.load_packed(loaded._mem.to_packed())
+        result.recorded_data_items = loaded.recorded_data_items
+        return result
+
+    def close(self):
+        self._mem.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
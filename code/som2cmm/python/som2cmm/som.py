@@ -1,29 +1,84 @@
+import argparse
+import hashlib
+import json
+import logging
 import numpy as np
+import os
+import time
+
+log = logging.getLogger("som2cmm")
+
+# How many patterns findBMUs compares against the codebook at once
+BMU_CHUNK_SIZE = 1024
+# Defaults for the coarse BMU search, see SOM.findBMUs
+COARSE_FACTOR = 4
+COARSE_CANDIDATES = 4
+# Most neuron weights the coarse search gathers at once
+COARSE_CHUNK_VALUES = 1 << 22
+# How many dimensions the pruned BMU search sums before dropping neurons
+PRUNED_BLOCK_SIZE = 32
+# How many patterns train_som updates the map with at once
+TRAIN_BATCH_SIZE = 32
 
 class SOM:
-    """Represents a Self-Organizing Map. Can only be used to execute pre-trained
-    SOMs at this time. For training SOMs use som.c
+    """Represents a Self-Organizing Map. Maps are trained with `train_som` or
+    with the C trainer, som.c
     """
     def __init__(self):
         self.data = None
+        self._codebook = None
+        self._codebook_norms = None
+        self._coarse_maps = None
+
+    def loadFromFile(self, file_path, mmap_mode="r", use_cache=True):
+        """Loads the SOM from a file. Binary codebooks (.npy or .npz, see
+        `saveToFile`) are loaded directly, memory-mapped where possible. A .som
+        text file is parsed once and a binary copy kept next to it, which later
+        loads use for as long as the text file is unchanged.
+        Args:
+            file_path (str): path to the .som, .npy or .npz file
+            mmap_mode (str): np.load mmap_mode for .npy files, or None to read
+                them into memory
+            use_cache (bool): whether to use and update the binary copy of a
+                .som text file
+        """
+        if is_binary_som_file(file_path):
+            self.setWeights(load_binary_codebook(file_path, mmap_mode))
+        elif use_cache:
+            self.setWeights(load_cached_codebook(file_path, mmap_mode))
+        else:
+            self.setWeights(load_text_codebook(file_path))
 
-    def loadFromFile(self, file_path):
-        with open(file_path, 'r') as f:
-            rows = 0
-            cols = 0
-            dims = 0
-            count = 0 # check to make sure the file is valid
-            for (i, line) in enumerate(f):
-                if i == 0:
-                    rows, cols, dims = map(int, line.split(","))
-                    self.data = np.zeros(shape=(rows,cols,dims))
-                else:
-                    weights = list(map(float, line.split(",")))
-                    row = int(count / float(cols))
-                    col = count % cols
-                    self.data[row,col] = np.array(weights)
-                    count += 1
-            assert(count == rows * cols)
+    def saveToFile(self, file_path, dtype=np.float64):
+        """Saves the SOM as a binary (rows, cols, dims) codebook if the path ends
+        in .npy or .npz, otherwise as a .som text file like som.c writes
+        Args:
+            file_path (str): path to write
+            dtype (np.dtype): float32 or float64, for binary codebooks
+        """
+        if is_binary_som_file(file_path):
+            save_binary_codebook(file_path, self.data, dtype)
+        else:
+            save_text_codebook(file_path, self.data)
+
+    def setWeights(self, data):
+        """Replaces the neuron weights with a (rows, cols, dims) array"""
+        assert(data.ndim == 3)
+        self.data = data
+        self._codebook = None
+        self._codebook_norms = None
+        self._coarse_maps = None
+
+    def getCodebook(self):
+        """Returns the neuron weights flattened into a (rows * cols, dims) array,
+        along with the squared norm of each neuron. Neurons are ordered column
+        by column, so neuron i is at row i % rows and column i // rows.
+        """
+        if self._codebook is None:
+            self._codebook = np.ascontiguousarray(
+                    self.data.transpose(1, 0, 2).reshape(-1, self.numDims()))
+            self._codebook_norms = np.einsum("ij,ij->i", self._codebook, self._codebook)
+        return (self._codebook, self._codebook_norms)
 
     def getNeuronWeights(self, row, col):
         return self.data[row, col, :]
@@ -44,15 +99,508 @@ class SOM:
         """Finds the best matching unit to the given pattern
         Args:
             pattern (np.array): The input pattern as a vector of float values
+        Returns:
+            tuple(int, int): the (row, col) of the best matching unit
         """
         assert(len(pattern) == self.numDims())
-        bestUnit = (0, 0)
-        bestDist = float("inf")
-        for col in range(self.numCols()):
-            for row in range(self.numRows()):
-                weights = self.getNeuronWeights(row, col)
-                dist = self.distanceFunc(pattern, weights)
-                if dist < bestDist:
-                    bestUnit = (row, col)
-                    bestDist = dist 
-        return bestUnit
+        bmus = self.findBMUs(np.asarray(pattern, dtype=np.float64)[np.newaxis, :])
+        return (int(bmus[0, 0]), int(bmus[0, 1]))
+
+    def findBMUs(self, patterns, chunk_size=BMU_CHUNK_SIZE, method="exact",
+                 coarse_factor=COARSE_FACTOR, coarse_candidates=COARSE_CANDIDATES):
+        """Finds the best matching unit to each of the given patterns.
+
+        Methods:
+            exact   Distances are computed as ||x||^2 - 2 x.w + ||w||^2 with one
+                    matrix product per chunk of patterns. Neurons which come
+                    within a rounding error of the best are compared again
+                    exactly, so the result is the same as comparing every neuron
+                    in turn: the first neuron, going column by column, wins ties.
+            pruned  Also exact, but each pattern's distances are summed a block
+                    of dimensions at a time and neurons are dropped as soon as
+                    they pass the distance to a first guess from the coarse
+                    search. Patterns are searched one at a time, so it uses far
+                    less memory than the exact search but is usually slower.
+            coarse  Approximate. Neighbouring neurons of a trained map are
+                    similar, so the map is shrunk by averaging blocks of
+                    coarse_factor x coarse_factor neurons. Only the neurons in
+                    the coarse_candidates blocks closest to each pattern are
+                    searched.
+        Args:
+            patterns (np.ndarray): (n, dims) array of input patterns
+            chunk_size (int): how many patterns to compare at once
+            method (str): "exact", "pruned" or "coarse"
+            coarse_factor (int): width of the blocks of the coarse map
+            coarse_candidates (int): how many blocks of the coarse map to search
+        Returns:
+            np.ndarray: (n, 2) array holding the (row, col) of each best matching unit
+        """
+        patterns = np.asarray(patterns, dtype=np.float64)
+        assert(patterns.ndim == 2 and patterns.shape[1] == self.numDims())
+
+        if method == "exact":
+            best = self._findBMUIndicesExact(patterns, chunk_size)
+        elif method == "pruned":
+            guesses = self._findBMUIndicesCoarse(patterns, chunk_size, coarse_factor, coarse_candidates)
+            best = self._findBMUIndicesPruned(patterns, guesses)
+        elif method == "coarse":
+            best = self._findBMUIndicesCoarse(patterns, chunk_size, coarse_factor, coarse_candidates)
+        else:
+            raise ValueError("Unknown BMU search method: " + str(method))
+
+        rows = self.numRows()
+        return np.column_stack((best % rows, best // rows))
+
+    def _findBMUIndicesExact(self, patterns, chunk_size):
+        (codebook, codebook_norms) = self.getCodebook()
+
+        best = np.zeros(shape=patterns.shape[0], dtype=np.intp)
+        for start in range(0, patterns.shape[0], chunk_size):
+            chunk = patterns[start:start+chunk_size]
+            chunk_norms = np.einsum("ij,ij->i", chunk, chunk)
+            dists = chunk_norms[:, np.newaxis] - 2 * np.dot(chunk, codebook.T) + codebook_norms[np.newaxis, :]
+            best_dists = dists.min(axis=1)
+
+            # Error bound of the expansion relative to the size of its terms
+            tolerance = 1e-9 * (chunk_norms + codebook_norms.max()) + 1e-12
+            close = dists <= (best_dists + tolerance)[:, np.newaxis]
+            best[start:start+len(chunk)] = np.argmax(close, axis=1)
+            for i in np.flatnonzero(np.count_nonzero(close, axis=1) > 1):
+                candidates = np.flatnonzero(close[i])
+                diffs = codebook[candidates] - chunk[i]
+                exact = np.sqrt(np.einsum("ij,ij->i", diffs, diffs))
+                best[start + i] = candidates[np.argmin(exact)]
+        return best
+
+    def _findBMUIndicesPruned(self, patterns, guesses):
+        """Partial distance elimination, starting from the given guess of each
+        pattern's best matching unit"""
+        (codebook, _) = self.getCodebook()
+        # Dimensions which vary most across the map rule out the most neurons,
+        # so they are summed first
+        dim_order = np.argsort(-codebook.var(axis=0), kind="stable")
+        ordered_codebook = np.ascontiguousarray(codebook[:, dim_order])
+        num_dims = self.numDims()
+
+        patterns = patterns[:, dim_order]
+        first_block = ordered_codebook[:, :PRUNED_BLOCK_SIZE]
+        first_block_norms = np.einsum("ij,ij->i", first_block, first_block)
+
+        best = np.zeros(shape=patterns.shape[0], dtype=np.intp)
+        for (i, pattern) in enumerate(patterns):
+            diff = ordered_codebook[guesses[i]] - pattern
+            # Loosened a little so that rounding never drops the best neuron
+            bound = np.dot(diff, diff) * (1 + 1e-9) + 1e-12
+
+            # The first block is summed for every neuron, and most are dropped
+            head = pattern[:PRUNED_BLOCK_SIZE]
+            partial = np.dot(head, head) - 2 * np.dot(first_block, head) + first_block_norms
+            candidates = np.flatnonzero(partial <= bound + 1e-9 * (np.dot(head, head) + first_block_norms))
+            diffs = ordered_codebook[candidates, :PRUNED_BLOCK_SIZE] - head
+            partial = np.einsum("ij,ij->i", diffs, diffs)
+            for start in range(PRUNED_BLOCK_SIZE, num_dims, PRUNED_BLOCK_SIZE):
+                keep = partial <= bound
+                candidates = candidates[keep]
+                partial = partial[keep]
+                diffs = ordered_codebook[candidates, start:start+PRUNED_BLOCK_SIZE] - pattern[start:start+PRUNED_BLOCK_SIZE]
+                partial += np.einsum("ij,ij->i", diffs, diffs)
+            best[i] = candidates[np.argmin(partial)]
+        return best
+
+    def _getCoarseMap(self, factor):
+        """Returns the coarse map used by the coarse search, built once for each
+        factor: the mean weights of each block of neurons, the squared norms of
+        those, and the indices of the neurons in each block padded with an
+        index past the end of the codebook.
+        """
+        if self._coarse_maps is None:
+            self._coarse_maps = {}
+        if factor not in self._coarse_maps:
+            (rows, cols) = (self.numRows(), self.numCols())
+            block_rows = range(0, rows, factor)
+            block_cols = range(0, cols, factor)
+            means = []
+            members = []
+            for col in block_cols:
+                for row in block_rows:
+                    means.append(self.data[row:row+factor, col:col+factor].reshape(-1, self.numDims()).mean(axis=0))
+                    block = [c * rows + r for c in range(col, min(col + factor, cols))
+                                          for r in range(row, min(row + factor, rows))]
+                    members.append(block + [rows * cols] * (factor * factor - len(block)))
+            means = np.array(means)
+            self._coarse_maps[factor] = (means, np.einsum("ij,ij->i", means, means),
+                                         np.array(members, dtype=np.intp))
+        return self._coarse_maps[factor]
+
+    def _findBMUIndicesCoarse(self, patterns, chunk_size, factor, num_candidates):
+        (codebook, codebook_norms) = self.getCodebook()
+        (means, mean_norms, members) = self._getCoarseMap(factor)
+        num_candidates = min(num_candidates, len(means))
+        # Padded so the padding index in members is never chosen
+        codebook_norms = np.append(codebook_norms, np.inf)
+        codebook = np.vstack((codebook, np.zeros(shape=(1, self.numDims()))))
+
+        # The candidate neurons' weights are gathered for each pattern, so the
+        # chunks are kept to a bounded number of values
+        candidates_per_pattern = num_candidates * members.shape[1]
+        chunk_size = max(1, min(chunk_size, COARSE_CHUNK_VALUES // (candidates_per_pattern * self.numDims())))
+
+        best = np.zeros(shape=patterns.shape[0], dtype=np.intp)
+        for start in range(0, patterns.shape[0], chunk_size):
+            chunk = patterns[start:start+chunk_size]
+            mean_dists = mean_norms[np.newaxis, :] - 2 * np.dot(chunk, means.T)
+            if num_candidates < len(means):
+                blocks = np.argpartition(mean_dists, num_candidates - 1, axis=1)[:, :num_candidates]
+            else:
+                blocks = np.broadcast_to(np.arange(len(means)), mean_dists.shape)
+            # Sorted so that the lowest index wins ties, as in the exact search
+            candidates = np.sort(members[blocks].reshape(len(chunk), -1), axis=1)
+            dists = codebook_norms[candidates] - 2 * np.einsum("ijk,ik->ij", codebook[candidates], chunk)
+            best[start:start+len(chunk)] = candidates[np.arange(len(chunk)), np.argmin(dists, axis=1)]
+        return best
+
+    def compareBMUSearch(self, patterns, method, **kwargs):
+        """Reports how closely a BMU search method agrees with the exact search,
+        and how long each took, for tuning the faster methods
+        Args:
+            patterns (np.ndarray): (n, dims) array of input patterns
+            method (str): the method to compare, see `findBMUs`
+            kwargs: any other arguments for `findBMUs`
+        Returns:
+            dict: "agreement" is the fraction of patterns given the same unit,
+                "mean_grid_distance" and "max_grid_distance" how far away on the
+                map the units given were, and "distance_ratio" the mean ratio of
+                the distance to the unit given to the distance to the true BMU
+        """
+        patterns = np.asarray(patterns, dtype=np.float64)
+        start_time = time.perf_counter()
+        exact = self.findBMUs(patterns, method="exact")
+        exact_seconds = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        found = self.findBMUs(patterns, method=method, **kwargs)
+        method_seconds = time.perf_counter() - start_time
+
+        grid_dists = np.sqrt(((found - exact) ** 2).sum(axis=1))
+        exact_dists = np.linalg.norm(self.data[exact[:, 0], exact[:, 1]] - patterns, axis=1)
+        found_dists = np.linalg.norm(self.data[found[:, 0], found[:, 1]] - patterns, axis=1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ratios = np.where(exact_dists > 0, found_dists / exact_dists, 1.0)
+        return {
+            "method": method,
+            "num_patterns": len(patterns),
+            "agreement": float(np.mean(grid_dists == 0)) if len(patterns) else 1.0,
+            "mean_grid_distance": float(grid_dists.mean()) if len(patterns) else 0.0,
+            "max_grid_distance": float(grid_dists.max()) if len(patterns) else 0.0,
+            "distance_ratio": float(ratios.mean()) if len(patterns) else 1.0,
+            "exact_seconds": exact_seconds,
+            "method_seconds": method_seconds,
+            }
+
+# Suffixes of the binary copy of a .som file and of the file recording which
+# version of the .som file it was made from
+SOM_CACHE_SUFFIX = ".npy"
+SOM_CACHE_INFO_SUFFIX = ".npy.json"
+
+def is_binary_som_file(file_path):
+    return file_path.endswith(".npy") or file_path.endswith(".npz")
+
+def load_text_codebook(file_path):
+    """Parses a .som text file, which has a "rows,cols,dims" header followed by
+    the weights of each neuron in row-major order, one neuron per line
+    Returns:
+        np.ndarray: (rows, cols, dims) array of weights
+    """
+    with open(file_path, 'r') as f:
+        rows, cols, dims = map(int, f.readline().split(","))
+        weights = np.loadtxt(f, delimiter=",", ndmin=2)
+    # check to make sure the file is valid
+    assert(weights.shape == (rows * cols, dims))
+    return weights.reshape(rows, cols, dims)
+
+def save_text_codebook(file_path, data):
+    """Writes a .som text file in the same format as som.c"""
+    (rows, cols, dims) = data.shape
+    with open(file_path, 'w') as f:
+        f.write("{},{},{}\n".format(rows, cols, dims))
+        np.savetxt(f, data.reshape(-1, dims), fmt="%f", delimiter=",")
+
+def load_binary_codebook(file_path, mmap_mode="r"):
+    if file_path.endswith(".npz"):
+        with np.load(file_path) as archive:
+            data = archive["data"]
+    else:
+        data = np.load(file_path, mmap_mode=mmap_mode)
+    assert(data.ndim == 3)
+    return data
+
+def save_binary_codebook(file_path, data, dtype=np.float64):
+    assert(np.dtype(dtype) in (np.dtype(np.float32), np.dtype(np.float64)))
+    data = np.asarray(data, dtype=dtype)
+    if file_path.endswith(".npz"):
+        np.savez(file_path, data=data)
+    elif file_path.endswith(".npy"):
+        np.save(file_path, data)
+    else:
+        raise ValueError("SOM codebooks are saved as .npy or .npz: " + file_path)
+
+def file_sha1(file_path):
+    sha1 = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+def load_cached_codebook(file_path, mmap_mode="r"):
+    """Loads a .som text file through its binary copy, first making the copy if
+    it is missing or out of date. The copy is current if the text file's size
+    and mtime are as recorded, or failing that if its hash is. If the copy
+    can't be written the text file is just parsed.
+    Returns:
+        np.ndarray: (rows, cols, dims) array of weights
+    """
+    cache_path = file_path + SOM_CACHE_SUFFIX
+    info_path = file_path + SOM_CACHE_INFO_SUFFIX
+    stat = os.stat(file_path)
+    info = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+    cached_info = None
+    if os.path.isfile(cache_path) and os.path.isfile(info_path):
+        try:
+            with open(info_path, 'r') as f:
+                cached_info = json.load(f)
+        except (OSError, ValueError):
+            cached_info = None
+
+    if cached_info is not None and cached_info.get("size") == info["size"]:
+        if cached_info.get("mtime_ns") == info["mtime_ns"]:
+            return load_binary_codebook(cache_path, mmap_mode)
+        info["sha1"] = file_sha1(file_path)
+        if cached_info.get("sha1") == info["sha1"]:
+            # Only touched, so just record the new mtime
+            write_cache_info(info_path, info)
+            return load_binary_codebook(cache_path, mmap_mode)
+
+    data = load_text_codebook(file_path)
+    if "sha1" not in info:
+        info["sha1"] = file_sha1(file_path)
+    try:
+        # Written under temporary names and then moved into place, so that
+        # other processes never see a partial copy
+        tmp_path = "{}.{}.tmp.npy".format(cache_path, os.getpid())
+        save_binary_codebook(tmp_path, data)
+        os.replace(tmp_path, cache_path)
+        write_cache_info(info_path, info)
+    except OSError as e:
+        log.warning("Couldn't cache the SOM codebook at %s: %s", cache_path, e)
+    return data
+
+def write_cache_info(info_path, info):
+    tmp_path = "{}.{}.tmp".format(info_path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(info, f)
+    os.replace(tmp_path, info_path)
+
+class TrainingPhase:
+    """The parameters of one phase of training, as taken by som.c. Over the
+    phase's iterations the learn rate and neighbourhood radius are blended
+    linearly from their initial to their final values.
+    """
+
+    def __init__(self, iterations=1000, learn_rate_initial=0.10, learn_rate_final=0.01,
+                 n_radius_initial=5.0, n_radius_final=2.0):
+        self.iterations = iterations
+        self.learn_rate_initial = learn_rate_initial
+        self.learn_rate_final = learn_rate_final
+        self.n_radius_initial = n_radius_initial
+        self.n_radius_final = n_radius_final
+
+    def getLearnRate(self, progress):
+        return self.learn_rate_initial + (self.learn_rate_final - self.learn_rate_initial) * progress
+
+    def getRadius(self, progress):
+        return self.n_radius_initial + (self.n_radius_final - self.n_radius_initial) * progress
+
+def lattice_sq_distances(size):
+    """Squared distances between the positions along one axis of the map"""
+    positions = np.arange(size, dtype=np.float64)
+    return (positions[:, np.newaxis] - positions[np.newaxis, :]) ** 2
+
+def neighbourhood_kernel(sq_distances, radius):
+    """The Gaussian neighbourhood function of som.c, exp(-0.5 (d / r)^2), along
+    one axis. It is separable, so the kernel between two neurons is the product
+    of the row and column kernels.
+    """
+    if radius <= 0:
+        return np.eye(len(sq_distances))
+    return np.exp(-0.5 * sq_distances / (radius * radius))
+
+def init_som_weights(patterns, rows, cols, method, equalize_value=0.0,
+                     randomize_min=-1.0, randomize_max=1.0, rng=None):
+    """Initial weights for training, as som.c's --weight-init-method
+    Args:
+        patterns (np.ndarray): (n, dims) training patterns, used by "intelligent"
+        method (str): "intelligent" spreads each weight uniformly across the
+            range of its dimension in the patterns, "randomize" uniformly
+            across [randomize_min, randomize_max], and "equalize" sets every
+            weight to equalize_value
+    Returns:
+        np.ndarray: (rows, cols, dims) array of weights
+    """
+    rng = rng or np.random.default_rng()
+    dims = patterns.shape[1]
+    if method == "intelligent":
+        return rng.uniform(patterns.min(axis=0), patterns.max(axis=0), size=(rows, cols, dims))
+    elif method == "randomize":
+        return rng.uniform(randomize_min, randomize_max, size=(rows, cols, dims))
+    elif method == "equalize":
+        return np.full(shape=(rows, cols, dims), fill_value=float(equalize_value))
+    else:
+        raise ValueError("Unknown weight init method: " + str(method))
+
+def train_som(patterns, rows, cols, phases, normalize_inputs=False, init_method="intelligent",
+              equalize_value=0.0, randomize_min=-1.0, randomize_max=1.0,
+              batch_size=TRAIN_BATCH_SIZE, seed=None):
+    """Trains a SOM with a batch version of som.c's algorithm, taking the same
+    parameters. As in som.c each phase's iterations are counted in patterns,
+    going round the patterns in order as many times as needed.
+
+    som.c moves every neuron j by learn_rate * h_bj * (x - w_b) for a pattern x
+    with BMU b, i.e. by the BMU's delta rather than the usual (x - w_j). This
+    keeps that rule. Each batch of patterns is assigned to its BMUs at once,
+    and each BMU k moves towards the mean m_k of the patterns it won by a
+    fraction 1 - (1 - learn_rate)^hits_k, which is how far hits_k som.c updates
+    would move it were the patterns all equal to m_k. Every neuron j then moves
+    by the sum of those displacements weighted by h_kj. With one pattern per
+    batch this is exactly som.c's update.
+
+    With normalize_inputs, as in som.c, dimensions whose minimum and maximum
+    are equal are trained on unscaled, so their weights end up at that value.
+    Unlike som.c, "intelligent" initialisation spreads the weights over the
+    normalized ranges rather than the raw ones.
+    Args:
+        patterns (np.ndarray): (n, dims) training patterns
+        rows (int): rows of the map
+        cols (int): cols of the map
+        phases (list(TrainingPhase)): the phases of training, in order
+        normalize_inputs (bool): whether to train on each dimension scaled to
+            [0, 1], scaling the weights back at the end
+        init_method (str): see `init_som_weights`
+        batch_size (int): how many patterns to update the map with at once
+        seed (int): seed for the random weight initialisation
+    Returns:
+        SOM: the trained map
+    """
+    patterns = np.asarray(patterns, dtype=np.float64)
+    assert(patterns.ndim == 2 and len(patterns) > 0)
+    rng = np.random.default_rng(seed)
+
+    if normalize_inputs:
+        minima = patterns.min(axis=0)
+        ranges = patterns.max(axis=0) - minima
+        scale = np.where(ranges > 0, ranges, 1.0)
+        patterns = np.where(ranges > 0, (patterns - minima) / scale, patterns)
+
+    som = SOM()
+    som.setWeights(init_som_weights(patterns, rows, cols, init_method, equalize_value,
+                                    randomize_min, randomize_max, rng))
+    row_sq_dists = lattice_sq_distances(rows)
+    col_sq_dists = lattice_sq_distances(cols)
+    num_patterns = len(patterns)
+    batch_size = max(1, min(batch_size, num_patterns))
+
+    for phase in phases:
+        # som.c reads each phase from the start of the training file
+        next_pattern = 0
+        for start in range(0, phase.iterations, batch_size):
+            size = min(batch_size, phase.iterations - start)
+            indices = (next_pattern + np.arange(size)) % num_patterns
+            next_pattern = (next_pattern + size) % num_patterns
+
+            # The schedule is taken at the middle of the batch
+            middle = start + (size - 1) / 2.0
+            progress = middle / (phase.iterations - 1) if phase.iterations > 1 else 0
+            train_som_batch(som, patterns[indices], phase.getLearnRate(progress),
+                            neighbourhood_kernel(row_sq_dists, phase.getRadius(progress)),
+                            neighbourhood_kernel(col_sq_dists, phase.getRadius(progress)))
+
+    if normalize_inputs:
+        som.setWeights(minima + som.data * ranges)
+    return som
+
+def train_som_batch(som, batch, learn_rate, row_kernel, col_kernel):
+    """Updates the map with one batch of patterns, see `train_som`"""
+    (rows, cols, dims) = som.data.shape
+    bmus = som.findBMUs(batch)
+
+    # Number and sum of the patterns won by each neuron
+    flat_bmus = bmus[:, 0] * cols + bmus[:, 1]
+    hits = np.bincount(flat_bmus, minlength=rows * cols).reshape(rows, cols).astype(np.float64)
+    sums = np.zeros(shape=(rows * cols, dims))
+    np.add.at(sums, flat_bmus, batch)
+    sums = sums.reshape(rows, cols, dims)
+
+    # How far each BMU moves towards the mean of the patterns it won
+    with np.errstate(divide="ignore", invalid="ignore"):
+        means = np.where(hits[:, :, np.newaxis] > 0, sums / hits[:, :, np.newaxis], som.data)
+    step = 1.0 - np.power(1.0 - learn_rate, hits)
+    deltas = step[:, :, np.newaxis] * (means - som.data)
+
+    # Spread over the neighbourhoods, one axis at a time
+    spread = np.tensordot(row_kernel, deltas, axes=(1, 0))
+    spread = np.einsum("ikd,kj->ijd", spread, col_kernel)
+    som.setWeights(som.data + spread)
+
+def load_training_patterns(file_path, class_index=-1):
+    """Loads a training file in som.c's format: CSV with one pattern per line,
+    optionally with a class column which is skipped"""
+    with open(file_path, 'r') as f:
+        num_cols = len(f.readline().split(","))
+    usecols = [i for i in range(num_cols) if i != class_index]
+    return np.loadtxt(file_path, delimiter=",", usecols=usecols, ndmin=2)
+
+if __name__ == "__main__":
+    # The same options as som.c
+    parser = argparse.ArgumentParser(description="Trains a SOM with a batch version of som.c's algorithm")
+    parser.add_argument("--rows", type=int, default=10)
+    parser.add_argument("--cols", type=int, default=10)
+    parser.add_argument("--input-dims", type=int, default=3)
+    parser.add_argument("--train", required=True, help="Path to the CSV training file")
+    parser.add_argument("--train-file-class-index", type=int, default=-1,
+                        help="Index of the class column of the training file, if it has one")
+    parser.add_argument("--save", required=True, help="Path to save the SOM to (.som, .npy or .npz)")
+    parser.add_argument("--weight-init-method", default="intelligent",
+                        choices=["intelligent", "randomize", "equalize"])
+    parser.add_argument("--weight-equalize-val", "--weight-equalize-value", type=float, default=0.0)
+    parser.add_argument("--weight-randomize-min", type=float, default=-1.0)
+    parser.add_argument("--weight-randomize-max", type=float, default=1.0)
+    parser.add_argument("--normalize-inputs", action="store_true")
+    for p in ["p1", "p2"]:
+        parser.add_argument("--{}-iterations".format(p), type=int, default=1000)
+        parser.add_argument("--{}-learn-rate-initial".format(p), type=float, default=0.10)
+        parser.add_argument("--{}-learn-rate-final".format(p), type=float, default=0.01)
+        parser.add_argument("--{}-n-radius-initial".format(p), type=float, default=5.0)
+        parser.add_argument("--{}-n-radius-final".format(p), type=float, default=2.0)
+    parser.add_argument("--batch-size", type=int, default=TRAIN_BATCH_SIZE)
+    parser.add_argument("--seed", type=int)
+    args = vars(parser.parse_args())
+
+    logging.basicConfig(level=logging.INFO)
+    patterns = load_training_patterns(args["train"], args["train_file_class_index"])
+    assert(patterns.shape[1] == args["input_dims"])
+
+    phases = [TrainingPhase(args[p + "_iterations"],
+                            args[p + "_learn_rate_initial"], args[p + "_learn_rate_final"],
+                            args[p + "_n_radius_initial"], args[p + "_n_radius_final"])
+              for p in ["p1", "p2"]]
+    start_time = time.perf_counter()
+    trained = train_som(patterns, args["rows"], args["cols"], phases,
+                        normalize_inputs=args["normalize_inputs"],
+                        init_method=args["weight_init_method"],
+                        equalize_value=args["weight_equalize_val"],
+                        randomize_min=args["weight_randomize_min"],
+                        randomize_max=args["weight_randomize_max"],
+                        batch_size=args["batch_size"], seed=args["seed"])
+    log.info("Trained in %.2fs", time.perf_counter() - start_time)
+    trained.saveToFile(args["save"])
+    log.info("Saved SOM to \"%s\"", args["save"])
@@ -0,0 +1,368 @@
+"""Storage backends for the binary weight matrix of a CMM.
+
+Every backend holds a matrix shaped with `data_size` rows and `key_size` cols
+where each cell is either 0 or 1, and exposes the same small set of operations
+so that the CMM itself doesn't need to know how the bits are laid out.
+"""
+import numpy as np
+
+# Number of set bits in each possible byte value
+POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+def popcount(arr, axis=None):
+    """Counts the set bits in an array of packed uint8 words
+    Args:
+        arr (np.ndarray): array of dtype uint8
+        axis (int): the axis to sum over, or None to sum everything
+    Returns:
+        np.ndarray: the number of set bits
+    """
+    return POPCOUNT_TABLE[arr].sum(axis=axis, dtype=np.int64)
+
+# How many pairs are multiplied at once by the batched operations. Bounds the
+# size of the temporary float matrices they allocate.
+CHUNK_SIZE = 4096
+
+def iter_chunks(n, chunk_size=CHUNK_SIZE):
+    """Yields (start, end) index pairs covering range(n) in chunks"""
+    for start in range(0, n, chunk_size):
+        yield (start, min(start + chunk_size, n))
+
+def keys_per_chunk(key_indices, rows):
+    """How many index keys to gather at once so that the (rows, n, bits)
+    temporary stays around the same size as the other chunked operations"""
+    return max(1, (CHUNK_SIZE * 64) // max(1, rows * key_indices.shape[1]))
+
+def pack_vector(vec):
+    """Packs a binary (n, 1) or (n,) vector into uint8 words"""
+    return np.packbits(np.ravel(vec) != 0)
+
+class DenseStorage:
+    """Stores the matrix as a dense float64 array, one element per cell"""
+
+    def __init__(self, rows, cols):
+        self._mat = np.zeros(shape=(rows, cols))
+        # This saves having to allocate a new matrix on every insert
+        self._work_mat = np.zeros(shape=(rows, cols))
+
+    @property
+    def shape(self):
+        return self._mat.shape
+
+    def nbytes(self):
+        return self._mat.nbytes + self._work_mat.nbytes
+
+    def insert(self, key_vec, data_vec):
+        """ORs the outer product of data_vec and key_vec into the matrix.
+        Args:
+            key_vec (np.ndarray): (cols, 1) binary key vector
+            data_vec (np.ndarray): (rows, 1) binary data vector
+        """
+        # Temporary matrix will be added to the main matrix
+        self._work_mat.fill(0)
+        np.dot(data_vec, np.transpose(key_vec), out=self._work_mat)
+        self._mat += self._work_mat
+        self._mat[self._mat > 1] = 1
+
+    def insert_many(self, keys, data):
+        """Inserts many pairs at once with a thresholded matrix product.
+        Args:
+            keys (np.ndarray): (n, cols) binary keys, one per row
+            data (np.ndarray): (n, rows) binary data vectors, one per row
+        """
+        for (start, end) in iter_chunks(keys.shape[0]):
+            self._mat += np.dot(data[start:end].T.astype(np.float64),
+                                keys[start:end].astype(np.float64))
+            self._mat[self._mat > 1] = 1
+
+    def sums(self, key_vec):
+        """Computes the un-thresholded recall for the given key.
+        Args:
+            key_vec (np.ndarray): (cols, 1) binary key vector
+        Returns:
+            np.ndarray: (rows, 1) vector of the per-row sums
+        """
+        output_vec = np.zeros(shape=(self.shape[0], 1))
+        np.dot(self._mat, key_vec, out=output_vec)
+        return output_vec
+
+    def sums_batch(self, keys):
+        """Computes the un-thresholded recall for many keys at once.
+        Args:
+            keys (np.ndarray): (n, cols) binary keys, one per row
+        Returns:
+            np.ndarray: (n, rows) array of the per-row sums for each key
+        """
+        output = np.zeros(shape=(keys.shape[0], self.shape[0]))
+        for (start, end) in iter_chunks(keys.shape[0]):
+            np.dot(keys[start:end].astype(np.float64), self._mat.T, out=output[start:end])
+        return output
+
+    def insert_indices(self, key_indices, data_vec):
+        """Inserts a pair whose key is given by the indices of its set bits.
+        Only the key's columns are touched.
+        Args:
+            key_indices (np.ndarray): indices of the set bits in the key
+            data_vec (np.ndarray): (rows, 1) binary data vector
+        """
+        rows = np.flatnonzero(np.ravel(data_vec))
+        self._mat[np.ix_(rows, key_indices)] = 1
+
+    def sums_indices(self, key_indices):
+        """Computes the un-thresholded recall for many keys given by the indices
+        of their set bits. Only the keys' columns are read.
+        Args:
+            key_indices (np.ndarray): (n, bits) indices of the set bits per key
+        Returns:
+            np.ndarray: (n, rows) array of the per-row sums for each key
+        """
+        output = np.zeros(shape=(key_indices.shape[0], self.shape[0]))
+        for (start, end) in iter_chunks(key_indices.shape[0], keys_per_chunk(key_indices, self.shape[0])):
+            # (rows, n, bits) -> (n, rows)
+            output[start:end] = self._mat[:, key_indices[start:end]].sum(axis=2).T
+        return output
+
+    def to_dense(self):
+        return self._mat
+
+    def to_packed(self):
+        """Returns the matrix packed into a (rows, words) uint8 array"""
+        return np.packbits(self._mat != 0, axis=1)
+
+    @classmethod
+    def from_packed(cls, bits, cols):
+        """Creates the storage from a (rows, words) packed uint8 array"""
+        result = cls(bits.shape[0], cols)
+        result._mat[:] = np.unpackbits(bits, axis=1, count=cols)
+        return result
+
+class PackedStorage:
+    """Stores the matrix bit-packed, each row packed into uint8 words along the
+    key dimension. Uses 1/64th of the memory of `DenseStorage`.
+    """
+
+    def __init__(self, rows, cols):
+        self._cols = cols
+        self._bits = np.zeros(shape=(rows, (cols + 7) // 8), dtype=np.uint8)
+
+    @property
+    def shape(self):
+        return (self._bits.shape[0], self._cols)
+
+    def nbytes(self):
+        return self._bits.nbytes
+
+    def insert(self, key_vec, data_vec):
+        """ORs the packed key into every row which is set in data_vec.
+        Args:
+            key_vec (np.ndarray): (cols, 1) binary key vector
+            data_vec (np.ndarray): (rows, 1) binary data vector
+        """
+        rows = np.flatnonzero(np.ravel(data_vec))
+        self._bits[rows] |= pack_vector(key_vec)
+
+    def insert_many(self, keys, data):
+        """Inserts many pairs at once. Each chunk of rows is built with a
+        thresholded matrix product, packed and then ORed into the matrix.
+        Args:
+            keys (np.ndarray): (n, cols) binary keys, one per row
+            data (np.ndarray): (n, rows) binary data vectors, one per row
+        """
+        rows = self._bits.shape[0]
+        # Keep each (rows_per_chunk, cols) product at around a megabyte
+        rows_per_chunk = max(1, (CHUNK_SIZE * 64) // max(1, self._cols))
+        for (start, end) in iter_chunks(keys.shape[0]):
+            keys_chunk = (keys[start:end] != 0).astype(np.float32)
+            data_chunk = (data[start:end] != 0).astype(np.float32)
+            for (row_start, row_end) in iter_chunks(rows, rows_per_chunk):
+                product = np.dot(data_chunk[:, row_start:row_end].T, keys_chunk)
+                self._bits[row_start:row_end] |= np.packbits(product > 0, axis=1)
+
+    def sums(self, key_vec):
+        """Computes the un-thresholded recall for the given key by counting the
+        set bits of each row which fall in the active key columns.
+        Args:
+            key_vec (np.ndarray): (cols, 1) binary key vector
+        Returns:
+            np.ndarray: (rows, 1) vector of the per-row sums
+        """
+        counts = popcount(self._bits & pack_vector(key_vec), axis=1)
+        return counts.astype(np.float64).reshape(-1, 1)
+
+    def sums_batch(self, keys):
+        """Computes the un-thresholded recall for many keys at once. Blocks of
+        rows are unpacked in turn and multiplied against the keys.
+        Args:
+            keys (np.ndarray): (n, cols) binary keys, one per row
+        Returns:
+            np.ndarray: (n, rows) array of the per-row sums for each key
+        """
+        rows = self._bits.shape[0]
+        rows_per_chunk = max(1, (CHUNK_SIZE * 64) // max(1, self._cols))
+        output = np.zeros(shape=(keys.shape[0], rows))
+        for (row_start, row_end) in iter_chunks(rows, rows_per_chunk):
+            block = np.unpackbits(self._bits[row_start:row_end], axis=1, count=self._cols)
+            block = block.astype(np.float32).T
+            for (start, end) in iter_chunks(keys.shape[0]):
+                keys_chunk = (keys[start:end] != 0).astype(np.float32)
+                output[start:end, row_start:row_end] = np.dot(keys_chunk, block)
+        return output
+
+    def insert_indices(self, key_indices, data_vec):
+        """Inserts a pair whose key is given by the indices of its set bits.
+        Only the words holding the key's columns are touched.
+        Args:
+            key_indices (np.ndarray): indices of the set bits in the key
+            data_vec (np.ndarray): (rows, 1) binary data vector
+        """
+        rows = np.flatnonzero(np.ravel(data_vec))
+        for index in np.ravel(key_indices):
+            self._bits[rows, index >> 3] |= np.uint8(0x80 >> (index & 7))
+
+    def sums_indices(self, key_indices):
+        """Computes the un-thresholded recall for many keys given by the indices
+        of their set bits, by extracting just the keys' columns from the words.
+        Args:
+            key_indices (np.ndarray): (n, bits) indices of the set bits per key
+        Returns:
+            np.ndarray: (n, rows) array of the per-row sums for each key
+        """
+        output = np.zeros(shape=(key_indices.shape[0], self._bits.shape[0]))
+        for (start, end) in iter_chunks(key_indices.shape[0], keys_per_chunk(key_indices, self.shape[0])):
+            indices = key_indices[start:end]
+            # (rows, n, bits) words, shifted so the wanted bit is the lowest
+            words = self._bits[:, indices >> 3] >> (7 - (indices & 7)).astype(np.uint8)
+            output[start:end] = (words & 1).sum(axis=2, dtype=np.int64).T
+        return output
+
+    def to_dense(self):
+        return np.unpackbits(self._bits, axis=1, count=self._cols).astype(np.float64)
+
+    def to_packed(self):
+        """Returns the matrix packed into a (rows, words) uint8 array"""
+        return self._bits
+
+    @classmethod
+    def from_packed(cls, bits, cols):
+        """Creates the storage around a (rows, words) packed uint8 array without
+        copying it, so `bits` may be a np.memmap.
+        """
+        assert(bits.dtype == np.uint8 and bits.shape[1] == (cols + 7) // 8)
+        result = cls(0, cols)
+        result._bits = bits
+        return result
+
+class RecordedItems:
+    """A deduplicated set of binary data vectors, stored bit-packed and in the
+    order they were first added. Used by smart recall to find the stored item
+    closest to a recalled vector.
+    """
+
+    def __init__(self, size):
+        self._size = size
+        self._index = {} # packed bytes -> position in self._rows
+        self._rows = []
+        self._packed = None # stacked self._rows, rebuilt lazily
+
+    def __len__(self):
+        if self._rows is None:
+            return len(self._packed)
+        return len(self._rows)
+
+    def add(self, vec):
+        """Adds a single (size, 1) or (size,) binary vector"""
+        self.add_many(np.reshape(vec, (1, -1)))
+
+    def add_many(self, data):
+        """Adds each row of the (n, size) binary array `data`"""
+        self._build_index()
+        packed = np.packbits(np.asarray(data) != 0, axis=1)
+        # Only visit each distinct row once, in order of first appearance
+        _, first = np.unique(packed, axis=0, return_index=True)
+        for i in np.sort(first):
+            row_key = packed[i].tobytes()
+            if row_key not in self._index:
+                self._index[row_key] = len(self._rows)
+                self._rows.append(packed[i])
+                self._packed = None
+
+    def _build_index(self):
+        """Builds the index of a set made by `from_packed`, which only
+        adding items needs"""
+        if self._index is None:
+            self._rows = list(self._packed)
+            self._index = {row.tobytes(): i for (i, row) in enumerate(self._rows)}
+
+    @classmethod
+    def from_packed(cls, packed, size):
+        """Creates the set from a (n, words) array of distinct packed items.
+        The array, e.g. a memmap, is used as it is until an item is added."""
+        result = cls(size)
+        result._index = None
+        result._rows = None
+        result._packed = packed
+        return result
+
+    def packed(self):
+        """Returns the (len, words) uint8 array of the packed items"""
+        if self._packed is None:
+            words = (self._size + 7) // 8
+            self._packed = np.array(self._rows, dtype=np.uint8).reshape(-1, words)
+        return self._packed
+
+    def items(self):
+        """Returns the (len, size) float64 array of the items"""
+        return np.unpackbits(self.packed(), axis=1, count=self._size).astype(np.float64)
+
+    def hamming_distances(self, queries, items=None, item_sums=None):
+        """Computes the Hamming distance from every query to every item.
+        Args:
+            queries (np.ndarray): (n, size) binary vectors, one per row
+            items (np.ndarray): the unpacked `items()`, if already computed
+            item_sums (np.ndarray): the number of set bits in each item, if
+                already computed
+        Returns:
+            np.ndarray: (n, len) array of distances
+        """
+        if items is None:
+            items = self.items()
+        if item_sums is None:
+            item_sums = items.sum(axis=1)
+        queries = (np.asarray(queries) != 0).astype(np.float64)
+        # |q - x|^2 = |q| + |x| - 2 q.x for binary q and x
+        return (queries.sum(axis=1)[:, np.newaxis] + item_sums[np.newaxis, :]
+                - 2 * np.dot(queries, items.T))
+
+    def nearest(self, queries):
+        """Finds the closest item to each query. As the vectors are binary the
+        Hamming distance orders items the same as the Euclidean distance.
+        Where items are equally close the one added first wins.
+        Args:
+            queries (np.ndarray): (n, size) binary vectors, one per row
+        Returns:
+            np.ndarray: (n, size) float64 array holding the nearest item per row
+        """
+        # Unpacked once for every chunk of queries
+        items = self.items()
+        item_sums = items.sum(axis=1)
+        nearest = np.zeros(shape=(queries.shape[0], self._size))
+        for (start, end) in iter_chunks(queries.shape[0]):
+            distances = self.hamming_distances(queries[start:end], items, item_sums)
+            nearest[start:end] = items[np.argmin(distances, axis=1)]
+        return nearest
+
+STORAGE_BACKENDS = {
+    "dense": DenseStorage,
+    "packed": PackedStorage,
+}
+
+def create_storage(kind, rows, cols):
+    """Creates the storage backend with the given name
+    Args:
+        kind (str): one of "dense" or "packed"
+        rows (int): number of rows (the data size)
+        cols (int): number of cols (the key size)
+    """
+    if kind not in STORAGE_BACKENDS:
+        raise ValueError("Unrecognized CMM storage: " + str(kind))
+    return STORAGE_BACKENDS[kind](rows, cols)
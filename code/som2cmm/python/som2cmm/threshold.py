@@ -0,0 +1,112 @@
+"""Thresholding functions applied to the raw output of a CMM recall.
+
+A threshold is compiled once from the CMM's `threshold_func` string by
+`create_threshold` and then called on a (n, data_size) array holding one
+un-thresholded output vector per row, returning a binary array of the same
+shape.
+
+Supported functions:
+    lmaxN     the N highest outputs are set (e.g. "lmax1", "lmax12")
+    willshaw  outputs equal to the number of bits in the key are set
+    lwtaN     the N highest outputs within each segment of the data vector are
+              set (e.g. "lwta1"). Needs the data vector's segment sizes, as
+              used by the Baum encoding.
+"""
+import re
+
+import numpy as np
+
+def threshold_lmax(sums, L):
+    """Sets the L highest values in each row to 1 and all others to 0. Where
+    values tie the lowest indices win, the same as a stable sort would give.
+    Args:
+        sums (np.ndarray): (n, size) array of un-thresholded recall outputs
+        L (int): how many values to set in each row
+    Returns:
+        np.ndarray: (n, size) binary array
+    """
+    n, size = sums.shape
+    if L >= size:
+        return np.ones(shape=(n, size))
+    if L <= 0:
+        return np.zeros(shape=(n, size))
+
+    # The L-th highest value in each row
+    kth_index = np.argpartition(sums, size - L, axis=1)[:, size - L]
+    kth = np.take_along_axis(sums, kth_index[:, np.newaxis], axis=1)
+    above = sums > kth
+    ties = sums == kth
+    # Fill the remaining places from the tied values, lowest index first
+    remaining = L - np.count_nonzero(above, axis=1)
+    chosen = ties & (np.cumsum(ties, axis=1) <= remaining[:, np.newaxis])
+    return (above | chosen).astype(np.float64)
+
+class LMaxThreshold:
+    """Sets the L highest outputs"""
+
+    def __init__(self, L):
+        self.L = L
+
+    def __call__(self, sums):
+        return threshold_lmax(sums, self.L)
+
+class WillshawThreshold:
+    """Sets every output which reached the number of bits set in the key, i.e.
+    the rows where every active key column was set
+    """
+
+    def __init__(self, bits_in_key):
+        self.bits_in_key = bits_in_key
+
+    def __call__(self, sums):
+        return (sums >= self.bits_in_key).astype(np.float64)
+
+class SegmentLWTAThreshold:
+    """L-winners-take-all applied separately to each segment of the output"""
+
+    def __init__(self, L, segment_sizes):
+        self.L = L
+        self.segment_sizes = list(segment_sizes)
+        self._equal_segments = len(set(self.segment_sizes)) == 1
+
+    def __call__(self, sums):
+        n, size = sums.shape
+        assert(size == sum(self.segment_sizes))
+
+        if self._equal_segments:
+            # Every segment can be thresholded as a row of its own
+            seg_size = self.segment_sizes[0]
+            result = threshold_lmax(sums.reshape(-1, seg_size), self.L)
+            return result.reshape(n, size)
+
+        result = np.zeros(shape=(n, size))
+        start = 0
+        for seg_size in self.segment_sizes:
+            end = start + seg_size
+            result[:, start:end] = threshold_lmax(sums[:, start:end], self.L)
+            start = end
+        return result
+
+def create_threshold(threshold_func, bits_in_key, segment_sizes=None):
+    """Compiles the named thresholding function
+    Args:
+        threshold_func (str): e.g. "lmax1", "willshaw" or "lwta1"
+        bits_in_key (int): how many bits are set in each key
+        segment_sizes (list(int)): sizes of the data vector's segments, needed by "lwtaN"
+    Returns:
+        callable: maps a (n, size) array of outputs to a (n, size) binary array
+    """
+    match = re.match(r"^lmax(\d+)$", threshold_func)
+    if match:
+        return LMaxThreshold(int(match.group(1)))
+
+    if threshold_func == "willshaw":
+        return WillshawThreshold(bits_in_key)
+
+    match = re.match(r"^lwta(\d+)$", threshold_func)
+    if match:
+        if segment_sizes is None:
+            raise ValueError("Thresholding function {} needs segment sizes".format(threshold_func))
+        return SegmentLWTAThreshold(int(match.group(1)), segment_sizes)
+
+    raise ValueError("Unknown thresholding function: " + str(threshold_func))
@@ -1,4 +1,15 @@
 import json
+import numpy as np
+import os.path
+
+# The binary files (CMM memories, cmm inputs and patterns) start with an 8 byte magic
+# string, then a uint32 header length and a JSON header padded so that the
+# packed arrays which follow start on an aligned offset
+BINARY_FILE_ALIGNMENT = 64
+CMM_INPUT_MAGIC = b"SOM2CMI1"
+PATTERNS_MAGIC = b"SOM2CMP1"
+# How many patterns AttributeStats converts to an array at once
+STATS_CHUNK_SIZE = 4096
 
 def binomial(n, k):
     if 0 <= k <= n:
@@ -13,22 +24,104 @@ def binomial(n, k):
         return 0
 
 def get_min_max_values(patterns):
-    pattern_length = len(patterns[0])
-    vmin = float("inf")
-    vmax = float("-inf")
-    min_values = [vmin] * pattern_length
-    max_values = [vmax] * pattern_length
+    return AttributeStats.from_patterns(patterns).min_max()
+
+class AttributeStats:
+    """Running count, min, max, mean and variance of each attribute of a set
+    of patterns, built up a chunk of patterns at a time. Stats built from
+    separate parts of the patterns, e.g. in different processes, can be
+    merged into the stats of the whole.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.min = None
+        self.max = None
+        self.mean = None
+        # Sum of squared differences from the mean
+        self.m2 = None
+
+    def update(self, patterns):
+        """Adds a chunk of patterns
+        Args:
+            patterns (list(list(float)) or np.ndarray): the patterns, one per row
+        Returns:
+            AttributeStats: self
+        """
+        patterns = np.asarray(patterns, dtype=np.float64)
+        if patterns.ndim == 1:
+            patterns = patterns[np.newaxis, :]
+        if len(patterns) == 0:
+            return self
+
+        chunk = AttributeStats()
+        chunk.count = len(patterns)
+        chunk.min = patterns.min(axis=0)
+        chunk.max = patterns.max(axis=0)
+        chunk.mean = patterns.mean(axis=0)
+        chunk.m2 = ((patterns - chunk.mean) ** 2).sum(axis=0)
+        return self.merge(chunk)
+
+    def merge(self, other):
+        """Adds the patterns counted by other, combining the means and
+        variances as in Chan et al.'s parallel algorithm
+        Returns:
+            AttributeStats: self
+        """
+        if other.count == 0:
+            return self
+        if self.count == 0:
+            (self.count, self.min, self.max, self.mean, self.m2) = \
+                (other.count, other.min.copy(), other.max.copy(), other.mean.copy(), other.m2.copy())
+            return self
+        assert(len(self.mean) == len(other.mean))
+
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * (other.count / count)
+        self.m2 = self.m2 + other.m2 + delta ** 2 * (self.count * other.count / count)
+        self.min = np.minimum(self.min, other.min)
+        self.max = np.maximum(self.max, other.max)
+        self.count = count
+        return self
+
+    @property
+    def variance(self):
+        """The population variance of each attribute"""
+        return self.m2 / self.count
 
-    for pat in patterns:
-        for i in range(pattern_length):
-            if pat[i] < min_values[i]:
-                min_values[i] = pat[i]
-            if pat[i] > max_values[i]:
-                max_values[i] = pat[i]
+    @property
+    def std(self):
+        return np.sqrt(self.variance)
 
-    return list(zip(min_values, max_values))
+    def min_max(self):
+        """The min and max values of each attribute, as `get_min_max_values` gives"""
+        assert(self.count > 0)
+        return list(zip(self.min.tolist(), self.max.tolist()))
+
+    @classmethod
+    def from_patterns(cls, patterns, chunk_size=STATS_CHUNK_SIZE):
+        """Stats of a list or array of patterns, taken a chunk at a time so that
+        a list is never converted all at once"""
+        stats = cls()
+        for start in range(0, len(patterns), chunk_size):
+            stats.update(patterns[start:start+chunk_size])
+        return stats
+
+    @classmethod
+    def from_chunks(cls, chunks):
+        """Stats of the patterns in an iterable of chunks, e.g. read from a file"""
+        stats = cls()
+        for chunk in chunks:
+            stats.update(chunk)
+        return stats
 
 def save_patterns_file(key_patterns, value_patterns, file_path):
+    # Encoders may give arrays, which json can't serialize
+    if isinstance(key_patterns, np.ndarray):
+        key_patterns = key_patterns.tolist()
+    if isinstance(value_patterns, np.ndarray):
+        value_patterns = value_patterns.tolist()
     data = [[k,v] for (k,v) in zip(key_patterns, value_patterns)]
     with open(file_path, 'w') as f:
         f.write("[\n")
@@ -48,13 +141,235 @@ def load_patterns_file(file_path):
     assert(type(patterns[0]) == list)
     return patterns
 
+def load_pattern_arrays(file_path, start=0, stop=None, mmap_mode="r"):
+    """Loads the pairs [start, stop) of a patterns file as key and value
+    arrays. A binary patterns file is memory mapped, so only the pairs which
+    are used are read from disk.
+    Returns:
+        tuple(np.ndarray, np.ndarray): the (n, key_size) keys and (n, value_size) values
+    """
+    if is_binary_file(file_path, PATTERNS_MAGIC):
+        _, keys, values = load_patterns_binary_file(file_path, mmap_mode)
+        return keys[start:stop], values[start:stop]
+    patterns = load_patterns_file(file_path)[start:stop]
+    return (np.array([pair[0] for pair in patterns]),
+            np.array([pair[1] for pair in patterns]))
+
+def save_patterns_binary_file(key_patterns, value_patterns, file_path, metadata=None):
+    """Writes key and value patterns as a binary patterns file. The keys and
+    values are stored as separate blocks, each with the dtype of its array, so
+    integer patterns (e.g. one-hot classes) stay integers.
+    Args:
+        metadata (dict): extra JSON serializable information to keep in the header
+    """
+    keys = np.asarray(key_patterns)
+    values = np.asarray(value_patterns)
+    assert(keys.ndim == 2 and values.ndim == 2 and len(keys) == len(values))
+
+    # Pad the keys so that the values block is aligned too
+    keys_bytes = keys.size * keys.dtype.itemsize
+    padding = np.zeros(-keys_bytes % BINARY_FILE_ALIGNMENT, dtype=np.uint8)
+    header = {
+        "count": keys.shape[0],
+        "key_size": keys.shape[1],
+        "value_size": values.shape[1],
+        "key_dtype": keys.dtype.str,
+        "value_dtype": values.dtype.str,
+        "values_offset": keys_bytes + padding.size,
+        "metadata": metadata or {},
+    }
+    write_binary_file(file_path, PATTERNS_MAGIC, header, [keys, padding, values])
+
+def load_patterns_binary_file(file_path, mmap_mode="r"):
+    """Opens a binary patterns file
+    Args:
+        mmap_mode (str): passed to np.memmap, or None to read the arrays into memory
+    Returns:
+        tuple(dict, np.ndarray, np.ndarray): the header, and the (count, key_size)
+            keys and (count, value_size) values
+    """
+    header, offset = read_binary_file_header(file_path, PATTERNS_MAGIC)
+    count = header["count"]
+    arrays = []
+    for (part, part_offset) in [("key", 0), ("value", header["values_offset"])]:
+        dtype = np.dtype(header[part + "_dtype"])
+        shape = (count, header[part + "_size"])
+        if mmap_mode is None:
+            with open(file_path, 'rb') as f:
+                f.seek(offset + part_offset)
+                arrays.append(np.fromfile(f, dtype=dtype, count=shape[0] * shape[1]).reshape(shape))
+        else:
+            arrays.append(np.memmap(file_path, dtype=dtype, mode=mmap_mode,
+                                    offset=offset + part_offset, shape=shape))
+    return header, arrays[0], arrays[1]
+
+def convert_patterns_json(json_path, output_path):
+    """Converts a [[key, value], ...] JSON patterns file to a binary patterns file"""
+    keys, values = load_pattern_arrays(json_path)
+    save_patterns_binary_file(keys, values, output_path, {"source": os.path.abspath(json_path)})
+
+def load_patterns_csv(csv_path, class_index=-1, classes=None):
+    """Loads a CSV file of attributes and a class label per line, as in the
+    iris and MNIST data. The keys are the attributes and the values are the
+    classes encoded one-hot.
+    Args:
+        class_index (int): the column holding the class label
+        classes (list(str)): the labels in one-hot order. By default the labels
+            which appear, sorted numerically if they are all numbers.
+    Returns:
+        tuple(np.ndarray, np.ndarray, list(str)): the (n, num_attrs) keys, the
+            (n, num_classes) values and the class labels
+    """
+    rows = []
+    labels = []
+    with open(csv_path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if len(line) == 0:
+                continue
+            items = line.split(",")
+            labels.append(items.pop(class_index).strip())
+            rows.append(items)
+    keys = np.array(rows, dtype=np.float64)
+
+    if classes is None:
+        classes = sorted(set(labels))
+        try:
+            classes.sort(key=float)
+        except ValueError:
+            pass
+    class_indices = {label: i for (i, label) in enumerate(classes)}
+    values = np.zeros((len(labels), len(classes)), dtype=np.int64)
+    values[np.arange(len(labels)), [class_indices[label] for label in labels]] = 1
+    return keys, values, classes
+
+def convert_patterns_csv(csv_path, output_path, class_index=-1, classes=None):
+    """Converts a CSV file of attributes and class labels to a binary patterns
+    file, see `load_patterns_csv`"""
+    keys, values, classes = load_patterns_csv(csv_path, class_index, classes)
+    save_patterns_binary_file(keys, values, output_path,
+                              {"source": os.path.abspath(csv_path), "classes": classes})
+
 def create_cmm_input_file(key_patterns, value_patterns, file_path):
     key_size = len(key_patterns[0])
     value_size = len(value_patterns[0])
+    keys = np.asarray(key_patterns)
+    values = np.asarray(value_patterns)
+
     with open(file_path, 'w') as f:
         f.write("{0}\n{1}\n".format(key_size, value_size))
+        if is_binary_int_array(keys) and is_binary_int_array(values):
+            f.write(format_binary_rows(keys, values).decode("ascii"))
+            return
+
         for (k,v) in zip(key_patterns, value_patterns):
             f.write(",".join(map(str, k)))
             f.write(":")
             f.write(",".join(map(str, v)))
             f.write("\n")
+
+def is_binary_int_array(arr):
+    """True if arr is a 2D array of integers which are all 0 or 1"""
+    return (arr.ndim == 2 and arr.dtype.kind in "iub"
+            and np.all((arr == 0) | (arr == 1)))
+
+def format_binary_rows(keys, values):
+    """Formats binary key and value rows as "k,k,k:v,v\n" lines without any
+    per-element string conversion
+    Args:
+        keys (np.ndarray): (n, key_size) array of 0s and 1s
+        values (np.ndarray): (n, value_size) array of 0s and 1s
+    Returns:
+        bytes: the formatted lines
+    """
+    rows = np.hstack([keys, values]).astype(np.uint8)
+    n, width = rows.shape
+    # Each element is a digit followed by a separator
+    chars = np.empty(shape=(n, width * 2), dtype=np.uint8)
+    chars[:, 0::2] = rows + ord("0")
+    chars[:, 1::2] = ord(",")
+    chars[:, keys.shape[1] * 2 - 1] = ord(":")
+    chars[:, -1] = ord("\n")
+    return chars.tobytes()
+
+def write_binary_file(file_path, magic, header, arrays):
+    """Writes a binary file made up of a header and a series of arrays
+    Args:
+        file_path (str): path to the file to write
+        magic (bytes): 8 bytes identifying the type of file
+        header (dict): JSON serializable metadata
+        arrays (list(np.ndarray)): arrays written one after another as raw bytes
+    """
+    header_bytes = json.dumps(header).encode("utf-8")
+    prefix_size = len(magic) + 4 + len(header_bytes)
+    padding = -prefix_size % BINARY_FILE_ALIGNMENT
+
+    with open(file_path, 'wb') as f:
+        f.write(magic)
+        f.write(np.uint32(len(header_bytes) + padding).tobytes())
+        f.write(header_bytes)
+        f.write(b" " * padding)
+        for arr in arrays:
+            f.write(np.ascontiguousarray(arr).tobytes())
+
+def is_binary_file(file_path, magic):
+    with open(file_path, 'rb') as f:
+        return f.read(len(magic)) == magic
+
+def read_binary_file_header(file_path, magic):
+    """Reads the header of a file written by `write_binary_file`
+    Returns:
+        tuple(dict, int): the header and the offset at which the arrays start
+    """
+    with open(file_path, 'rb') as f:
+        if f.read(len(magic)) != magic:
+            raise ValueError("Unexpected file type: " + file_path)
+        header_size = int(np.frombuffer(f.read(4), dtype=np.uint32)[0])
+        header = json.loads(f.read(header_size).decode("utf-8"))
+    return header, len(magic) + 4 + header_size
+
+def map_binary_file(file_path, offset, size, mmap_mode="r"):
+    """Returns `size` bytes of a file starting at `offset` as a uint8 array
+    Args:
+        mmap_mode (str): passed to np.memmap, or None to read the bytes into memory
+    """
+    if mmap_mode is None:
+        with open(file_path, 'rb') as f:
+            f.seek(offset)
+            return np.fromfile(f, dtype=np.uint8, count=size)
+    else:
+        return np.memmap(file_path, dtype=np.uint8, mode=mmap_mode, offset=offset, shape=(size,))
+
+def create_cmm_input_binary_file(key_patterns, value_patterns, file_path):
+    """Writes binary key and value patterns as a binary cmm input file, with
+    the keys and values each packed into bits
+    """
+    keys = np.asarray(key_patterns)
+    values = np.asarray(value_patterns)
+    assert(np.all((keys == 0) | (keys == 1)) and np.all((values == 0) | (values == 1)))
+
+    header = {
+        "key_size": keys.shape[1],
+        "data_size": values.shape[1],
+        "count": keys.shape[0],
+    }
+    write_binary_file(file_path, CMM_INPUT_MAGIC, header,
+                      [np.packbits(keys != 0, axis=1), np.packbits(values != 0, axis=1)])
+
+def load_cmm_input_binary_file(file_path, mmap_mode="r"):
+    """Opens a binary cmm input file without unpacking it
+    Returns:
+        tuple(int, int, np.ndarray, np.ndarray): the key size, data size and the
+            (count, words) packed keys and data
+    """
+    header, offset = read_binary_file_header(file_path, CMM_INPUT_MAGIC)
+    key_size = header["key_size"]
+    data_size = header["data_size"]
+    count = header["count"]
+    key_words = (key_size + 7) // 8
+    data_words = (data_size + 7) // 8
+
+    contents = map_binary_file(file_path, offset, count * (key_words + data_words), mmap_mode)
+    keys = contents[:count * key_words].reshape(count, key_words)
+    data = contents[count * key_words:].reshape(count, data_words)
+    return key_size, data_size, keys, data
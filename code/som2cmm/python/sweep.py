@@ -0,0 +1,179 @@
+"""Runs an experiment over a grid of parameter values.
+
+A sweep file names a base experiment config and the values to try for any of
+its settings, given by dotted paths into the config:
+
+    base_config = "config.toml"
+    working_directory = "/tmp/mnist_sweep"
+    processes = 4
+
+    [axes]
+    num_patterns = [100, 200, 500, 1000]
+    "cmm.threshold_func" = ["lmax1", "willshaw"]
+    "cmm.smart_recall" = [true, false]
+    "encoding.keys.method" = ["som", "baum"]
+
+Every combination of the axes' values is run in its own directory under the
+sweep's working directory, on a pool of processes. Points which only differ in
+their [cmm] settings share their parsed and encoded patterns, which are
+computed once before the pool starts (or taken from the encoding cache if the
+base config has a [cache] table) and given to each worker process once.
+sweep_results.json collects the parameters and stats of every point.
+"""
+import argparse
+import concurrent.futures
+import copy
+import itertools
+import json
+import logging
+import os
+import os.path
+import re
+
+import toml
+
+import main
+
+log = logging.getLogger("som2cmm")
+
+# The encoded patterns of each group of points, set in each worker process by
+# init_worker so that they are sent to a worker once rather than with every point
+_worker_encoded = {}
+
+def set_config_value(config, path, value):
+    """Sets the value at a dotted path such as "cmm.threshold_func", creating
+    any missing tables on the way"""
+    keys = path.split(".")
+    for key in keys[:-1]:
+        config = config.setdefault(key, {})
+    config[keys[-1]] = value
+
+def point_name(params):
+    """A directory name for a point, e.g. "threshold_func=lmax1,smart_recall=True" """
+    parts = []
+    for (path, value) in params:
+        value = os.path.splitext(os.path.basename(value))[0] if isinstance(value, str) and os.sep in value else value
+        parts.append("{}={}".format(path.split(".")[-1], value))
+    return re.sub(r"[^A-Za-z0-9_.,=+-]", "_", ",".join(parts))
+
+def expand_grid(base_config, axes, working_directory):
+    """Expands the axes into one config for each point of the grid
+    Args:
+        base_config (dict): the experiment config the points are based on
+        axes (dict): maps dotted config paths to the list of values to try
+        working_directory (str): directory holding each point's directory
+    Returns:
+        list(tuple(list, dict)): the (path, value) parameters and config of each point
+    """
+    paths = list(axes.keys())
+    points = []
+    for values in itertools.product(*[axes[path] for path in paths]):
+        params = list(zip(paths, values))
+        config = copy.deepcopy(base_config)
+        for (path, value) in params:
+            set_config_value(config, path, value)
+        config["working_directory"] = os.path.join(working_directory, point_name(params) or "base")
+        points.append((params, config))
+    return points
+
+def encoding_key(config):
+    """Points with the same encoding key have the same encoded patterns"""
+    return json.dumps([config["input_patterns_file"], config.get("num_patterns", None),
+                       config["encoding"]], sort_keys=True)
+
+def encode_points(points):
+    """Parses and encodes the patterns once for each group of points that share
+    them
+    Returns:
+        dict: the encoded patterns, keyed by `encoding_key`
+    """
+    patterns_cache = {}
+    encoded = {}
+    for (params, config) in points:
+        key = encoding_key(config)
+        if key not in encoded:
+            log.info("Encoding patterns for %s", config["working_directory"])
+            encoded[key] = main.load_encoded_patterns(config, patterns_cache)
+    return encoded
+
+def init_worker(encoded):
+    """Runs at the start of each worker process"""
+    global _worker_encoded
+    _worker_encoded = encoded
+
+def run_point(config):
+    """Runs one point of the sweep in its own directory. Runs in a worker process.
+    Returns:
+        dict: the point's stats
+    """
+    encoded = _worker_encoded[encoding_key(config)]
+    os.makedirs(config["working_directory"], exist_ok=True)
+    os.chdir(config["working_directory"])
+    with open("config.copy.toml", 'w') as f:
+        toml.dump(config, f)
+
+    # Each point logs to its own debug.log
+    for handler in list(log.handlers):
+        log.removeHandler(handler)
+        handler.close()
+    main.setup_logging()
+
+    main.run_encoded_experiment(config, *encoded)
+    with open("stats.json", 'r') as f:
+        return json.load(f)
+
+def run_sweep(sweep, sweep_dir=".", processes=None):
+    """Runs every point of a sweep
+    Args:
+        sweep (dict): the sweep config, see the module docstring
+        sweep_dir (str): directory relative paths in the sweep config are from
+        processes (int): size of the process pool, overriding the sweep config
+    Returns:
+        list(dict): the parameters, directory and stats of each point
+    """
+    base_config = toml.load(os.path.join(sweep_dir, sweep["base_config"]))
+    working_directory = os.path.abspath(os.path.join(sweep_dir, sweep["working_directory"]))
+    points = expand_grid(base_config, sweep.get("axes", {}), working_directory)
+    for (params, config) in points:
+        main.validate_config(config)
+    log.info("Sweep of %d points in %s", len(points), working_directory)
+
+    encoded = encode_points(points)
+    processes = processes or sweep.get("processes", None) or os.cpu_count()
+
+    results = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes, initializer=init_worker,
+                                                initargs=(encoded,)) as pool:
+        futures = [pool.submit(run_point, config) for (params, config) in points]
+        for ((params, config), future) in zip(points, futures):
+            stats = future.result()
+            log.info("Done %s: %s", config["working_directory"], stats)
+            results.append({
+                "params": dict(params),
+                "working_directory": config["working_directory"],
+                "stats": stats,
+                })
+
+    with open(os.path.join(working_directory, "sweep_results.json"), 'w') as f:
+        f.write(json.dumps(results, indent=4, sort_keys=True))
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("sweep_file", help="Path to the sweep's .toml file")
+    parser.add_argument("--processes", type=int, help="How many experiments to run at once")
+    parser.add_argument("--dry-run", action="store_true", help="Only list the points of the sweep")
+    args = parser.parse_args()
+
+    assert(os.path.isfile(args.sweep_file))
+    sweep = toml.load(args.sweep_file)
+    sweep_dir = os.path.dirname(os.path.abspath(args.sweep_file))
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    if args.dry_run:
+        base_config = toml.load(os.path.join(sweep_dir, sweep["base_config"]))
+        working_directory = os.path.abspath(os.path.join(sweep_dir, sweep["working_directory"]))
+        for (params, config) in expand_grid(base_config, sweep.get("axes", {}), working_directory):
+            print(config["working_directory"])
+    else:
+        run_sweep(sweep, sweep_dir, args.processes)
@@ -0,0 +1,51 @@
+import unittest
+
+from .context import som2cmm
+import benchmark
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_run_and_compare(self):
+        datasets = [d for d in benchmark.load_datasets([200]) if d[0] == "synthetic200"]
+        results = benchmark.run_benchmarks(datasets, max_calls=20, repeats=1, min_time=0)
+        for name in ["CMM.insert", "CMM.recall", "CMM.recall_smart", "QuantizationEncoder.encodeAll",
+                     "BaumEncoder.decodeAll", "SOMEncoder.decodeAll", "SOM.findBMU", "SOM.loadFromFile"]:
+            self.assertIn(name + "[synthetic200]", results["results"])
+        self.assertEqual(results["results"]["CMM.insert[synthetic200]"]["items"], 20)
+        self.assertEqual(results["results"]["CMM.insert_many[synthetic200]"]["items"], 200)
+
+        baseline = {"results": {
+            "fast": {"seconds": 1.0}, "slow": {"seconds": 1.0}, "noise": {"seconds": 0.0001}}}
+        now = {"results": {
+            "fast": {"seconds": 1.2}, "slow": {"seconds": 1.5}, "noise": {"seconds": 0.0005}, "new": {"seconds": 1.0}}}
+        comparison = benchmark.compare_results(now, baseline, tolerance=0.25)
+        self.assertEqual([(name, regressed) for (name, _, _, regressed) in comparison],
+                         [("fast", False), ("noise", False), ("slow", True)])
+
+        (seconds, runs) = benchmark.time_best(lambda _: None, repeats=2)
+        self.assertEqual(runs, 2)
+        (seconds, runs) = benchmark.time_best(lambda _: None, repeats=2, min_time=0.01, max_runs=50)
+        self.assertEqual(runs, 50)
+
+        del now["results"]["fast"]
+        self.assertEqual(benchmark.missing_results(now, baseline), ["fast"])
+
+        self.assertTrue(benchmark.same_environment(results, results))
+        other = dict(results, environment=dict(results["environment"], cpu_count=-1))
+        self.assertFalse(benchmark.same_environment(results, other))
+
+    def test_missing_with_fewer_scales(self):
+        # A baseline of two scales, compared against a run of just the smaller one
+        datasets = [d for d in benchmark.load_datasets([100, 200]) if d[0].startswith("synthetic")]
+        baseline = benchmark.run_benchmarks(datasets, max_calls=10, repeats=1, min_time=0)
+        now = benchmark.run_benchmarks(datasets[:1], max_calls=10, repeats=1, min_time=0)
+        requested = benchmark.dataset_names([100])
+        self.assertEqual(requested, ["iris", "mnist1000", "synthetic100"])
+        self.assertEqual(benchmark.missing_results(now, baseline, requested), [])
+        self.assertEqual(len(benchmark.missing_results(now, baseline)), len(now["results"]))
+
+        # A dropped benchmark or a missing data file still count
+        del now["results"]["CMM.insert[synthetic100]"]
+        baseline["results"]["CMM.insert[iris]"] = {"seconds": 0.01}
+        self.assertEqual(benchmark.missing_results(now, baseline, requested),
+                         ["CMM.insert[iris]", "CMM.insert[synthetic100]"])
@@ -1,7 +1,15 @@
+import json
+import os
+import tempfile
 import unittest
+import numpy as np
 
 from .context import som2cmm
 import som2cmm.cmm as cmm
+import som2cmm.sharded as sharded
+import som2cmm.storage as storage
+import som2cmm.threshold as threshold
+import som2cmm.utils as utils
 
 class TestCMM(unittest.TestCase):
 
@@ -20,3 +28,301 @@ class TestCMM(unittest.TestCase):
         mat[2,2] = 1
         expected = "100\n010\n001"
         self.assertEqual(cmm.binary_mat_to_str(mat), expected)
+
+    def test_packed_storage_matches_dense(self):
+        np.random.seed(0)
+        key_size, data_size, bits_in_key = 37, 11, 3
+        dense = cmm.CMM(key_size, data_size, bits_in_key, "lmax2")
+        packed = cmm.CMM(key_size, data_size, bits_in_key, "lmax2", storage_kind="packed")
+
+        keys = []
+        for _ in range(20):
+            key_vec = random_binary_vector(key_size, bits_in_key)
+            data_vec = random_binary_vector(data_size, 2)
+            dense.insert(key_vec, data_vec)
+            packed.insert(key_vec, data_vec)
+            keys.append(key_vec)
+
+        self.assertEqual(dense.serialize_mem(), packed.serialize_mem())
+        for key_vec in keys:
+            np.testing.assert_array_equal(dense.recall_basic(key_vec),
+                                          packed.recall_basic(key_vec))
+
+    def test_insert_many_matches_insert(self):
+        np.random.seed(1)
+        key_size, data_size, bits_in_key = 40, 9, 2
+        keys = np.hstack([random_binary_vector(key_size, bits_in_key) for _ in range(30)]).T
+        data = np.hstack([random_binary_vector(data_size, 1) for _ in range(30)]).T
+
+        for storage_kind in ["dense", "packed"]:
+            one_by_one = cmm.CMM(key_size, data_size, bits_in_key, "lmax1", storage_kind=storage_kind)
+            batched = cmm.CMM(key_size, data_size, bits_in_key, "lmax1", storage_kind=storage_kind)
+            for (key_vec, data_vec) in zip(keys, data):
+                one_by_one.insert(key_vec.reshape(-1, 1), data_vec.reshape(-1, 1))
+            batched.insert_many(keys, data)
+
+            self.assertEqual(one_by_one.serialize_mem(), batched.serialize_mem())
+            self.assertEqual(len(batched.recorded_data_items), len(np.unique(data, axis=0)))
+
+    def test_threshold_lmax_breaks_ties_by_index(self):
+        sums = np.array([[1, 3, 3, 0, 3],
+                         [2, 2, 2, 2, 2],
+                         [0, 0, 5, 1, 0]], dtype=float)
+        expected = np.array([[0, 1, 1, 0, 0],
+                             [1, 1, 0, 0, 0],
+                             [0, 0, 1, 1, 0]], dtype=float)
+        np.testing.assert_array_equal(threshold.threshold_lmax(sums, 2), expected)
+
+    def test_threshold_willshaw(self):
+        sums = np.array([[3, 2, 3, 0],
+                         [1, 1, 1, 1]], dtype=float)
+        willshaw = threshold.create_threshold("willshaw", 3)
+        np.testing.assert_array_equal(willshaw(sums), [[1, 0, 1, 0],
+                                                       [0, 0, 0, 0]])
+
+    def test_threshold_segment_lwta(self):
+        sums = np.array([[1, 3, 0, 2, 2, 0, 5],
+                         [0, 0, 4, 1, 0, 2, 1]], dtype=float)
+        lwta = threshold.create_threshold("lwta1", 2, segment_sizes=[3, 4])
+        np.testing.assert_array_equal(lwta(sums), [[0, 1, 0, 0, 0, 0, 1],
+                                                   [0, 0, 1, 0, 0, 1, 0]])
+
+        equal_segments = threshold.create_threshold("lwta1", 2, segment_sizes=[2, 2])
+        np.testing.assert_array_equal(equal_segments(np.array([[1., 2., 2., 2.]])),
+                                      [[0, 1, 1, 0]])
+
+    def test_threshold_parsing(self):
+        self.assertEqual(threshold.create_threshold("lmax12", 2).L, 12)
+        with self.assertRaises(ValueError):
+            threshold.create_threshold("lwta1", 2)
+        with self.assertRaises(ValueError):
+            threshold.create_threshold("unknown", 2)
+
+    def test_recall_batch_matches_recall(self):
+        np.random.seed(2)
+        key_size, data_size, bits_in_key = 30, 12, 2
+        keys = np.hstack([random_binary_vector(key_size, bits_in_key) for _ in range(25)]).T
+        data = np.hstack([random_binary_vector(data_size, 2) for _ in range(25)]).T
+
+        for storage_kind in ["dense", "packed"]:
+            mem = cmm.CMM(key_size, data_size, bits_in_key, "lmax2", storage_kind=storage_kind)
+            mem.insert_many(keys, data)
+            for smart in [False, True]:
+                batch = mem.recall_batch(keys, smart=smart)
+                for (key_vec, recalled) in zip(keys, batch):
+                    single = mem.recall(key_vec.reshape(-1, 1), smart=smart)
+                    np.testing.assert_array_equal(single[:, 0], recalled)
+
+    def test_index_keys_match_vector_keys(self):
+        np.random.seed(3)
+        key_size, data_size, bits_in_key = 50, 10, 3
+        keys = np.hstack([random_binary_vector(key_size, bits_in_key) for _ in range(20)]).T
+        data = np.hstack([random_binary_vector(data_size, 2) for _ in range(20)]).T
+        key_indices = cmm.keys_to_indices(keys)
+        self.assertEqual(key_indices.shape, (20, bits_in_key))
+
+        for storage_kind in ["dense", "packed"]:
+            by_vector = cmm.CMM(key_size, data_size, bits_in_key, "lmax2", storage_kind=storage_kind)
+            by_index = cmm.CMM(key_size, data_size, bits_in_key, "lmax2", storage_kind=storage_kind)
+            by_vector.insert_many(keys, data)
+            for (indices, data_vec) in zip(key_indices, data):
+                by_index.insert_indices(indices, data_vec.reshape(-1, 1))
+
+            self.assertEqual(by_vector.serialize_mem(), by_index.serialize_mem())
+            np.testing.assert_array_equal(by_vector.recall_batch(keys),
+                                          by_index.recall_indices_batch(key_indices))
+            np.testing.assert_array_equal(by_vector.recall_basic(keys[0].reshape(-1, 1)),
+                                          by_index.recall_indices(key_indices[0]))
+
+    def test_recorded_items_are_deduplicated(self):
+        items = storage.RecordedItems(4)
+        items.add_many(np.array([[0, 1, 0, 0],
+                                 [1, 0, 0, 0],
+                                 [0, 1, 0, 0]]))
+        items.add(np.array([[1], [0], [0], [0]]))
+        items.add(np.array([[0], [0], [1], [1]]))
+        self.assertEqual(len(items), 3)
+        np.testing.assert_array_equal(items.items(), [[0, 1, 0, 0],
+                                                      [1, 0, 0, 0],
+                                                      [0, 0, 1, 1]])
+
+    def test_recorded_items_from_packed(self):
+        packed = np.packbits(np.array([[0, 1, 0, 0], [1, 0, 0, 0]], dtype=np.uint8), axis=1)
+        items = storage.RecordedItems.from_packed(packed, 4)
+        self.assertIs(items.packed(), packed)
+        self.assertEqual(len(items), 2)
+
+        # Adding builds the index, so duplicates of the loaded items are skipped
+        items.add_many(np.array([[1, 0, 0, 0], [0, 0, 1, 1]]))
+        np.testing.assert_array_equal(items.items(), [[0, 1, 0, 0],
+                                                      [1, 0, 0, 0],
+                                                      [0, 0, 1, 1]])
+
+    def test_recorded_items_nearest(self):
+        items = storage.RecordedItems(4)
+        items.add_many(np.array([[0, 1, 0, 0],
+                                 [1, 0, 0, 0],
+                                 [0, 0, 1, 1]]))
+        queries = np.array([[1, 0, 0, 0],
+                            [0, 0, 1, 0],
+                            [1, 1, 0, 0],
+                            [1, 1, 1, 1]])
+        expected = [[1, 0, 0, 0],
+                    [0, 0, 1, 1],
+                    [0, 1, 0, 0],
+                    [0, 0, 1, 1]]
+        np.testing.assert_array_equal(items.nearest(queries), expected)
+
+    def test_save_and_load(self):
+        np.random.seed(4)
+        key_size, data_size, bits_in_key = 45, 13, 3
+        keys = np.hstack([random_binary_vector(key_size, bits_in_key) for _ in range(20)]).T
+        data = np.hstack([random_binary_vector(data_size, 2) for _ in range(20)]).T
+        original = cmm.CMM(key_size, data_size, bits_in_key, "lmax2")
+        original.insert_many(keys, data)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "cmm.bin")
+            original.save(path)
+
+            for (mmap_mode, storage_kind) in [("r", "packed"), (None, "dense")]:
+                loaded = cmm.CMM.load(path, mmap_mode=mmap_mode, storage_kind=storage_kind)
+                self.assertEqual((loaded.key_size(), loaded.data_size()), (key_size, data_size))
+                self.assertEqual(loaded.threshold_func, "lmax2")
+                self.assertEqual(loaded.serialize_mem(), original.serialize_mem())
+                np.testing.assert_array_equal(loaded.recall_batch(keys, smart=True),
+                                              original.recall_batch(keys, smart=True))
+                del loaded
+
+    def test_sharded_matches_single_process(self):
+        np.random.seed(5)
+        key_size, data_size, bits_in_key = 33, 17, 2
+        keys = np.hstack([random_binary_vector(key_size, bits_in_key) for _ in range(20)]).T
+        data = np.hstack([random_binary_vector(data_size, 3) for _ in range(20)]).T
+
+        single = cmm.CMM(key_size, data_size, bits_in_key, "lmax3")
+        single.insert_many(keys[:10], data[:10])
+        for (key_vec, data_vec) in zip(keys[10:], data[10:]):
+            single.insert(key_vec.reshape(-1, 1), data_vec.reshape(-1, 1))
+
+        with sharded.ShardedCMM(key_size, data_size, bits_in_key, "lmax3", num_shards=3) as mem:
+            mem.insert_many(keys[:10], data[:10])
+            for (key_vec, data_vec) in zip(keys[10:], data[10:]):
+                mem.insert(key_vec.reshape(-1, 1), data_vec.reshape(-1, 1))
+
+            self.assertEqual(mem.serialize_mem(), single.serialize_mem())
+            np.testing.assert_array_equal(mem.recall_batch(keys), single.recall_batch(keys))
+            np.testing.assert_array_equal(mem.recall_indices_batch(cmm.keys_to_indices(keys), smart=True),
+                                          single.recall_batch(keys, smart=True))
+            np.testing.assert_array_equal(mem.recall(keys[0].reshape(-1, 1)),
+                                          single.recall(keys[0].reshape(-1, 1)))
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "cmm.bin")
+            single.save(path)
+            for storage_kind in ["packed", "dense"]:
+                with sharded.ShardedCMM.load(path, storage_kind=storage_kind, num_shards=2) as loaded:
+                    self.assertEqual(loaded.serialize_mem(), single.serialize_mem())
+                    np.testing.assert_array_equal(loaded.recall_batch(keys, smart=True),
+                                                  single.recall_batch(keys, smart=True))
+                    loaded.insert_many(keys[:1], data[:1])
+
+    def test_iter_input_chunks(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "cmm_input.txt")
+            with open(path, 'w') as f:
+                f.write("4\n2\n")
+                for i in range(5):
+                    key = [0, 0, 0, 0]
+                    key[i % 4] = 1
+                    f.write(",".join(map(str, key)) + ":" + "{},1\n".format(i % 2))
+
+            chunks = list(cmm.iter_input_chunks(path, 2))
+            self.assertEqual([len(keys) for (keys, data) in chunks], [2, 2, 1])
+            keys = np.vstack([keys for (keys, data) in chunks])
+            data = np.vstack([data for (keys, data) in chunks])
+
+            key_size, data_size, pairs = cmm.parse_input_file(path)
+            np.testing.assert_array_equal(keys, np.hstack([k for (k, d) in pairs]).T)
+            np.testing.assert_array_equal(data, np.hstack([d for (k, d) in pairs]).T)
+
+    def test_input_file_formats(self):
+        np.random.seed(6)
+        keys = np.hstack([random_binary_vector(12, 2) for _ in range(9)]).T.astype(int)
+        values = np.hstack([random_binary_vector(3, 1) for _ in range(9)]).T.astype(int)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            text_path = os.path.join(tmp_dir, "cmm_input.txt")
+            binary_path = os.path.join(tmp_dir, "cmm_input.bin")
+            utils.create_cmm_input_file(keys.tolist(), values.tolist(), text_path)
+            utils.create_cmm_input_binary_file(keys, values, binary_path)
+
+            with open(text_path, 'r') as f:
+                lines = f.read().splitlines()
+            self.assertEqual(lines[:2], ["12", "3"])
+            self.assertEqual(lines[2], ",".join(map(str, keys[0])) + ":" + ",".join(map(str, values[0])))
+
+            for path in [text_path, binary_path]:
+                key_size, data_size, loaded_keys, loaded_data = cmm.load_input_file(path)
+                self.assertEqual((key_size, data_size), (12, 3))
+                np.testing.assert_array_equal(loaded_keys, keys)
+                np.testing.assert_array_equal(loaded_data, values)
+
+                chunks = list(cmm.iter_input_chunks(path, 4))
+                self.assertEqual([len(k) for (k, d) in chunks], [4, 4, 1])
+                np.testing.assert_array_equal(np.vstack([k for (k, d) in chunks]), keys)
+
+    def test_run_experiment_chunked(self):
+        np.random.seed(8)
+        keys = np.hstack([random_binary_vector(20, 2) for _ in range(15)]).T.astype(np.uint8)
+        values = np.hstack([random_binary_vector(6, 1) for _ in range(15)]).T.astype(np.uint8)
+        config = {"threshold_func": "lmax1", "smart_recall": False}
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            input_path = os.path.join(tmp_dir, "cmm_input.txt")
+            utils.create_cmm_input_file(keys, values, input_path)
+            whole_dir = os.path.join(tmp_dir, "whole")
+            chunked_dir = os.path.join(tmp_dir, "chunked")
+            os.mkdir(whole_dir)
+            os.mkdir(chunked_dir)
+            whole = cmm.run_experiment(input_path, whole_dir, 2, config)
+            chunked = cmm.run_experiment(input_path, chunked_dir, 2, dict(config, chunk_size=4))
+
+            self.assertIsInstance(chunked, np.memmap)
+            np.testing.assert_array_equal(chunked, whole)
+            with open(os.path.join(whole_dir, "cmm_results.txt")) as f1, \
+                 open(os.path.join(chunked_dir, "cmm_results.txt")) as f2:
+                self.assertEqual(f1.read(), f2.read())
+            with open(os.path.join(whole_dir, "cmm_stats.json")) as f1, \
+                 open(os.path.join(chunked_dir, "cmm_stats.json")) as f2:
+                whole_stats = json.load(f1)
+                chunked_stats = json.load(f2)
+            self.assertEqual(chunked_stats["correct"], whole_stats["correct"])
+            self.assertEqual(chunked_stats["wrong"], whole_stats["wrong"])
+            self.assertAlmostEqual(chunked_stats["mean bits wrong"], whole_stats["mean bits wrong"])
+            self.assertAlmostEqual(chunked_stats["stdev bits wrong"], whole_stats["stdev bits wrong"])
+            del chunked
+
+    def test_run_experiment_in_memory(self):
+        np.random.seed(7)
+        keys = np.hstack([random_binary_vector(20, 2) for _ in range(15)]).T.astype(np.uint8)
+        values = np.hstack([random_binary_vector(6, 1) for _ in range(15)]).T.astype(np.uint8)
+        config = {"threshold_func": "lmax1", "smart_recall": True}
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            input_path = os.path.join(tmp_dir, "cmm_input.txt")
+            utils.create_cmm_input_file(keys, values, input_path)
+            from_file = cmm.run_experiment(input_path, tmp_dir, 2, config)
+            self.assertTrue(os.path.isfile(os.path.join(tmp_dir, "cmm_results.txt")))
+
+            mem_dir = os.path.join(tmp_dir, "in_memory")
+            os.mkdir(mem_dir)
+            in_memory = cmm.run_experiment_arrays(keys, values, mem_dir, 2,
+                    dict(config, save_results=False, save_stats=False, mem_format="none"))
+            np.testing.assert_array_equal(in_memory, from_file)
+            self.assertEqual(os.listdir(mem_dir), [])
+
+def random_binary_vector(size, bits):
+    vec = cmm.create_vector(size)
+    vec[np.random.choice(size, bits, replace=False), 0] = 1
+    return vec
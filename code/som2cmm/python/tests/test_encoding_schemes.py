@@ -1,9 +1,13 @@
+import os
+import tempfile
 import unittest
 import numpy as np
 
 from .context import som2cmm
+import som2cmm.cache as cache
 import som2cmm.encoding_schemes as enc
 import som2cmm.cmm as cmm
+import som2cmm.utils as utils
 
 class TestQuantizationEncoder(unittest.TestCase):
     test_cases = [
@@ -108,6 +112,107 @@ class TestQuantizationEncoder(unittest.TestCase):
             self.assertEqual(decode1, pat)
             self.assertEqual(decode2, pat)
 
+    def test_code_table_matches_new_quantize(self):
+        for (bits_len, bits_set) in [(5, 1), (5, 2), (5, 3), (8, 4)]:
+            table = enc.quantize_code_table(bits_len, bits_set)
+            for (bin_used, code) in enumerate(table):
+                self.assertEqual(code.tolist(), enc.new_quantize(bits_len, bits_set, bin_used))
+
+    def test_encode_all_matches_encode(self):
+        qe = enc.QuantizationEncoder(
+                [(0, 2), (-1, 5), (3, 3), (0, 1)],
+                [5, 7, 4, 5],
+                [1, 2, 1, 3]
+                )
+        np.random.seed(0)
+        patterns = np.column_stack([np.random.uniform(0, 2, 50),
+                                    np.random.uniform(-1, 5, 50),
+                                    np.full(50, 3.0),
+                                    np.random.uniform(0, 1, 50)])
+        patterns[0] = [0, -1, 3, 0]
+        patterns[1] = [2, 5, 3, 1]
+
+        codes = qe.encodeAll(patterns.tolist())
+        self.assertEqual(codes.dtype, np.uint8)
+        self.assertEqual(codes.shape, (50, sum(qe.bits_per_attr)))
+        # The constant attribute goes in the first bin
+        self.assertTrue((codes[:, 12:16] == [1, 0, 0, 0]).all())
+
+        without_constant = enc.QuantizationEncoder([(0, 2), (-1, 5), (0, 1)], [5, 7, 5], [1, 2, 3])
+        codes = without_constant.encodeAll(patterns[:, [0, 1, 3]])
+        for (pat, code) in zip(patterns[:, [0, 1, 3]], codes):
+            self.assertEqual(code.tolist(), without_constant.encode(pat.tolist()))
+
+    def test_decode_all_matches_decode_attr(self):
+        qe = enc.QuantizationEncoder([(0, 2), (-1, 5), (0, 1)], [5, 7, 5], [1, 2, 3])
+        np.random.seed(1)
+        patterns = np.column_stack([np.random.uniform(0, 2, 40),
+                                    np.random.uniform(-1, 5, 40),
+                                    np.random.uniform(0, 1, 40)])
+        codes = qe.encodeAll(patterns)
+
+        decoded = qe.decodeAll(codes)
+        self.assertEqual(decoded.shape, (40, 3))
+        for (code, values) in zip(codes.tolist(), decoded):
+            expected = [qe.decode_attr(code[0:5], 0, 2, 5, 1),
+                        qe.decode_attr(code[5:12], -1, 5, 7, 2),
+                        qe.decode_attr(code[12:17], 0, 1, 5, 3)]
+            self.assertEqual(values.tolist(), expected)
+
+    def test_decode_all_invalid_codes(self):
+        qe = enc.QuantizationEncoder([(0, 10)], [5], [2])
+        codes = np.array([
+            [1, 1, 1, 0, 0], # too many bits, closest to bin 0
+            [0, 0, 0, 0, 1], # too few bits, ties go to the lowest bin
+            [0, 0, 0, 0, 0], # nothing set, every code ties
+            [0, 0, 0, 1, 1], # valid, the last bin
+            ])
+        decoded = qe.decodeAll(codes)
+        self.assertEqual(decoded[:, 0].tolist(), [0.0, 3.0, 0.0, 9.0])
+
+class TestDoNothingEncoder(unittest.TestCase):
+
+    def test_batch(self):
+        dne = enc.DoNothingEncoder(1)
+        patterns = [[0, 1, 0], [1, 0, 0]]
+        codes = dne.encode_batch(np.array(patterns, dtype=np.uint8))
+        self.assertEqual(codes.dtype, np.uint8)
+        self.assertEqual(codes.tolist(), patterns)
+        self.assertEqual(dne.decode_batch(codes).dtype, np.float64)
+        # Like encode, anything is passed through
+        self.assertEqual(dne.encode_batch([[0.5, 2.0]]).tolist(), [[0.5, 2.0]])
+        self.assertEqual(dne.encode_batch([[0.5, 2.0]]).dtype, np.float64)
+
+class TestAttributeStats(unittest.TestCase):
+
+    def test_stats(self):
+        np.random.seed(3)
+        patterns = np.random.normal(5, 2, (1000, 4))
+        stats = utils.AttributeStats.from_patterns(patterns.tolist(), chunk_size=64)
+        self.assertEqual(stats.count, 1000)
+        self.assertTrue(np.allclose(stats.mean, patterns.mean(axis=0)))
+        self.assertTrue(np.allclose(stats.variance, patterns.var(axis=0)))
+        self.assertEqual(stats.min_max(), list(zip(patterns.min(axis=0), patterns.max(axis=0))))
+        self.assertEqual(utils.get_min_max_values([[1, 5], [3, -2], [2, 0]]), [(1, 3), (-2, 5)])
+
+    def test_merge(self):
+        np.random.seed(4)
+        patterns = np.random.uniform(-3, 7, (500, 3))
+        whole = utils.AttributeStats().update(patterns)
+        parts = [utils.AttributeStats.from_chunks(np.array_split(part, 3))
+                 for part in np.array_split(patterns, [10, 300])]
+        merged = utils.AttributeStats()
+        for part in parts:
+            merged.merge(part)
+        self.assertEqual(merged.count, whole.count)
+        self.assertTrue(np.allclose(merged.mean, whole.mean))
+        self.assertTrue(np.allclose(merged.m2, whole.m2))
+        self.assertEqual(merged.min_max(), whole.min_max())
+
+        qe = enc.QuantizationEncoder.from_stats(merged, [5, 5, 5], [1, 1, 1])
+        self.assertEqual(qe.encodeAll(patterns).tolist(),
+                         enc.QuantizationEncoder(whole.min_max(), [5, 5, 5], [1, 1, 1]).encodeAll(patterns).tolist())
+
 class TestBaumEncoder(unittest.TestCase):
 
     def test_it_works(self):
@@ -128,6 +233,281 @@ class TestBaumEncoder(unittest.TestCase):
         self.assertEqual(be.encode(12), [0,1, 1,0,0, 1,0,0,0])
         self.assertEqual(be.encode(13), [0,1, 1,0,0, 0,1,0,0])
 
+    def test_codes_match_counter(self):
+        segment_sizes = [2, 3, 4]
+        bit_positions = enc.get_initial_baum_code(segment_sizes)
+        codes = enc.baum_codes(segment_sizes, np.arange(30))
+        for rank in range(30):
+            self.assertEqual(codes[rank].tolist(), enc.concrete_baum_code(segment_sizes, bit_positions))
+            bit_positions = enc.get_next_baum_code(segment_sizes, bit_positions)
+        self.assertEqual(enc.baum_code_ranks(segment_sizes, codes).tolist(), [r % 24 for r in range(30)])
+
+    def test_decode(self):
+        be = enc.BaumEncoder([2, 3])
+        patterns = np.arange(16, dtype=np.float64).reshape(8, 2)
+        codes = be.encodeAll(patterns[:5])
+        codes = np.vstack((codes, [be.encode(pat.tolist()) for pat in patterns[5:]]))
+
+        self.assertEqual(be.decode(codes[2].tolist()), [4.0, 5.0])
+        # The codes wrap round after six patterns, and the latest pattern wins
+        self.assertEqual(be.decodeAll(codes).tolist(), patterns[[6, 7, 2, 3, 4, 5, 6, 7]].tolist())
+
+        fresh = enc.BaumEncoder([2, 3])
+        fresh.encode([1.0, 1.0])
+        with self.assertRaises(KeyError):
+            fresh.decode(codes[3].tolist())
+
+    def test_split_encoding(self):
+        patterns = np.arange(20, dtype=np.float64).reshape(10, 2)
+        sequential = enc.BaumEncoder([2, 3, 4])
+        codes = sequential.encode_batch(patterns)
+
+        # Two workers encode halves of the patterns without any shared state
+        first = enc.BaumEncoder([2, 3, 4]).encode_batch(patterns[:6], start=0)
+        second_encoder = enc.BaumEncoder([2, 3, 4])
+        second = second_encoder.encode_batch(patterns[6:], start=6)
+        self.assertEqual(second_encoder.num_patterns, 0)
+        np.testing.assert_array_equal(np.vstack((first, second)), codes)
+
+        merged = enc.BaumEncoder([2, 3, 4])
+        merged.add_patterns(6, patterns[6:])
+        with self.assertRaises(KeyError):
+            merged.decode_batch(first)
+        merged.add_patterns(0, patterns[:6])
+        np.testing.assert_array_equal(merged.decode_batch(codes), patterns)
+
+class TestSOMEncoder(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(2)
+        self.weights = np.random.uniform(0, 1, (4, 3, 5))
+        # Two identical neurons, the first going column by column should win
+        self.weights[2, 0] = self.weights[1, 2]
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.som_path = os.path.join(self.tmp_dir.name, "test.som")
+        self.write_som_file(self.weights)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def write_som_file(self, weights):
+        (rows, cols, dims) = weights.shape
+        with open(self.som_path, "w") as f:
+            f.write("{},{},{}\n".format(rows, cols, dims))
+            for row in range(rows):
+                for col in range(cols):
+                    f.write(",".join(map(repr, weights[row, col].tolist())) + "\n")
+
+    def test_find_bmus_matches_loop(self):
+        se = enc.SOMEncoder(self.som_path)
+        patterns = np.random.uniform(0, 1, (30, 5))
+        patterns[0] = self.weights[1, 2]
+        for pat in patterns:
+            expected = (0, 0)
+            best = float("inf")
+            for col in range(3):
+                for row in range(4):
+                    dist = se.som.distanceFunc(pat, se.som.getNeuronWeights(row, col))
+                    if dist < best:
+                        (expected, best) = ((row, col), dist)
+            self.assertEqual(se.som.findBMU(pat), expected)
+        self.assertEqual(se.som.findBMU(patterns[0]), (2, 0))
+
+        bmus = se.som.findBMUs(patterns, chunk_size=7)
+        self.assertEqual([tuple(b) for b in bmus.tolist()], [se.som.findBMU(p) for p in patterns])
+
+    def test_bmu_search_methods(self):
+        se = enc.SOMEncoder(self.som_path)
+        patterns = np.random.uniform(0, 1, (50, 5))
+        patterns[0] = self.weights[1, 2]
+        exact = se.som.findBMUs(patterns)
+
+        pruned = se.som.findBMUs(patterns, method="pruned", coarse_factor=2, coarse_candidates=1)
+        self.assertEqual(pruned.tolist(), exact.tolist())
+        # Searching every block of the coarse map is the same as the exact search
+        coarse = se.som.findBMUs(patterns, method="coarse", coarse_factor=2, coarse_candidates=4)
+        self.assertEqual(coarse.tolist(), exact.tolist())
+        with self.assertRaises(ValueError):
+            se.som.findBMUs(patterns, method="fastest")
+
+        report = se.som.compareBMUSearch(patterns, "coarse", coarse_factor=2, coarse_candidates=1)
+        self.assertEqual(report["num_patterns"], 50)
+        self.assertTrue(0 <= report["agreement"] <= 1)
+        self.assertTrue(report["distance_ratio"] >= 1)
+        self.assertEqual(se.som.compareBMUSearch(patterns, "pruned")["agreement"], 1.0)
+
+        # The report goes to the som2cmm logger, which main.py sets up
+        reporting = enc.SOMEncoder(self.som_path, report_bmu_search=True,
+                                   bmu_search={"method": "coarse", "coarse_factor": 2})
+        with self.assertLogs("som2cmm", level="INFO") as logs:
+            reporting.encode_batch(patterns)
+        self.assertTrue(any("BMU search report" in line for line in logs.output))
+
+    def test_train_som(self):
+        patterns = np.random.uniform(0, 10, (200, 2))
+        phases = [enc.som.TrainingPhase(500, 0.5, 0.1, 3.0, 1.0),
+                  enc.som.TrainingPhase(1500, 0.1, 0.05, 1.0, 0.5)]
+        initial = enc.som.SOM()
+        initial.setWeights(enc.som.init_som_weights(patterns, 6, 6, "intelligent",
+                                                    rng=np.random.default_rng(0)))
+        trained = enc.som.train_som(patterns, 6, 6, phases, normalize_inputs=True, seed=0)
+        self.assertEqual(trained.data.shape, (6, 6, 2))
+
+        def quantization_error(s):
+            bmus = s.findBMUs(patterns)
+            return np.linalg.norm(s.data[bmus[:, 0], bmus[:, 1]] - patterns, axis=1).mean()
+        self.assertLess(quantization_error(trained), quantization_error(initial))
+
+        # Written in the .som text format
+        trained.saveToFile(self.som_path)
+        loaded = enc.SOMEncoder(self.som_path, use_cache=False)
+        self.assertTrue(np.allclose(loaded.som.data, trained.data, atol=1e-6))
+
+        with self.assertRaises(ValueError):
+            enc.som.train_som(patterns, 6, 6, phases, init_method="zeros")
+
+    def test_train_som_matches_som_c(self):
+        # The last dimension is constant, which som.c trains on unscaled
+        patterns = np.random.uniform(0, 10, (23, 3))
+        patterns[:, 2] = 4.0
+        phases = [enc.som.TrainingPhase(30, 0.5, 0.1, 2.0, 1.0),
+                  enc.som.TrainingPhase(50, 0.1, 0.05, 1.0, 0.5)]
+        trained = enc.som.train_som(patterns, 4, 5, phases, normalize_inputs=True,
+                                    init_method="randomize", randomize_min=0, randomize_max=1,
+                                    batch_size=1, seed=3)
+
+        # A direct port of som.c's train_SOM and adjust_weights
+        minima, maxima = patterns.min(axis=0), patterns.max(axis=0)
+        inputs = np.where(maxima > minima, (patterns - minima) / np.where(maxima > minima, maxima - minima, 1), minima)
+        weights = enc.som.init_som_weights(inputs, 4, 5, "randomize", 0, 0, 1,
+                                           np.random.default_rng(3)).reshape(20, 3)
+        positions = np.array([(n // 5, n % 5) for n in range(20)], dtype=np.float64)
+        for phase in phases:
+            for iteration in range(phase.iterations):
+                x = inputs[iteration % len(inputs)]
+                progress = iteration / (phase.iterations - 1)
+                learn_rate, radius = phase.getLearnRate(progress), phase.getRadius(progress)
+                bmu = np.argmin(np.linalg.norm(weights - x, axis=1))
+                delta = x - weights[bmu]
+                for neuron in range(20):
+                    dist = np.linalg.norm(positions[bmu] - positions[neuron])
+                    weights[neuron] += learn_rate * np.exp(-0.5 * (dist / radius) ** 2) * delta
+        weights = minima + weights * (maxima - minima)
+
+        np.testing.assert_allclose(trained.data.reshape(20, 3), weights, atol=1e-9)
+        np.testing.assert_array_equal(trained.data[:, :, 2], 4.0)
+
+    def test_encode_all_matches_encode(self):
+        se = enc.SOMEncoder(self.som_path)
+        patterns = np.random.uniform(0, 1, (10, 5))
+        codes = se.encodeAll(patterns)
+        self.assertEqual(codes.shape, (10, 7))
+        for (pat, code) in zip(patterns, codes):
+            self.assertEqual(code.tolist(), se.encode(pat.tolist()))
+
+    def test_decode_batch_matches_decode(self):
+        se = enc.SOMEncoder(self.som_path)
+        codes = se.encode_batch(np.random.uniform(0, 1, (10, 5)))
+        decoded = se.decode_batch(codes)
+        self.assertEqual(decoded.shape, (10, 5))
+        for (code, values) in zip(codes.tolist(), decoded):
+            self.assertEqual(values.tolist(), se.decode(code))
+
+    def test_codebook_cache(self):
+        se = enc.SOMEncoder(self.som_path)
+        self.assertTrue(np.array_equal(se.som.data, self.weights))
+        self.assertTrue(os.path.isfile(self.som_path + ".npy"))
+
+        # The second load comes from the cached copy
+        cached = enc.SOMEncoder(self.som_path)
+        self.assertIsInstance(cached.som.data, np.memmap)
+        self.assertTrue(np.array_equal(cached.som.data, self.weights))
+
+        # Changing the .som file invalidates the cached copy
+        changed = self.weights[:, :2] + 1
+        self.write_som_file(changed)
+        reloaded = enc.SOMEncoder(self.som_path)
+        self.assertTrue(np.array_equal(reloaded.som.data, changed))
+
+    def test_binary_codebook(self):
+        se = enc.SOMEncoder(self.som_path, use_cache=False)
+        self.assertFalse(os.path.isfile(self.som_path + ".npy"))
+        patterns = np.random.uniform(0, 1, (10, 5))
+
+        for (name, dtype) in [("test.npy", np.float64), ("test.npz", np.float32)]:
+            path = os.path.join(self.tmp_dir.name, name)
+            se.som.saveToFile(path, dtype=dtype)
+            loaded = enc.SOMEncoder(path)
+            self.assertEqual(loaded.som.data.dtype, dtype)
+            self.assertTrue(np.allclose(loaded.som.data, self.weights))
+            self.assertEqual(loaded.encodeAll(patterns).tolist(), se.encodeAll(patterns).tolist())
+
+class TestEncodingCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.patterns_path = os.path.join(self.tmp_dir.name, "patterns.json")
+        utils.save_patterns_file([[1, 2], [3, 4], [2, 2]], [[0, 1], [1, 0], [1, 1]], self.patterns_path)
+        self.config = {
+            "input_patterns_file": self.patterns_path,
+            "encoding": {"keys": {"method": "quantize",
+                                  "quantize": {"bits_per_attr": [4, 4], "bits_set_per_attr": [1, 1]}},
+                         "values": {"method": "donothing", "donothing": {"bits_set": 1}}},
+            "cmm": {"threshold_func": "lmax1"},
+            "cache": {"directory": os.path.join(self.tmp_dir.name, "cache"), "max_size_mb": 1},
+            }
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_key(self):
+        key = cache.cache_key(self.config)
+        self.assertEqual(cache.cache_key(dict(self.config, cmm={"threshold_func": "willshaw"})), key)
+        self.assertNotEqual(cache.cache_key(dict(self.config, num_patterns=2)), key)
+
+        utils.save_patterns_file([[1, 2]], [[0, 1]], self.patterns_path)
+        changed_key = cache.cache_key(self.config)
+        self.assertNotEqual(changed_key, key)
+
+        version = cache.CACHE_FORMAT_VERSION
+        try:
+            cache.CACHE_FORMAT_VERSION = version + 1
+            self.assertNotEqual(cache.cache_key(self.config), changed_key)
+        finally:
+            cache.CACHE_FORMAT_VERSION = version
+
+    def test_get_put(self):
+        encoding_cache = cache.EncodingCache.from_config(self.config)
+        key = cache.cache_key(self.config)
+        self.assertIsNone(encoding_cache.get(key))
+
+        qe = enc.QuantizationEncoder([(1, 3), (2, 4)], [4, 4], [1, 1])
+        keys = [[1, 2], [3, 4]]
+        codes = qe.encode_batch(np.array(keys, dtype=np.float64))
+        encoding_cache.put(key, keys, keys, qe, qe, codes, codes)
+
+        (key_patterns, _, key_encoder, _, key_codes, _) = encoding_cache.get(key)
+        self.assertEqual(key_patterns, keys)
+        np.testing.assert_array_equal(key_codes, codes)
+        np.testing.assert_array_equal(key_encoder.decode_batch(key_codes), qe.decode_batch(codes))
+
+        # An entry pickled with a class which no longer exists is a miss
+        with open(os.path.join(encoding_cache.entry_path(key), cache.STATE_FILE), 'wb') as f:
+            f.write(b"\x80\x04csom2cmm.encoding_schemes\nRemovedEncoder\n.")
+        with self.assertLogs("som2cmm", level="WARNING"):
+            self.assertIsNone(encoding_cache.get(key))
+
+    def test_evict(self):
+        encoding_cache = cache.EncodingCache(os.path.join(self.tmp_dir.name, "cache"), max_size_mb=1)
+        big = np.zeros((200, 1000), dtype=np.uint8)
+        for (i, key) in enumerate(["a", "b", "c"]):
+            encoding_cache.put(key, [], [], None, None, big, big)
+            os.utime(encoding_cache.entry_path(key), (i, i))
+            if key == "b":
+                # Using "a" makes "b" the least recently used
+                encoding_cache.get("a")
+        self.assertEqual(sorted(name for (_, _, name) in encoding_cache.entries()), ["a", "c"])
+
 
 def count_1s(code):
     return sum(code)
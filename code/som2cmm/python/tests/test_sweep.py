@@ -0,0 +1,89 @@
+import json
+import os
+import tempfile
+import unittest
+import numpy as np
+
+from .context import som2cmm
+import som2cmm.utils as utils
+import main
+import sweep
+
+class TestSweep(unittest.TestCase):
+
+    def test_expand_grid(self):
+        base_config = {
+            "input_patterns_file": "patterns.json",
+            "encoding": {"keys": {"method": "quantize"}, "values": {"copy_keys_encoding": True}},
+            "cmm": {"threshold_func": "lmax1"},
+            }
+        axes = {"num_patterns": [10, 20], "cmm.threshold_func": ["lmax1", "willshaw"],
+                "cmm.smart_recall": [True]}
+        points = sweep.expand_grid(base_config, axes, "/tmp/sweep")
+
+        self.assertEqual(len(points), 4)
+        (params, config) = points[1]
+        self.assertEqual(dict(params), {"num_patterns": 10, "cmm.threshold_func": "willshaw",
+                                        "cmm.smart_recall": True})
+        self.assertEqual(config["cmm"], {"threshold_func": "willshaw", "smart_recall": True})
+        self.assertEqual(config["working_directory"],
+                         "/tmp/sweep/num_patterns=10,threshold_func=willshaw,smart_recall=True")
+        self.assertEqual(base_config["cmm"], {"threshold_func": "lmax1"})
+
+        # Only the points with different num_patterns need encoding separately
+        keys = set(sweep.encoding_key(config) for (params, config) in points)
+        self.assertEqual(len(keys), 2)
+
+    def test_run_sweep(self):
+        np.random.seed(9)
+        key_patterns = np.random.uniform(0, 10, (12, 3)).tolist()
+        value_patterns = np.eye(3, dtype=int)[np.random.randint(3, size=12)].tolist()
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            utils.save_patterns_file(key_patterns, value_patterns, os.path.join(tmp_dir, "patterns.json"))
+            with open(os.path.join(tmp_dir, "base.toml"), 'w') as f:
+                f.write("working_directory = \"unused\"\n"
+                        "input_patterns_file = \"{}\"\n"
+                        "[cmm]\nthreshold_func = \"lmax1\"\nmem_format = \"none\"\n"
+                        "[encoding.keys]\nmethod = \"quantize\"\n"
+                        "[encoding.keys.quantize]\nbits_per_attr = [8, 8, 8]\nbits_set_per_attr = [1, 1, 1]\n"
+                        "[encoding.values]\nmethod = \"donothing\"\n"
+                        "[encoding.values.donothing]\nbits_set = 1\n"
+                        .format(os.path.join(tmp_dir, "patterns.json")))
+            sweep_config = {
+                "base_config": "base.toml",
+                "working_directory": "out",
+                "axes": {"num_patterns": [6, 12], "cmm.smart_recall": [True, False]},
+                }
+            results = sweep.run_sweep(sweep_config, tmp_dir, processes=2)
+
+            self.assertEqual(len(results), 4)
+            self.assertEqual(results[3]["params"], {"num_patterns": 12, "cmm.smart_recall": False})
+            for result in results:
+                stats = result["stats"]
+                self.assertEqual(stats["exactly right"] + stats["not exactly right"],
+                                 result["params"]["num_patterns"])
+                self.assertTrue(os.path.isfile(os.path.join(result["working_directory"], "results.txt")))
+            with open(os.path.join(tmp_dir, "out", "sweep_results.json")) as f:
+                self.assertEqual(json.load(f), results)
+
+    def test_patterns_loaded_once(self):
+        key_patterns = np.random.uniform(0, 10, (12, 3)).tolist()
+        value_patterns = np.eye(3, dtype=int)[np.random.randint(3, size=12)].tolist()
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            input_path = os.path.join(tmp_dir, "patterns.json")
+            utils.save_patterns_file(key_patterns, value_patterns, input_path)
+            config = {
+                "input_patterns_file": input_path,
+                "encoding": {"keys": {"method": "quantize",
+                                      "quantize": {"bits_per_attr": [8] * 3, "bits_set_per_attr": [1] * 3}},
+                             "values": {"method": "donothing", "donothing": {"bits_set": 1}}},
+                }
+            patterns_cache = {}
+            for num_patterns in [6, 12, None]:
+                encoded = main.load_encoded_patterns(dict(config, num_patterns=num_patterns), patterns_cache)
+                self.assertEqual(encoded[0], key_patterns[:num_patterns])
+                self.assertEqual(encoded[1], value_patterns[:num_patterns])
+                self.assertEqual(len(encoded[4]), len(encoded[0]))
+            self.assertEqual(list(patterns_cache), [input_path])
@@ -0,0 +1,38 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+
+from .context import som2cmm
+import som2cmm.utils as utils
+
+class TestPatternsFiles(unittest.TestCase):
+
+    def test_patterns_binary_file(self):
+        key_patterns = [[5.1, 3.5], [4.9, 3.0], [6.2, 2.9]]
+        value_patterns = [[1, 0], [1, 0], [0, 1]]
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            json_path = os.path.join(tmp_dir, "patterns.json")
+            binary_path = os.path.join(tmp_dir, "patterns.bin")
+            utils.save_patterns_file(key_patterns, value_patterns, json_path)
+            utils.convert_patterns_json(json_path, binary_path)
+            self.assertTrue(utils.is_binary_file(binary_path, utils.PATTERNS_MAGIC))
+
+            header, keys, values = utils.load_patterns_binary_file(binary_path)
+            self.assertIsInstance(keys, np.memmap)
+            self.assertEqual(header["count"], 3)
+            self.assertEqual(keys.tolist(), key_patterns)
+            self.assertEqual(values.tolist(), value_patterns)
+
+            keys, values = utils.load_pattern_arrays(binary_path, start=1, stop=2)
+            self.assertEqual((keys.tolist(), values.tolist()), ([[4.9, 3.0]], [[1, 0]]))
+
+            csv_path = os.path.join(tmp_dir, "patterns.csv")
+            with open(csv_path, 'w') as f:
+                f.write("5.1,3.5,b\n4.9,3.0,b\n\n6.2,2.9,a\n")
+            utils.convert_patterns_csv(csv_path, binary_path, classes=["b", "a"])
+            header, keys, values = utils.load_patterns_binary_file(binary_path, mmap_mode=None)
+            self.assertEqual(header["metadata"]["classes"], ["b", "a"])
+            self.assertEqual(keys.tolist(), key_patterns)
+            self.assertEqual(values.tolist(), value_patterns)